@@ -0,0 +1,120 @@
+"""analysis_cache.py
+   script to keep the state of the analysers for a pcap file in a sidecar cache file
+   so later runs only have to read packets added since the cache was saved
+
+   the cache is keyed by the size, modification time and a hash of the start of the file
+   an unchanged file is not read again, only the outputs are built from the cached state
+   a file that has only grown (e.g. a rolling tcpdump capture) is read from
+   the end of the last record in the cache
+"""
+import hashlib
+import os
+import pickle
+from typing import Optional
+from pcap_pipeline import Analyser
+
+# changed whenever the layout of the cache file or the analysers state changes
+CACHE_VERSION = 3
+
+# most bytes at the start of the capture hashed to check it is the same capture
+HASH_SIZE = 65536
+
+
+def cache_path(pcap_file: str) -> str:
+    """
+    :param pcap_file: relative path to pcap file
+    :return: path of the sidecar cache file used when none is given
+    """
+    return f'{pcap_file}.cache'
+
+
+def fingerprint(pcap_file: str, hash_size: int = HASH_SIZE) -> dict:
+    """
+    identify the contents of a pcap file without reading all of it
+    :param pcap_file: relative path to pcap file
+    :param hash_size: most bytes at the start of the file to hash
+    :return: dictionary of size, mtime, hash_size and digest
+    """
+    status = os.stat(pcap_file)
+    with open(pcap_file, 'rb') as open_file:
+        head = open_file.read(hash_size)
+    return {'size': status.st_size,
+            'mtime': status.st_mtime_ns,
+            # the same number of bytes must be hashed to compare a capture that has grown
+            'hash_size': len(head),
+            'digest': hashlib.sha256(head).hexdigest()}
+
+
+def same_capture(cached: dict, pcap_file: str) -> bool:
+    """
+    check a pcap file is the capture a fingerprint was taken of, or that capture after it has grown
+    :param cached: fingerprint taken when a sidecar file was saved
+    :param pcap_file: relative path to pcap file
+    :return: True if the file is unchanged or has only had records added
+    """
+    current = fingerprint(pcap_file, cached['hash_size'])
+    # the start of the file must be the same capture
+    if current['digest'] != cached['digest'] or current['size'] < cached['size']:
+        return False
+    # a file the same size that has been modified may have been rewritten
+    return current['size'] > cached['size'] or current['mtime'] == cached['mtime']
+
+
+def load_cache(cache_file: str, pcap_file: str, analysers: list[Analyser],
+               packet_filter: Optional[str] = None) -> Optional[tuple[int, list[Analyser], int]]:
+    """
+    read the cached state of the analysers
+    if the cache was saved for the same capture, or an earlier part of it
+    :param cache_file: path of the cache file
+    :param pcap_file: relative path to pcap file
+    :param analysers: analysers for this run, the cache must be for the same analysers and options
+    :param packet_filter: filter expression for this run, the cache must be for the same filter
+    :return: (offset to carry on reading the capture from, cached analysers, packets they were fed) tuple,
+             None if the cache cannot be used
+    """
+    try:
+        with open(cache_file, 'rb') as open_file:
+            cache = pickle.load(open_file)
+    # no cache yet, or a cache that cannot be read is built again
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return None
+    # analysers collecting different state cannot continue from the cache
+    cached_analysers = cache['analysers']
+    if [(type(analyser), analyser.options()) for analyser in analysers] != \
+            [(type(analyser), analyser.options()) for analyser in cached_analysers]:
+        return None
+    if cache.get('filter') != packet_filter:
+        return None
+
+    if not same_capture(cache['fingerprint'], pcap_file):
+        return None
+
+    return cache['offset'], cached_analysers, cache['packets']
+
+
+def save_cache(cache_file: str, pcap_file: str, analysers: list[Analyser], offset: int,
+               packet_filter: Optional[str] = None, packets: int = 0) -> None:
+    """
+    save the state of each analyser
+    :param cache_file: path of the cache file
+    :param pcap_file: relative path to pcap file
+    :param analysers: analysers fed every packet up to offset
+    :param offset: offset after the last record the analysers were fed
+    :param packet_filter: filter expression packets were kept by, None for every packet
+    :param packets: number of packets the analysers were fed, where the next run carries on counting from
+    """
+    cache = {'version': CACHE_VERSION,
+             'fingerprint': fingerprint(pcap_file),
+             'filter': packet_filter,
+             'offset': offset,
+             'packets': packets,
+             'analysers': analysers}
+
+    # replace the old cache in one step so an interrupted save never leaves half a cache
+    temporary_file = f'{cache_file}.tmp'
+    with open(temporary_file, 'wb') as open_file:
+        pickle.dump(cache, open_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_file, cache_file)
@@ -0,0 +1,455 @@
+"""flow_table.py
+   script to track the flows of a capture in a hash table held in numpy arrays
+
+   a flow is both directions of a connection, keyed by the 5-tuple
+   (source IP, destination IP, source port, destination port, protocol),
+   its source is the end that sent the first packet seen
+   packets and bytes are counted in each direction, along with the first and last packet
+   and the TCP flags seen, which give the duration and mean time between packets
+
+   flows are rows of numpy arrays found through an open addressing hash table,
+   so each flow takes under a hundred bytes rather than a python object,
+   and a batch of packets is added with a few array operations
+
+   a flow ends when no packet is seen for the idle timeout, or at the first sweep after
+   it has lasted the active timeout, finished flows are returned to be written out and forgotten
+   sweeps happen at fixed times, so the flows found do not depend on how packets are batched
+"""
+from typing import Optional
+import numpy as np
+from sketches import mix64
+
+# one row for each flow handed out, src is the end that sent the first packet seen,
+# reverse_packets and reverse_bytes were sent by dst, flags are every TCP flag seen
+FLOW_DTYPE = np.dtype([('src', 'u4'),
+                       ('dst', 'u4'),
+                       ('sport', 'u2'),
+                       ('dport', 'u2'),
+                       ('proto', 'i2'),
+                       ('packets', 'i8'),
+                       ('bytes', 'i8'),
+                       ('reverse_packets', 'i8'),
+                       ('reverse_bytes', 'i8'),
+                       ('start', 'f8'),
+                       ('end', 'f8'),
+                       ('flags', 'u1')])
+
+# one row for each flow in the table, keyed by its lower and higher end (IP << 16 | port),
+# the higher end also holds the protocol, counts are of packets sent by each end
+ROW_DTYPE = np.dtype([('low', 'u8'),
+                      ('high', 'u8'),
+                      ('low_packets', 'i8'),
+                      ('low_bytes', 'i8'),
+                      ('high_packets', 'i8'),
+                      ('high_bytes', 'i8'),
+                      ('start', 'f8'),
+                      ('end', 'f8'),
+                      ('flags', 'u1'),
+                      ('high_first', '?')])
+
+# fields added together when two parts of a flow are joined
+_COUNTS = ('low_packets', 'low_bytes', 'high_packets', 'high_bytes')
+
+# fewest slots in the hash table, a power of two
+MIN_SLOTS = 1 << 12
+
+# most of the slots used before the hash table grows
+MAX_LOAD = 0.5
+
+# sweeps for finished flows in each idle timeout
+SWEEPS_PER_TIMEOUT = 4
+
+_UINT64 = np.uint64
+
+
+def flow_keys(src: np.ndarray, dst: np.ndarray, sport: np.ndarray, dport: np.ndarray,
+              proto: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    key both directions of a connection the same way
+    :param src: source IPv4 address of each packet
+    :param dst: destination IPv4 address of each packet
+    :param sport: source port of each packet
+    :param dport: destination port of each packet
+    :param proto: IP protocol of each packet
+    :return: (lower end, higher end and protocol, sent by the higher end) tuple of arrays
+    """
+    source = (src.astype(_UINT64) << _UINT64(16)) | sport.astype(_UINT64)
+    destination = (dst.astype(_UINT64) << _UINT64(16)) | dport.astype(_UINT64)
+    from_high = source > destination
+    low = np.where(from_high, destination, source)
+    high = (np.where(from_high, source, destination) << _UINT64(8)) | (proto.astype(_UINT64) & _UINT64(0xff))
+    return low, high, from_high
+
+
+def key_hash(low: np.ndarray, high: np.ndarray) -> np.ndarray:
+    """
+    :param low: lower end of each flow
+    :param high: higher end and protocol of each flow
+    :return: 64 bit hash of each flow
+    """
+    return mix64(low ^ mix64(high))
+
+
+def to_flows(rows: np.ndarray) -> np.ndarray:
+    """
+    :param rows: numpy structured array of ROW_DTYPE rows
+    :return: numpy structured array of FLOW_DTYPE rows, facing the way the first packet was sent
+    """
+    flows = np.zeros(len(rows), dtype=FLOW_DTYPE)
+    high_first = rows['high_first']
+    high = rows['high'] >> _UINT64(8)
+    first = np.where(high_first, high, rows['low'])
+    second = np.where(high_first, rows['low'], high)
+
+    flows['src'] = first >> _UINT64(16)
+    flows['dst'] = second >> _UINT64(16)
+    flows['sport'] = first & _UINT64(0xffff)
+    flows['dport'] = second & _UINT64(0xffff)
+    flows['proto'] = rows['high'] & _UINT64(0xff)
+    flows['packets'] = np.where(high_first, rows['high_packets'], rows['low_packets'])
+    flows['bytes'] = np.where(high_first, rows['high_bytes'], rows['low_bytes'])
+    flows['reverse_packets'] = np.where(high_first, rows['low_packets'], rows['high_packets'])
+    flows['reverse_bytes'] = np.where(high_first, rows['low_bytes'], rows['high_bytes'])
+    for field in ('start', 'end', 'flags'):
+        flows[field] = rows[field]
+    return flows
+
+
+def from_flows(flows: np.ndarray) -> np.ndarray:
+    """
+    :param flows: numpy structured array of FLOW_DTYPE rows
+    :return: numpy structured array of ROW_DTYPE rows
+    """
+    rows = np.zeros(len(flows), dtype=ROW_DTYPE)
+    low, high, high_first = flow_keys(flows['src'], flows['dst'], flows['sport'], flows['dport'], flows['proto'])
+    rows['low'] = low
+    rows['high'] = high
+    rows['high_first'] = high_first
+    rows['low_packets'] = np.where(high_first, flows['reverse_packets'], flows['packets'])
+    rows['low_bytes'] = np.where(high_first, flows['reverse_bytes'], flows['bytes'])
+    rows['high_packets'] = np.where(high_first, flows['packets'], flows['reverse_packets'])
+    rows['high_bytes'] = np.where(high_first, flows['bytes'], flows['reverse_bytes'])
+    for field in ('start', 'end', 'flags'):
+        rows[field] = flows[field]
+    return rows
+
+
+class FlowTable:
+    """
+    table of the flows in progress, one ROW_DTYPE row each
+    slots of the hash table hold the row of a flow, or -1 when free,
+    a key is in the first slot free or holding it, counting on from the slot it hashes to
+    """
+
+    def __init__(self, idle_timeout: float = 120.0, active_timeout: float = 1800.0):
+        """
+        :param idle_timeout: seconds without a packet before a flow ends
+        :param active_timeout: seconds after which a flow still going is handed out and started again
+        """
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.sweep_interval = idle_timeout / SWEEPS_PER_TIMEOUT
+        self.rows = np.zeros(MIN_SLOTS // 2, dtype=ROW_DTYPE)
+        # number of rows in use, rows are kept together at the start of the array
+        self.count = 0
+        self._slots = np.full(MIN_SLOTS, -1, dtype=np.intp)
+        # number of sweep intervals since the epoch at the last sweep
+        self.tick: Optional[int] = None
+        # timestamp of the first packet added
+        self.first: Optional[float] = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, timestamps: np.ndarray, lengths: np.ndarray, src: np.ndarray, dst: np.ndarray,
+            sport: np.ndarray, dport: np.ndarray, proto: np.ndarray, flags: np.ndarray) -> np.ndarray:
+        """
+        add a batch of IPv4 packets to their flows, sweeping for finished flows at each sweep time passed
+        :param timestamps: timestamp of each packet
+        :param lengths: size of each packet
+        :param src: source IPv4 address of each packet
+        :param dst: destination IPv4 address of each packet
+        :param sport: source port of each packet, 0 without ports
+        :param dport: destination port of each packet, 0 without ports
+        :param proto: IP protocol of each packet
+        :param flags: TCP flags of each packet, 0 when not TCP
+        :return: numpy structured array of FLOW_DTYPE rows for the flows that finished
+        """
+        if len(timestamps) == 0:
+            return np.zeros(0, dtype=FLOW_DTYPE)
+
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if self.first is None:
+            self.first = float(timestamps[0])
+        low, high, from_high = flow_keys(src, dst, sport, dport, proto)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        flags = np.asarray(flags, dtype=np.uint8)
+
+        # a packet older than one before it is swept with the later packet
+        ticks = np.floor(np.maximum.accumulate(timestamps) / self.sweep_interval).astype(np.int64)
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(ticks)) + 1, [len(ticks)]))
+        finished = []
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            finished.append(self.sweep(int(ticks[start])))
+            part = slice(start, end)
+            finished.append(self._add_packets(timestamps[part], lengths[part], low[part], high[part],
+                                              from_high[part], flags[part]))
+        return to_flows(np.concatenate(finished))
+
+    def _add_packets(self, timestamps: np.ndarray, lengths: np.ndarray, low: np.ndarray, high: np.ndarray,
+                     from_high: np.ndarray, flags: np.ndarray) -> np.ndarray:
+        """
+        add packets between two sweeps to their flows
+        packets of a flow more than the idle timeout apart are split into separate flows
+        :return: numpy structured array of ROW_DTYPE rows for the flows that finished
+        """
+        order = np.lexsort((timestamps, high, low))
+        timestamps, lengths, low, high, from_high, flags = (
+            timestamps[order], lengths[order], low[order], high[order], from_high[order], flags[order])
+
+        # each part of a flow with no gap longer than the idle timeout is one segment
+        new_key = np.ones(len(order), dtype=bool)
+        new_key[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+        new_segment = new_key.copy()
+        new_segment[1:] |= np.diff(timestamps) > self.idle_timeout
+        starts = np.flatnonzero(new_segment)
+        ends = np.append(starts[1:], len(order)) - 1
+
+        segments = np.zeros(len(starts), dtype=ROW_DTYPE)
+        segments['low'] = low[starts]
+        segments['high'] = high[starts]
+        high_lengths = np.where(from_high, lengths, 0)
+        segments['high_packets'] = np.add.reduceat(from_high.astype(np.int64), starts)
+        segments['low_packets'] = ends - starts + 1 - segments['high_packets']
+        segments['high_bytes'] = np.add.reduceat(high_lengths, starts)
+        segments['low_bytes'] = np.add.reduceat(lengths, starts) - segments['high_bytes']
+        segments['start'] = timestamps[starts]
+        segments['end'] = timestamps[ends]
+        segments['flags'] = np.bitwise_or.reduceat(flags, starts)
+        segments['high_first'] = from_high[starts]
+
+        first = new_key[starts]
+        last = np.append(first[1:], True)
+        # the first segment of each flow carries on from the flow in the table, unless it has been idle too long
+        heads = segments[first]
+        rows, created = self._find(heads['low'], heads['high'])
+        joined = ~created & (heads['start'] - self.rows['end'][rows] <= self.idle_timeout)
+        finished = [self.rows[rows[~created & ~joined]]]
+        self._join(rows[joined], heads[joined])
+        self.rows[rows[~joined]] = heads[~joined]
+
+        # a flow with later segments has finished, as have all but its last segment
+        head_rows = rows[np.cumsum(first) - 1]
+        tails = last & ~first
+        finished.append(self.rows[head_rows[tails]])
+        finished.append(segments[~first & ~last])
+        self.rows[head_rows[tails]] = segments[tails]
+        return np.concatenate(finished)
+
+    def _join(self, rows: np.ndarray, parts: np.ndarray) -> None:
+        """
+        add later parts of flows to the flows in the table
+        :param rows: row of each flow, each row only once
+        :param parts: numpy structured array of ROW_DTYPE rows for the same flows
+        """
+        table = self.rows
+        for field in _COUNTS:
+            table[field][rows] += parts[field]
+        earlier = parts['start'] < table['start'][rows]
+        table['high_first'][rows] = np.where(earlier, parts['high_first'], table['high_first'][rows])
+        table['start'][rows] = np.minimum(table['start'][rows], parts['start'])
+        table['end'][rows] = np.maximum(table['end'][rows], parts['end'])
+        table['flags'][rows] |= parts['flags']
+
+    def _find(self, low: np.ndarray, high: np.ndarray, insert: bool = True) -> tuple[np.ndarray, np.ndarray]:
+        """
+        find the rows of flows, adding a row for each flow not in the table
+        :param low: lower end of each flow, each flow only once
+        :param high: higher end and protocol of each flow
+        :param insert: add flows not in the table, otherwise their row is -1
+        :return: (row of each flow, flows added) tuple of arrays
+        """
+        if insert:
+            self._reserve(len(low))
+        mask = len(self._slots) - 1
+        slots = (key_hash(low, high) & _UINT64(mask)).astype(np.intp)
+        rows = np.full(len(low), -1, dtype=np.intp)
+        created = np.zeros(len(low), dtype=bool)
+
+        pending = np.arange(len(low))
+        while len(pending):
+            slot = slots[pending]
+            occupant = self._slots[slot]
+            empty = occupant < 0
+            found = ~empty
+            found[found] = (self.rows['low'][occupant[found]] == low[pending[found]]) & \
+                           (self.rows['high'][occupant[found]] == high[pending[found]])
+            rows[pending[found]] = occupant[found]
+
+            if insert and empty.any():
+                # only one of the flows hashing to the same free slot takes it
+                free, first = np.unique(slot[empty], return_index=True)
+                winners = pending[empty][first]
+                new_rows = np.arange(self.count, self.count + len(winners))
+                self._slots[free] = new_rows
+                self.rows['low'][new_rows] = low[winners]
+                self.rows['high'][new_rows] = high[winners]
+                self.count += len(winners)
+                rows[winners] = new_rows
+                created[winners] = True
+
+            # flows in a slot held by another flow try the next slot,
+            # flows that lost a free slot try it again and find it taken
+            taken = ~empty & ~found
+            slots[pending[taken]] = (slot[taken] + 1) & mask
+            # without inserting, a free slot ends the search for a flow not in the table
+            pending = pending[rows[pending] < 0] if insert else pending[taken]
+        return rows, created
+
+    def _reserve(self, number: int) -> None:
+        """
+        make room for more flows, growing the rows and the hash table
+        :param number: number of flows that may be added
+        """
+        needed = self.count + number
+        if needed > len(self.rows):
+            rows = np.zeros(max(needed, 2 * len(self.rows)), dtype=ROW_DTYPE)
+            rows[:self.count] = self.rows[:self.count]
+            self.rows = rows
+        if needed > len(self._slots) * MAX_LOAD:
+            size = len(self._slots)
+            while needed > size * MAX_LOAD:
+                size *= 2
+            self._rehash(size)
+
+    def _rehash(self, size: int) -> None:
+        """
+        put every row in use into a new hash table, the rows keep their place
+        :param size: number of slots, a power of two
+        """
+        self._slots = np.full(size, -1, dtype=np.intp)
+        mask = size - 1
+        rows = self.rows[:self.count]
+        slots = (key_hash(rows['low'], rows['high']) & _UINT64(mask)).astype(np.intp)
+
+        pending = np.arange(self.count)
+        while len(pending):
+            slot = slots[pending]
+            free = np.flatnonzero(self._slots[slot] < 0)
+            # only one of the rows hashing to the same free slot takes it, the others try the next slot
+            unused_slots, first = np.unique(slot[free], return_index=True)
+            placed = free[first]
+            self._slots[slot[placed]] = pending[placed]
+            left = np.ones(len(pending), dtype=bool)
+            left[placed] = False
+            slots[pending[left]] = (slot[left] + 1) & mask
+            pending = pending[left]
+
+    def sweep(self, tick: int) -> np.ndarray:
+        """
+        remove flows idle for longer than the idle timeout, or going for longer than the active timeout
+        :param tick: number of sweep intervals since the epoch to sweep at
+        :return: numpy structured array of ROW_DTYPE rows for the flows removed
+        """
+        if self.tick is not None and tick <= self.tick:
+            return np.zeros(0, dtype=ROW_DTYPE)
+        self.tick = tick
+        now = tick * self.sweep_interval
+        rows = self.rows[:self.count]
+        done = (rows['end'] < now - self.idle_timeout) | (rows['start'] <= now - self.active_timeout)
+        return self._remove(done)
+
+    def _remove(self, done: np.ndarray) -> np.ndarray:
+        """
+        remove flows from the table, keeping the other rows together
+        :param done: boolean mask over the rows in use
+        :return: numpy structured array of ROW_DTYPE rows removed
+        """
+        if not done.any():
+            return np.zeros(0, dtype=ROW_DTYPE)
+        rows = self.rows[:self.count]
+        removed = rows[done]
+        kept = rows[~done]
+        self.rows[:len(kept)] = kept
+        self.count = len(kept)
+        self._rehash(len(self._slots))
+        return removed
+
+    def close(self) -> np.ndarray:
+        """
+        end every flow, e.g. at the end of the capture
+        :return: numpy structured array of FLOW_DTYPE rows for the flows in progress
+        """
+        return to_flows(self._remove(np.ones(self.count, dtype=bool)))
+
+    def live(self) -> np.ndarray:
+        """
+        :return: numpy structured array of FLOW_DTYPE rows for the flows in progress
+        """
+        return to_flows(self.rows[:self.count])
+
+    def lookup(self, src: int, dst: int, sport: int, dport: int, proto: int) -> Optional[np.void]:
+        """
+        find the connection a packet belongs to, sent either way
+        :param src: source IPv4 address as an integer
+        :param dst: destination IPv4 address as an integer
+        :param sport: source port
+        :param dport: destination port
+        :param proto: IP protocol
+        :return: FLOW_DTYPE row of the flow in progress, None if there is none
+        """
+        low, high, unused_from_high = flow_keys(*(np.array([value]) for value in (src, dst, sport, dport, proto)))
+        rows, unused_created = self._find(low, high, insert=False)
+        if rows[0] < 0:
+            return None
+        return to_flows(self.rows[rows])[0]
+
+    def merge(self, other: 'FlowTable', heads: np.ndarray) -> np.ndarray:
+        """
+        add the flows of a table fed the following packets to this table
+        the first part of each flow in the other table carries on from the same flow in this table,
+        unless it was idle too long, a flow going past the active timeout across the two tables
+        is swept at the end of the other table rather than where one table would have swept it
+        :param other: table fed the following packets
+        :param heads: numpy structured array of FLOW_DTYPE rows for the flows the other table finished
+                      that could carry on from this table, those starting within the idle timeout of its first packet
+        :return: numpy structured array of FLOW_DTYPE rows for the flows that finished
+        """
+        if other.first is None:
+            return np.zeros(0, dtype=FLOW_DTYPE)
+        if self.first is None:
+            self.first = other.first
+
+        # sweep as a single table would before the first packet of the other table
+        finished = [self.sweep(int(np.floor(other.first / self.sweep_interval)))]
+
+        parts = np.concatenate((from_flows(heads), other.rows[:other.count]))
+        live = np.arange(len(parts)) >= len(heads)
+        order = np.lexsort((parts['start'], parts['high'], parts['low']))
+        parts, live = parts[order], live[order]
+        first = np.ones(len(parts), dtype=bool)
+        first[1:] = (parts['low'][1:] != parts['low'][:-1]) | (parts['high'][1:] != parts['high'][:-1])
+        last = np.append(first[1:], True)
+
+        # the first part of each flow is joined to the flow in this table, unless it has been idle too long
+        firsts = parts[first]
+        rows, created = self._find(firsts['low'], firsts['high'])
+        joined = ~created & (firsts['start'] - self.rows['end'][rows] <= self.idle_timeout)
+        finished.append(self.rows[rows[~created & ~joined]])
+        self._join(rows[joined], firsts[joined])
+        self.rows[rows[~joined]] = firsts[~joined]
+
+        # only the last part of a flow can still be going, every part before it has finished
+        finished.append(self.rows[rows[~last[first] | ~live[first]]])
+        finished.append(parts[~first & ~last])
+        tails = last & ~first
+        finished.append(parts[tails & ~live])
+        head_rows = rows[np.cumsum(first) - 1]
+        self.rows[head_rows[tails & live]] = parts[tails & live]
+
+        # flows whose last part has finished are no longer in progress
+        done = np.zeros(self.count, dtype=bool)
+        done[rows[~live[last]]] = True
+        self._remove(done)
+        finished.append(self.sweep(other.tick))
+        return to_flows(np.concatenate(finished))
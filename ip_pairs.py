@@ -1,59 +1,351 @@
 """ip_pairs.py
    script to count the packets send to/from each source and destination IP pair
-   pairs and number of packets stored in dictionary which can be printed
+   pairs and number of packets and bytes stored in dictionary which can be printed
    as a table ordered by number of packets send from largest to smallest
-   output generated with tabulate
+
+   pairs are keyed by source and destination packed into one integer
+   and counted in batches with numpy, IPs are only converted to strings for printed rows
+   both directions of a pair can be merged into one conversation
+
+   with a memory limit the pairs are kept in a spill.SpillStore, spilled to sorted runs on disk
+   and merged at the end, printing the same table as counting in memory
+
+   in approximate mode the top talker pairs are counted in fixed memory with sketches,
+   every count is printed with the most it can be above the true count
+   output generated with tabulate, or streamed as CSV or JSON, by table_writer
 """
+import heapq
 import socket
-import dpkt
-from tabulate import tabulate
+import struct
+from array import array
+from typing import Optional
+import numpy as np
+from packet_view import ETH_TYPE_IP, PacketView
+from pcap_index import PacketIndex
+from pcap_pipeline import Analyser, run_pipeline
+from sketches import CountMin, HyperLogLog, SpaceSaving
+from spill import SpillStore, add_counts, sort_rows
+from table_writer import write_table
+
+# number of packets buffered by IpPairCounter.feed before they are counted together
+BATCH_SIZE = 65536
+
+# number of pairs counted by ApproxIpPairCounter
+TOP_PAIRS = 10000
+
+
+class IpPairCounter(Analyser):
+    """
+    analyser counting packets and bytes send To/From IPv4 source and destination pairs
+    finish returns a dictionary of packets and bytes send between each pair
+    """
+    name = 'pairs'
+
+    def __init__(self, memory_limit: Optional[int] = None, spill_dir: Optional[str] = None):
+        """
+        :param memory_limit: bytes the pairs may use before they are spilled to disk, None to keep them in memory
+        :param spill_dir: directory run files are made in, None for the system temporary directory
+        """
+        # (source << 32 | destination): [packets, bytes]
+        self.ip_pairs: dict[int, list[int]] = {}
+        if memory_limit is not None:
+            # half is left for merging both directions of the pairs into conversations
+            self.ip_pairs = SpillStore(memory_limit // 2, spill_dir, add_counts)
+        # packets waiting to be counted
+        self._pairs = array('Q')
+        self._lengths = array('d')
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        buffer the source and destination pair and size of a packet
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        # skips non IPv4 packets which causes an errors
+        if not packet.ipv4:
+            return
+
+        # create key from src and dst
+        self._pairs.append((packet.src << 32) | packet.dst)
+        self._lengths.append(len(packet))
+        if len(self._pairs) >= BATCH_SIZE:
+            self._flush()
+
+    def feed_index(self, index: PacketIndex) -> None:
+        """
+        count packets for each source and destination pair using the packet index columns
+        :param index: packet index of the pcap file
+        """
+        records = index.records
+        # only rows with an IPv4 layer have source and destination IPs
+        ipv4 = records[(records['ethertype'] == ETH_TYPE_IP) & (records['proto'] >= 0)]
+
+        # combine source and destination into one integer so pairs can be counted at once
+        pairs = (ipv4['src'].astype(np.uint64) << np.uint64(32)) | ipv4['dst']
+        self.feed_arrays(pairs, ipv4['length'])
+
+    def feed_arrays(self, pairs: np.ndarray, lengths: np.ndarray) -> None:
+        """
+        count a batch of packets against their source and destination pair
+        :param pairs: source << 32 | destination of each packet
+        :param lengths: size of each packet
+        """
+        if len(pairs) == 0:
+            return
+
+        unique_pairs, inverse, counts = np.unique(pairs, return_inverse=True, return_counts=True)
+        sizes = np.bincount(inverse, weights=lengths, minlength=len(unique_pairs))
+
+        for pair, packet_count, size in zip(unique_pairs.tolist(), counts.tolist(), sizes.tolist()):
+            self._add(pair, packet_count, int(size))
+
+    def _add(self, pair: int, packet_count: int, size: int) -> None:
+        """
+        add packets and bytes to a source and destination pair
+        :param pair: source << 32 | destination
+        :param packet_count: number of packets
+        :param size: number of bytes
+        """
+        totals = self.ip_pairs.get(pair)
+        if totals is None:
+            self.ip_pairs[pair] = [packet_count, size]
+        else:
+            totals[0] += packet_count
+            totals[1] += size
+
+    def _flush(self) -> None:
+        """
+        count the packets buffered by feed
+        """
+        if not self._pairs:
+            return
+        self.feed_arrays(np.frombuffer(self._pairs, dtype=np.uint64), np.frombuffer(self._lengths))
+        self._pairs = array('Q')
+        self._lengths = array('d')
+
+    def merge(self, other: 'IpPairCounter') -> None:
+        """
+        add the packets counted by another counter to this counter
+        :param other: counter fed the following packets
+        """
+        other._flush()
+        for (pair, (packet_count, size)) in other.ip_pairs.items():
+            self._add(pair, packet_count, size)
+
+    def finish(self) -> dict[int, list[int]]:
+        """
+        :return: dictionary of packets and bytes send between each source and destination pair,
+                 keyed by source << 32 | destination, or a SpillStore with the same items
+        """
+        self._flush()
+        return self.ip_pairs
+
+
+class ApproxIpPairCounter(IpPairCounter):
+    """
+    analyser estimating the packets and bytes of the top talker source and destination pairs in fixed memory
+    packets of the heaviest pairs are counted with Space-Saving, bytes of each pair with Count-Min
+    and distinct source and destination IPs with HyperLogLog
+    """
+
+    def __init__(self, capacity: int = TOP_PAIRS):
+        """
+        :param capacity: number of pairs counted, every pair with more than 1 / capacity of the packets is counted
+        """
+        super().__init__()
+        self.capacity = capacity
+        self.packets = SpaceSaving(capacity)
+        self.bytes = CountMin()
+        self.sources = HyperLogLog()
+        self.destinations = HyperLogLog()
+
+    def feed_arrays(self, pairs: np.ndarray, lengths: np.ndarray) -> None:
+        """
+        add a batch of packets to the sketches
+        :param pairs: source << 32 | destination of each packet
+        :param lengths: size of each packet
+        """
+        if len(pairs) == 0:
+            return
 
+        pairs = pairs.astype(np.uint64)
+        self.packets.update(pairs, np.ones(len(pairs)))
+        self.bytes.update(pairs, lengths)
+        self.sources.update(pairs >> np.uint64(32))
+        self.destinations.update(pairs & np.uint64(0xffffffff))
 
-def find_ip_pairs(packet_list: list[tuple]) -> dict[str, int]:
+    def options(self) -> tuple:
+        """
+        :return: number of pairs counted
+        """
+        return (self.capacity,)
+
+    def merge(self, other: 'ApproxIpPairCounter') -> None:
+        """
+        add the sketches of another counter to this counters sketches
+        :param other: counter fed the following packets
+        """
+        other._flush()
+        self.packets.merge(other.packets)
+        self.bytes.merge(other.bytes)
+        self.sources.merge(other.sources)
+        self.destinations.merge(other.destinations)
+
+    def finish(self) -> list[tuple[int, int, int, int]]:
+        """
+        :return: list of (source << 32 | destination, packets, most packets are above the true count,
+                 estimated bytes) tuples for each pair counted, most packets first
+        """
+        self._flush()
+        top = self.packets.top()
+        sizes = self.bytes.query(np.array([pair for pair, unused_count, unused_error in top], dtype=np.uint64))
+        return [(pair, packet_count, error, size)
+                for (pair, packet_count, error), size in zip(top, sizes.tolist())]
+
+
+def find_ip_pairs(packet_list: list[tuple]) -> dict[int, list[int]]:
     """
     Find all IPv4 source and destination pairs and count packets send To/From the pairs
-    store number of packets send between pairs in a dictionary
+    store number of packets and bytes send between pairs in a dictionary
     :param packet_list: list of (packet_timestamp, packet_bytes) tuples
-    :return:
+    :return: dictionary of [packets, bytes] keyed by source << 32 | destination
     """
-    ip_pairs = {}
+    ip_pair_counter = IpPairCounter()
+    run_pipeline(packet_list, [ip_pair_counter])
+    return ip_pair_counter.finish()
 
-    for unused_timestamp, eth in packet_list:
-        # skips non IPv4 packets which causes an errors
-        if not isinstance(eth.data, dpkt.ip.IP):
-            continue
-        ip = eth.data
 
-        # convert source and destination IP to human-readable strings
-        src = socket.inet_ntoa(ip.src)
-        dst = socket.inet_ntoa(ip.dst)
+def conversations(ip_pairs: dict[int, list[int]]) -> dict[int, list[int]]:
+    """
+    merge both directions between two IPs into one conversation
+    :param ip_pairs: dictionary from IpPairCounter.finish
+    :return: dictionary of [packets A -> B, bytes A -> B, packets B -> A, bytes B -> A]
+             keyed by A << 32 | B where A is the lower IP, a SpillStore for pairs in a SpillStore
+    """
+    merged = ip_pairs.empty_like() if isinstance(ip_pairs, SpillStore) else {}
+    for (pair, (packet_count, size)) in ip_pairs.items():
+        src, dst = pair >> 32, pair & 0xffffffff
+        # the lower IP is always A
+        key, offset = (pair, 0) if src <= dst else ((dst << 32) | src, 2)
+        totals = merged.setdefault(key, [0, 0, 0, 0])
+        totals[offset] += packet_count
+        totals[offset + 1] += size
+    return merged
 
-        # create key from src and dst
-        ip_pair_key = src + " -> " + dst
 
-        ip_pairs.setdefault(ip_pair_key, 0)
-        # increment packets from that key
-        ip_pairs[ip_pair_key] += 1
+def pair_ips(pair: int) -> tuple[str, str]:
+    """
+    :param pair: source << 32 | destination
+    :return: human-readable source and destination IPs
+    """
+    return (socket.inet_ntoa(struct.pack('>I', pair >> 32)),
+            socket.inet_ntoa(struct.pack('>I', pair & 0xffffffff)))
 
-    return ip_pairs
 
+def top_candidates(ip_pairs: dict[int, list[int]], count, top: int):
+    """
+    pairs with at least as many packets as the top'th pair, which can be among the top pairs
+    once pairs with the same packets are ordered by their IPs
+    :param ip_pairs: dictionary of totals keyed by pair, e.g. from IpPairCounter.finish or conversations
+    :param count: function giving the packets of a pair from its totals
+    :param top: number of pairs printed
+    :return: generator of (pair, totals) tuples in the order of ip_pairs
+    """
+    counts = heapq.nlargest(top, (count(totals) for unused_pair, totals in ip_pairs.items()))
+    lowest = counts[-1] if top and len(counts) == top else 0
+    return ((pair, totals) for pair, totals in ip_pairs.items() if count(totals) >= lowest)
 
-def print_ip_pairs_ordered(ip_pairs: dict[str, int]) -> None:
+
+def print_ip_pairs_ordered(ip_pairs: dict[int, list[int]], top: Optional[int] = None,
+                           output_format: str = 'pretty') -> None:
     """
     Prints the source and destination IP pair and the number of packets sent
     to/from that pair, ordered by number of packets sent largest to smallest
-    :param ip_pairs:
+    :param ip_pairs: dictionary from IpPairCounter.finish
+    :param top: only print this many pairs with the most packets, None for every pair
+    :param output_format: format of the table, one of table_writer.FORMATS
     """
     headers = ['Source -> Destination IP',
                'Packets']
-    rows = []
 
-    # creates a list of tuples containing a key and number of packets from ip_pairs
-    key_num = [(key, ip_pairs[key]) for key in ip_pairs]
-    # sort the list by number of packets then key from largest to smallest
-    key_num = sorted(key_num, key=lambda kn: [kn[1], kn[0]], reverse=True)
+    items = ip_pairs.items()
+    # only the pairs that can be printed are kept, without sorting every pair
+    if top is not None:
+        items = top_candidates(ip_pairs, lambda totals: totals[0], top)
+
+    # covert to human readable key only for pairs that can be printed
+    rows = ([' -> '.join(pair_ips(pair)), packet_count] for (pair, (packet_count, unused_size)) in items)
+    # sort the list by number of packets then key from largest to smallest,
+    # the top pairs are chosen by the same order so they are the first rows of the full table
+    if top is not None:
+        rows = heapq.nlargest(top, rows, key=lambda row: (row[1], row[0]))
+    else:
+        rows = sort_rows(rows, ip_pairs, key=lambda row: (row[1], row[0]), reverse=True)
 
-    for key, num_of_packets in key_num:
-        rows.append([key, num_of_packets])
+    write_table('ip_pairs', headers, rows, output_format)
 
-    print(tabulate(rows, headers, tablefmt='pretty'))
+
+def print_conversations_ordered(ip_pairs: dict[int, list[int]], top: Optional[int] = None,
+                                output_format: str = 'pretty') -> None:
+    """
+    Prints the packets and bytes sent each way between two IPs,
+    ordered by number of packets sent in both directions largest to smallest
+    :param ip_pairs: dictionary from IpPairCounter.finish
+    :param top: only print this many conversations with the most packets, None for every conversation
+    :param output_format: format of the table, one of table_writer.FORMATS
+    """
+    headers = ['IP A <-> IP B',
+               'Packets',
+               'Packets A -> B',
+               'Bytes A -> B',
+               'Packets B -> A',
+               'Bytes B -> A']
+
+    merged = conversations(ip_pairs)
+    items = merged.items()
+    # only the conversations that can be printed are kept, without sorting every conversation
+    if top is not None:
+        items = top_candidates(merged, lambda totals: totals[0] + totals[2], top)
+
+    rows = ([' <-> '.join(pair_ips(pair)), totals[0] + totals[2]] + totals for (pair, totals) in items)
+    if top is not None:
+        rows = heapq.nlargest(top, rows, key=lambda row: (row[1], row[0]))
+    else:
+        rows = sort_rows(rows, merged, key=lambda row: (row[1], row[0]), reverse=True)
+
+    write_table('conversations', headers, rows, output_format)
+
+
+def print_approx_ip_pairs(ip_pair_counter: ApproxIpPairCounter, ip_pairs: list[tuple[int, int, int, int]],
+                          top: Optional[int] = None, output_format: str = 'pretty') -> None:
+    """
+    Prints the estimated packets and bytes of the pairs with the most packets,
+    each with the most it can be above the true count,
+    followed by the estimated number of distinct source and destination IPs
+    :param ip_pair_counter: counter fed every packet
+    :param ip_pairs: pairs counted, from ip_pair_counter.finish()
+    :param top: only print this many pairs with the most packets, None for every pair counted
+    :param output_format: format of the tables, one of table_writer.FORMATS
+    """
+    headers = ['Source -> Destination IP',
+               'Packets',
+               'Packets Error',
+               'Bytes',
+               'Bytes Error']
+
+    if top is not None:
+        ip_pairs = ip_pairs[:top]
+    # one bound covers the bytes of every pair
+    bytes_error = ip_pair_counter.bytes.error_bound()
+    rows = ([' -> '.join(pair_ips(pair)), packet_count, error, size, bytes_error]
+            for (pair, packet_count, error, size) in ip_pairs)
+    write_table('ip_pairs', headers, rows, output_format)
+
+    headers = ['Distinct IPs',
+               'Estimate',
+               'Error (95%)']
+    rows = []
+    for name, sketch in (('Source', ip_pair_counter.sources), ('Destination', ip_pair_counter.destinations)):
+        estimate = sketch.count()
+        rows.append([name, estimate, round(estimate * sketch.relative_error())])
+    write_table('distinct_ips', headers, rows, output_format)
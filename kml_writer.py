@@ -0,0 +1,92 @@
+"""kml_writer.py
+   script to write a KML file one placemark at a time
+   each placemark is written to disk as soon as it is added, so memory use does not grow
+   with the number of points, a file name ending in .kmz is written as a zipped KML file
+   the file is only created when the first point is added
+
+   the layout and ids match simplekml, a file written here is the same as one saved by simplekml
+"""
+import zipfile
+from typing import Optional
+from xml.sax.saxutils import escape
+
+# written before the first placemark
+KML_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+              '    <Document id="1">\n')
+
+# written after the last placemark
+KML_FOOTER = ('    </Document>\n'
+              '</kml>\n')
+
+# characters replaced in names and descriptions, as well as &, < and >
+_ENTITIES = {'"': '&quot;'}
+
+
+class KmlWriter:
+    """
+    writes points to a KML or KMZ file as they are added
+    used as a context manager, the file is complete once the with block ends
+    """
+
+    def __init__(self, file_name: str):
+        """
+        :param file_name: name of KML file, written as KMZ when it ends in .kmz
+        """
+        self.file_name = file_name
+        self.points = 0
+        # ids are shared by placemarks and points, the document is id 1
+        self._next_id = 2
+        self._archive: Optional[zipfile.ZipFile] = None
+        self._file = None
+
+    def __enter__(self) -> 'KmlWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def add_point(self, name: str, long: float, lat: float, description: str) -> None:
+        """
+        write one placemark with a point
+        :param name: name of placemark
+        :param long: longitude of point
+        :param lat: latitude of point
+        :param description: description of placemark, can be several lines
+        """
+        if self._file is None:
+            self._open()
+        point_id = self._next_id
+        self._next_id += 2
+        self.points += 1
+        self._file.write(f'        <Placemark id="{point_id + 1}">\n'
+                         f'            <name>{escape(name, _ENTITIES)}</name>\n'
+                         f'            <description>{escape(description, _ENTITIES)}</description>\n'
+                         f'            <Point id="{point_id}">\n'
+                         f'                <coordinates>{long},{lat},0.0</coordinates>\n'
+                         f'            </Point>\n'
+                         f'        </Placemark>\n'.encode())
+
+    def _open(self) -> None:
+        """
+        create the file and write the start of the document
+        """
+        if self.file_name.lower().endswith('.kmz'):
+            self._archive = zipfile.ZipFile(self.file_name, 'w', zipfile.ZIP_DEFLATED)
+            self._file = self._archive.open('doc.kml', 'w')
+        else:
+            self._file = open(self.file_name, 'wb')
+        self._file.write(KML_HEADER.encode())
+
+    def close(self) -> None:
+        """
+        end the document and close the file, if any points were added
+        """
+        if self._file is None:
+            return
+        self._file.write(KML_FOOTER.encode())
+        self._file.close()
+        self._file = None
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
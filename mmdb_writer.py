@@ -0,0 +1,184 @@
+"""mmdb_writer.py
+   script to write a tiny IPv4 MaxMind DB (.mmdb) file with a few City records
+   so geolocation can be run and benchmarked without the real GeoLite2 database
+
+   records are stored for whole networks, networks must not overlap
+   only the data types needed for City records are written
+"""
+import argparse
+import socket
+import struct
+
+# network: (city, country, latitude, longitude)
+TEST_LOCATIONS = {'8.8.0.0/16': ('Mountain View', 'United States', 37.4, -122.07),
+                  '1.1.1.0/24': (None, 'Australia', -33.49, 143.21),
+                  '81.2.69.0/24': ('London', 'United Kingdom', 51.5, -0.09),
+                  '2.125.160.0/20': ('Boxford', 'United Kingdom', 51.75, -1.25),
+                  '89.160.0.0/16': ('Linköping', 'Sweden', 58.4, 15.6),
+                  '175.16.199.0/24': ('Changchun', 'China', 43.88, 125.32),
+                  '216.160.83.0/24': ('Milton', 'United States', 47.25, -122.31)}
+
+# build time of the written database, matching GeoLite2-City_20190129
+BUILD_EPOCH = 1548720000
+
+# marks where the metadata starts at the end of the file
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+
+# data types, types above 7 are extended types
+TYPE_STRING = 2
+TYPE_DOUBLE = 3
+TYPE_UINT16 = 5
+TYPE_UINT32 = 6
+TYPE_MAP = 7
+TYPE_UINT64 = 9
+TYPE_ARRAY = 11
+
+
+class Unsigned:
+    """
+    unsigned integer written as a particular data type, the reader checks metadata types
+    """
+
+    def __init__(self, data_type: int, value: int):
+        """
+        :param data_type: TYPE_UINT16, TYPE_UINT32 or TYPE_UINT64
+        :param value: integer value
+        """
+        self.data_type = data_type
+        self.value = value
+
+
+def control_bytes(data_type: int, size: int) -> bytes:
+    """
+    encode the control byte(s) starting each field
+    :param data_type: type of the field
+    :param size: size of the field in bytes, or entries for maps and arrays
+    :return: control bytes of the field
+    """
+    first = data_type << 5 if data_type <= 7 else 0
+    extended = b'' if data_type <= 7 else bytes([data_type - 7])
+    if size < 29:
+        return bytes([first | size]) + extended
+    if size < 285:
+        return bytes([first | 29]) + extended + bytes([size - 29])
+    if size < 65821:
+        return bytes([first | 30]) + extended + struct.pack('>H', size - 285)
+    return bytes([first | 31]) + extended + struct.pack('>I', size - 65821)[1:]
+
+
+def encode(value) -> bytes:
+    """
+    encode a value in the MaxMind DB data section format
+    :param value: str, float, Unsigned, dict or list
+    :return: encoded field
+    """
+    if isinstance(value, Unsigned):
+        data = value.value.to_bytes((value.value.bit_length() + 7) // 8, 'big')
+        return control_bytes(value.data_type, len(data)) + data
+    if isinstance(value, str):
+        data = value.encode()
+        return control_bytes(TYPE_STRING, len(data)) + data
+    if isinstance(value, float):
+        return control_bytes(TYPE_DOUBLE, 8) + struct.pack('>d', value)
+    if isinstance(value, dict):
+        return control_bytes(TYPE_MAP, len(value)) + b''.join(encode(key) + encode(entry)
+                                                               for key, entry in value.items())
+    if isinstance(value, list):
+        return control_bytes(TYPE_ARRAY, len(value)) + b''.join(encode(entry) for entry in value)
+    raise TypeError(f'cannot encode {type(value).__name__}')
+
+
+def city_record(city, country: str, latitude: float, longitude: float) -> dict:
+    """
+    :param city: name of city, None if unknown
+    :param country: name of country
+    :param latitude: latitude of location
+    :param longitude: longitude of location
+    :return: record in the layout of a GeoIP2 City database
+    """
+    record = {'country': {'iso_code': country[:2].upper(), 'names': {'en': country}},
+              'location': {'latitude': float(latitude), 'longitude': float(longitude)}}
+    if city is not None:
+        record['city'] = {'names': {'en': city}}
+    return record
+
+
+def write_mmdb(file_name: str, records: dict[str, dict], build_epoch: int = BUILD_EPOCH) -> None:
+    """
+    write an IPv4 MaxMind DB file with 24 bit records
+    :param file_name: path of the database file
+    :param records: record for each network, e.g. {'8.8.0.0/16': city_record(...)}
+    :param build_epoch: build time stored in the metadata
+    """
+    data = b''
+    # binary search tree over the address bits, each node is [left, right]
+    # children are ('node', number) or ('data', offset) or None
+    tree = [[None, None]]
+    for network, record in records.items():
+        address, prefix = (network.split('/') + ['32'])[:2]
+        prefix = int(prefix)
+        bits = int.from_bytes(socket.inet_aton(address), 'big')
+        offset = len(data)
+        data += encode(record)
+
+        node = 0
+        for position in range(31, 32 - prefix, -1):
+            bit = (bits >> position) & 1
+            if tree[node][bit] is None:
+                tree.append([None, None])
+                tree[node][bit] = ('node', len(tree) - 1)
+            node = tree[node][bit][1]
+        tree[node][(bits >> (32 - prefix)) & 1] = ('data', offset)
+
+    node_count = len(tree)
+    search_tree = b''
+    for node in tree:
+        for child in node:
+            # node_count means no record, data pointers skip the 16 byte separator
+            if child is None:
+                value = node_count
+            elif child[0] == 'node':
+                value = child[1]
+            else:
+                value = node_count + 16 + child[1]
+            search_tree += value.to_bytes(3, 'big')
+
+    metadata = {'node_count': Unsigned(TYPE_UINT32, node_count),
+                'record_size': Unsigned(TYPE_UINT16, 24),
+                'ip_version': Unsigned(TYPE_UINT16, 4),
+                'database_type': 'GeoLite2-City',
+                'languages': ['en'],
+                'binary_format_major_version': Unsigned(TYPE_UINT16, 2),
+                'binary_format_minor_version': Unsigned(TYPE_UINT16, 0),
+                'build_epoch': Unsigned(TYPE_UINT64, build_epoch),
+                'description': {'en': 'test database'}}
+
+    with open(file_name, 'wb') as open_file:
+        open_file.write(search_tree + b'\0' * 16 + data + METADATA_MARKER + encode(metadata))
+
+
+def write_test_mmdb(file_name: str) -> None:
+    """
+    write a database with the TEST_LOCATIONS networks
+    :param file_name: path of the database file
+    """
+    write_mmdb(file_name, {network: city_record(*location) for network, location in TEST_LOCATIONS.items()})
+
+
+def main() -> None:
+    """
+    process command line arguments and write the test database
+    """
+    parser = argparse.ArgumentParser(description='Write a tiny IP location database for testing')
+    parser.add_argument('-o', '--output',
+                        metavar='',
+                        default='test-city.mmdb',
+                        help='path of the database file (default test-city.mmdb)')
+    args = parser.parse_args()
+
+    write_test_mmdb(args.output)
+    print(f'Database Saved as {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,74 +5,491 @@
    using geoip2.database to get geolocation from IP
    create a KML file with a point for each IP
    point description contains city, country and packet send to that IP
+
+   points are streamed to the KML (or KMZ) file as each IP is looked up,
+   IPs at the same coordinates or in the same city can be clustered into one point
+   with their packets summed and a list of the IPs, so the file grows with locations not IPs
+
+   destinations are counted as integers and each unique address is looked up once,
+   lookups are remembered in a bounded LRU memo and optionally a persistent cache file
+
+   geoip2 is only imported when the addresses are looked up
+   a process analysing many captures can keep one open database and memo for all of them
+
+   in approximate mode only the destinations with the most packets are counted, in fixed memory,
+   and the number of distinct destinations is estimated
 """
 import socket
-import dpkt
-import simplekml
-import geoip2.database
-from geoip2.errors import AddressNotFoundError
+import sqlite3
+import struct
+from collections import OrderedDict
+from collections.abc import Iterator
+from typing import TYPE_CHECKING, Optional
+import numpy as np
+from kml_writer import KmlWriter
+from packet_view import ETH_TYPE_IP, PacketView
+from pcap_index import PacketIndex
+from pcap_pipeline import Analyser, run_pipeline
+from pcap_profile import counters
+from sketches import HyperLogLog, SpaceSaving
+
+if TYPE_CHECKING:
+    import geoip2.database
+
+# IP location database used when none is given
+DEFAULT_DATABASE = 'GeoLite2-City_20190129.mmdb'
+
+# most lookups remembered in memory by GeoLookup
+LOOKUP_CACHE_SIZE = 65536
+
+# ways IPs can be clustered into one point
+CLUSTER_MODES = ('location', 'city')
+
+# most IPs listed in the description of a clustered point
+CLUSTER_IP_LIST = 100
+
+# number of destinations buffered by ApproxGeoLocator.feed before they are counted together
+BATCH_SIZE = 65536
+
+# number of destinations counted by ApproxGeoLocator
+TOP_DESTINATIONS = 10000
 
+# marks an address missing from the memo, None is a remembered failed lookup
+_NOT_CACHED = object()
 
-def packet_geolocation(packet_list: list[tuple], file_name: str) -> str:
+
+class GeoLookup:
     """
-    find geolocation information of valid IPv4 addresses
-    create a KML file with information found about each address
-    :param packet_list: list of (packet_timestamp, packet_bytes) tuples
-    :param file_name: name of KML file
-    :return: string indicating success or failure finding any IP geolocations
+    city lookups for IPv4 addresses stored as integers
+    results, including addresses not in the database, are kept in a bounded LRU memo
+    and optionally in a persistent SQLite cache keyed by the database build
     """
-    ips = {}
-    try:
-        with geoip2.database.Reader(r"GeoLite2-City_20190129.mmdb") as reader:
-            kml = simplekml.Kml()
-            for unused_timestamp, eth in packet_list:
-                # skip non-IPv4 packets
-                if not isinstance(eth.data, dpkt.ip.IP):
-                    continue
 
-                # get packets destination IP
-                dst_ip = eth.data.dst
-                # covert to human readable IP
-                dst_ip = socket.inet_ntoa(dst_ip)
+    def __init__(self, reader: 'geoip2.database.Reader', cache_file: Optional[str] = None,
+                 cache_size: int = LOOKUP_CACHE_SIZE):
+        """
+        :param reader: open IP location database
+        :param cache_file: path of persistent cache file, None to only cache in memory
+        :param cache_size: most lookups remembered in memory
+        """
+        self.reader = reader
+        self.cache_size = cache_size
+        self.memo: OrderedDict = OrderedDict()
+        # number of lookups that reached the database
+        self.lookups = 0
+
+        # results are only valid for the database build they came from
+        metadata = reader.metadata()
+        self.build = f'{metadata.database_type}:{metadata.build_epoch}'
+        self.cache = None
+        if cache_file is not None:
+            self.cache = sqlite3.connect(cache_file)
+            self.cache.execute('CREATE TABLE IF NOT EXISTS locations ('
+                               'build TEXT, ip INTEGER, found INTEGER, '
+                               'longitude REAL, latitude REAL, city TEXT, country TEXT, '
+                               'PRIMARY KEY (build, ip))')
+
+    def city(self, ip_address: int) -> Optional[tuple]:
+        """
+        find the location of an IPv4 address
+        :param ip_address: IPv4 address as an integer
+        :return: (longitude, latitude, city, country) tuple, None if the address is not in the database
+        """
+        location = self.memo.get(ip_address, _NOT_CACHED)
+        if location is not _NOT_CACHED:
+            self.memo.move_to_end(ip_address)
+            return location
+
+        location = self._cached(ip_address)
+        if location is _NOT_CACHED:
+            location = self._lookup(ip_address)
+
+        self.memo[ip_address] = location
+        # forget the least recently used address when the memo is full
+        if len(self.memo) > self.cache_size:
+            self.memo.popitem(last=False)
+        return location
+
+    def _cached(self, ip_address: int):
+        """
+        read a lookup from the persistent cache
+        :param ip_address: IPv4 address as an integer
+        :return: location, None if not in the database, or _NOT_CACHED if never looked up
+        """
+        if self.cache is None:
+            return _NOT_CACHED
+        row = self.cache.execute('SELECT found, longitude, latitude, city, country FROM locations '
+                                 'WHERE build = ? AND ip = ?', (self.build, ip_address)).fetchone()
+        if row is None:
+            return _NOT_CACHED
+        return tuple(row[1:]) if row[0] else None
+
+    def _lookup(self, ip_address: int) -> Optional[tuple]:
+        """
+        look up an address in the database and save the result to the persistent cache
+        :param ip_address: IPv4 address as an integer
+        :return: (longitude, latitude, city, country) tuple, None if the address is not in the database
+        """
+        from geoip2.errors import AddressNotFoundError
+
+        self.lookups += 1
+        counters['geoip_lookups'] += 1
+        try:
+            geo_info = self.reader.city(socket.inet_ntoa(struct.pack('>I', ip_address)))
+            location = (geo_info.location.longitude, geo_info.location.latitude,
+                        geo_info.city.name, geo_info.country.name)
+        # invalid IPs (e.g. private IPs) are not in the database
+        except AddressNotFoundError:
+            location = None
+
+        if self.cache is not None:
+            row = location if location is not None else (None, None, None, None)
+            self.cache.execute('INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (self.build, ip_address, location is not None) + row)
+        return location
+
+    def commit(self) -> None:
+        """
+        save the lookups added to the persistent cache
+        """
+        if self.cache is not None:
+            self.cache.commit()
+
+    def close(self) -> None:
+        """
+        save and close the persistent cache
+        """
+        if self.cache is not None:
+            self.cache.commit()
+            self.cache.close()
+            self.cache = None
+
+
+# lookups kept open by shared_lookup for the life of the process
+_shared_lookups: dict[tuple, GeoLookup] = {}
+
+
+def shared_lookup(database: str, cache_file: Optional[str] = None) -> GeoLookup:
+    """
+    open an IP location database once for each process, later calls return the same lookup
+    so a worker analysing many captures opens the database once and keeps its memo
+    :param database: path of IP location database
+    :param cache_file: path of persistent lookup cache file, None to not keep lookups between runs
+    :return: city lookups for the database
+    """
+    import geoip2.database
+
+    lookup = _shared_lookups.get((database, cache_file))
+    if lookup is None:
+        lookup = _shared_lookups[database, cache_file] = GeoLookup(geoip2.database.Reader(database), cache_file)
+    return lookup
+
+
+class GeoLocator(Analyser):
+    """
+    analyser counting packets send to each destination IPv4 address
+    finish finds the geolocation of valid addresses and creates a KML file
+    """
+    name = 'geolocation'
+
+    def __init__(self, file_name: str, database: str = DEFAULT_DATABASE,
+                 cache_file: Optional[str] = None, cluster: Optional[str] = None,
+                 keep_lookup: bool = False):
+        """
+        :param file_name: name of KML file, a KMZ file when it ends in .kmz
+        :param database: path of IP location database
+        :param cache_file: path of persistent lookup cache file, None to not keep lookups between runs
+        :param cluster: 'location' or 'city' to make one point for the IPs at the same coordinates
+                        or in the same city, None for a point for each IP
+        :param keep_lookup: look addresses up with the database kept open by shared_lookup
+        """
+        self.file_name = file_name
+        self.database = database
+        self.cache_file = cache_file
+        self.cluster = cluster
+        self.keep_lookup = keep_lookup
+        # number of packets send to each destination ip, stored as an integer
+        self.ips: dict[int, int] = {}
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        count a packet against its destination IP
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        # skip non-IPv4 packets
+        if not packet.ipv4:
+            return
+
+        # count number of packets for each destination ip
+        dst_ip = packet.dst
+        self.ips[dst_ip] = self.ips.get(dst_ip, 0) + 1
+
+    def feed_index(self, index: PacketIndex) -> None:
+        """
+        count packets send to each destination IP using the packet index columns
+        :param index: packet index of the pcap file
+        """
+        records = index.records
+        # skip non-IPv4 packets
+        dst_ips = records['dst'][(records['ethertype'] == ETH_TYPE_IP) & (records['proto'] >= 0)]
 
-                # skip packets with invalid destination IPs (e.g. private IPs)
+        unique_ips, first_seen, counts = np.unique(dst_ips, return_index=True, return_counts=True)
+        # keep destinations in the order they were first seen in the capture
+        order = np.argsort(first_seen, kind='stable')
+
+        for dst_ip, packet_count in zip(unique_ips[order].tolist(), counts[order].tolist()):
+            self.ips[dst_ip] = self.ips.get(dst_ip, 0) + packet_count
+
+    def merge(self, other: 'GeoLocator') -> None:
+        """
+        add the packets counted by another geolocator to this geolocator
+        :param other: geolocator fed the following packets
+        """
+        for (dst_ip, packet_count) in other.ips.items():
+            self.ips[dst_ip] = self.ips.get(dst_ip, 0) + packet_count
+
+    def finish(self) -> str:
+        """
+        find geolocation information of valid IPv4 addresses
+        create a KML file with information found about each address
+        :return: string indicating success or failure finding any IP geolocations
+        """
+        import geoip2.database
+
+        try:
+            if self.keep_lookup:
+                lookup = shared_lookup(self.database, self.cache_file)
+                try:
+                    return self.build_kml(lookup)
+                finally:
+                    lookup.commit()
+            with geoip2.database.Reader(self.database) as reader:
+                lookup = GeoLookup(reader, self.cache_file)
                 try:
-                    reader.city(dst_ip)
-                except AddressNotFoundError:
+                    return self.build_kml(lookup)
+                finally:
+                    lookup.close()
+        # when IP location database file not present
+        except FileNotFoundError as err:
+            return f'{err.__class__.__name__} IP location database "{self.database}"'
+
+    def destinations(self) -> Iterator[tuple[int, int, int]]:
+        """
+        :return: iterator of (destination IP, packets, most packets are above the true count) tuples,
+                 in the order first seen
+        """
+        for (dst_ip, packet_count) in self.ips.items():
+            yield dst_ip, packet_count, 0
+
+    def build_kml(self, lookup: GeoLookup) -> str:
+        """
+        create a KML file with a point for each destination found in the database
+        :param lookup: city lookups for the destinations
+        :return: string indicating success or failure finding any IP geolocations
+        """
+        if self.cluster is not None:
+            return self.build_clustered_kml(lookup)
+
+        with KmlWriter(self.file_name) as kml:
+            for (dst_ip, packet_count, error) in self.destinations():
+                location = lookup.city(dst_ip)
+                # skip invalid destination IPs (e.g. private IPs)
+                if location is None:
                     continue
 
-                # count number of packets for each destination ip
-                ips.setdefault(dst_ip, 0)
-                ips[dst_ip] += 1
+                # get longitude, latitude, city and country of IP
+                long, lat, city, country = location
+                # covert to human readable IP
+                ip_address = socket.inet_ntoa(struct.pack('>I', dst_ip))
+
+                # if city name couldn't be found use Unknown
+                if city is None:
+                    city = 'Unknown'
+
+                # add new point to kml file
+                kml.add_point(ip_address, long, lat,
+                              f"{ip_address}\n"
+                              f"City: {city}\n"
+                              f"Country: {country}\n"
+                              f"Packets: {packet_count}{error_text(error)}")
+
+        # if no geolocations are found
+        if kml.points == 0:
+            return "No valid IPs in pcap file"
+        return f'Output Geolocation info to {self.file_name}'
 
-                # if no geolocations are found
-                if len(ips) == 0:
-                    return "No valid IPs in pcap file"
+    def build_clustered_kml(self, lookup: GeoLookup) -> str:
+        """
+        create a KML file with a point for each location or city with destinations found in the database
+        a city is placed at the coordinates of its first destination
+        :param lookup: city lookups for the destinations
+        :return: string indicating success or failure finding any IP geolocations
+        """
+        # cluster key: [long, lat, city, country, packets, number of IPs, first IPs, packets error],
+        # in the order first seen
+        clusters: dict[tuple, list] = {}
+        for (dst_ip, packet_count, error) in self.destinations():
+            location = lookup.city(dst_ip)
+            # skip invalid destination IPs (e.g. private IPs)
+            if location is None:
+                continue
 
-            for (ip_address, packet_count) in ips.items():
-                geo_info = reader.city(ip_address)
+            long, lat, city, country = location
+            key = (long, lat) if self.cluster == 'location' else (city, country)
+            cluster = clusters.get(key)
+            if cluster is None:
+                cluster = clusters[key] = [long, lat, city, country, 0, 0, [], 0]
+            cluster[4] += packet_count
+            cluster[7] += error
+            cluster[5] += 1
+            # only the first IPs are listed so a point never grows with the number of IPs
+            if len(cluster[6]) < CLUSTER_IP_LIST:
+                cluster[6].append(socket.inet_ntoa(struct.pack('>I', dst_ip)))
 
-                # get longitude and latitude of IP
-                long = geo_info.location.longitude
-                lat = geo_info.location.latitude
+        # if no geolocations are found
+        if not clusters:
+            return "No valid IPs in pcap file"
 
+        with KmlWriter(self.file_name) as kml:
+            for long, lat, city, country, packet_count, ip_count, ip_addresses, error in clusters.values():
                 # if city name couldn't be found use Unknown
-                if geo_info.city.name is None:
+                if city is None:
                     city = 'Unknown'
-                else:
-                    city = geo_info.city.name
+                ip_list = ', '.join(ip_addresses)
+                if ip_count > len(ip_addresses):
+                    ip_list += f' and {ip_count - len(ip_addresses)} more'
 
-                country = geo_info.country.name
+                kml.add_point(f'{city} ({ip_count} IPs)' if ip_count > 1 else ip_addresses[0], long, lat,
+                              f"City: {city}\n"
+                              f"Country: {country}\n"
+                              f"Packets: {packet_count}{error_text(error)}\n"
+                              f"IPs: {ip_list}")
+        return f'Output Geolocation info to {self.file_name} ({len(clusters)} points)'
 
-                # add new point to kml file
-                kml.newpoint(name=ip_address,
-                             coords=[(long, lat)],
-                             description=f"{ip_address}\n"
-                                         f"City: {city}\n"
-                                         f"Country: {country}\n"
-                                         f"Packets: {packet_count}")
-            kml.save(file_name)
-            return f'Output Geolocation info to {file_name}'
-    # when IP location database file not present
-    except FileNotFoundError as err:
-        return f'{err.__class__.__name__} IP location database "GeoLite2-City_20190129.mmdb"'
+
+class ApproxGeoLocator(GeoLocator):
+    """
+    analyser counting packets send to the destination IPv4 addresses with the most packets in fixed memory
+    with Space-Saving and estimating the number of distinct destinations with HyperLogLog
+    finish creates a KML file with the counted destinations, most packets first
+    """
+
+    def __init__(self, file_name: str, database: str = DEFAULT_DATABASE,
+                 cache_file: Optional[str] = None, cluster: Optional[str] = None,
+                 keep_lookup: bool = False, capacity: int = TOP_DESTINATIONS):
+        """
+        :param file_name: name of KML file, a KMZ file when it ends in .kmz
+        :param database: path of IP location database
+        :param cache_file: path of persistent lookup cache file, None to not keep lookups between runs
+        :param cluster: 'location' or 'city' to make one point for the IPs at the same coordinates
+                        or in the same city, None for a point for each IP
+        :param keep_lookup: look addresses up with the database kept open by shared_lookup
+        :param capacity: number of destinations counted
+        """
+        super().__init__(file_name, database, cache_file, cluster, keep_lookup)
+        self.capacity = capacity
+        self.counter = SpaceSaving(capacity)
+        self.distinct = HyperLogLog()
+        # destination ips of packets not yet counted
+        self._dst_ips: list[int] = []
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        buffer the destination IP of a packet, counted once BATCH_SIZE are buffered
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        # skip non-IPv4 packets
+        if not packet.ipv4:
+            return
+
+        self._dst_ips.append(packet.dst)
+        if len(self._dst_ips) >= BATCH_SIZE:
+            self._flush()
+
+    def feed_index(self, index: PacketIndex) -> None:
+        """
+        count packets send to each destination IP using the packet index columns
+        :param index: packet index of the pcap file
+        """
+        records = index.records
+        # skip non-IPv4 packets
+        self.feed_arrays(records['dst'][(records['ethertype'] == ETH_TYPE_IP) & (records['proto'] >= 0)])
+
+    def feed_arrays(self, dst_ips: np.ndarray) -> None:
+        """
+        add a batch of packets to the sketches
+        :param dst_ips: destination IP of each packet
+        """
+        if len(dst_ips) == 0:
+            return
+
+        dst_ips = dst_ips.astype(np.uint64)
+        self.counter.update(dst_ips, np.ones(len(dst_ips)))
+        self.distinct.update(dst_ips)
+
+    def _flush(self) -> None:
+        """
+        count the buffered destination IPs
+        """
+        if self._dst_ips:
+            self.feed_arrays(np.array(self._dst_ips, dtype=np.uint64))
+            self._dst_ips = []
+
+    def options(self) -> tuple:
+        """
+        :return: number of destinations counted
+        """
+        return (self.capacity,)
+
+    def merge(self, other: 'ApproxGeoLocator') -> None:
+        """
+        add the sketches of another geolocator to this geolocators sketches
+        :param other: geolocator fed the following packets
+        """
+        self._flush()
+        other._flush()
+        self.counter.merge(other.counter)
+        self.distinct.merge(other.distinct)
+
+    def destinations(self) -> Iterator[tuple[int, int, int]]:
+        """
+        :return: iterator of (destination IP, packets, most packets are above the true count) tuples,
+                 most packets first
+        """
+        self._flush()
+        yield from self.counter.top()
+
+    def finish(self) -> str:
+        """
+        find geolocation information of the counted IPv4 addresses
+        create a KML file with information found about each address
+        :return: string indicating success or failure finding any IP geolocations
+        """
+        self._flush()
+        message = super().finish()
+        return f'{message}, top {len(self.counter.counters)} of ~{self.distinct.count()} destinations'
+
+
+def error_text(error: int) -> str:
+    """
+    :param error: most a packet count is above the true count
+    :return: error to follow a packet count in a description, empty for an exact count
+    """
+    return f' (at most {error} over)' if error else ''
+
+
+def packet_geolocation(packet_list: list[tuple], file_name: str,
+                       database: str = DEFAULT_DATABASE) -> str:
+    """
+    find geolocation information of valid IPv4 addresses
+    create a KML file with information found about each address
+    :param packet_list: list of (packet_timestamp, packet_bytes) tuples
+    :param file_name: name of KML file
+    :param database: path of IP location database
+    :return: string indicating success or failure finding any IP geolocations
+    """
+    geo_locator = GeoLocator(file_name, database)
+    run_pipeline(packet_list, [geo_locator])
+    return geo_locator.finish()
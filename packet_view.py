@@ -0,0 +1,271 @@
+"""packet_view.py
+   script to read the header fields of a packet at fixed offsets
+   from the raw bytes of an ethernet frame, without creating dpkt objects
+
+   a PacketView decodes the ethernet, VLAN/MPLS, IPv4/IPv6 and TCP/UDP
+   header fields of one packet the first time any of them is used,
+   the full dpkt object is only built when an analyser asks for it
+"""
+import struct
+import dpkt
+from pcap_profile import counters
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+ETH_TYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+ETH_TYPE_MPLS = (0x8847, 0x8848)
+
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+
+# IPv6 extension headers skipped to find the payload protocol
+IP6_EXT_HEADERS = (0, 43, 44, 51, 60)
+
+_eth_type = struct.Struct('>H')
+_ports = struct.Struct('>HH')
+_ipv4 = struct.Struct('>BxHHHxB2xII')
+_ipv6_plen = struct.Struct('>HB')
+
+
+def transport_payload(buf, proto: int, start: int, end: int) -> int:
+    """
+    :param buf: buffer containing the packet
+    :param proto: IP protocol number, TCP or UDP
+    :param start: offset of the TCP/UDP header in buf
+    :param end: offset of the end of the IP payload in buf
+    :return: bytes of data after the TCP/UDP header, 0 if the header is cut short
+    """
+    if proto == IP_PROTO_UDP:
+        return max(end - start - 8, 0)
+    if start + 13 > end:
+        return 0
+    # TCP data offset, header length including options in 32 bit words,
+    # dpkt does not decode a header shorter than 20 bytes so it has no data
+    header_length = buf[start + 12] >> 4 << 2
+    if header_length < 20:
+        return 0
+    return max(end - start - header_length, 0)
+
+
+def decode_headers(buf, start: int, caplen: int) -> tuple:
+    """
+    read ethernet, VLAN/MPLS, IPv4/IPv6 and TCP/UDP header fields at fixed offsets
+    field values match what dpkt would decode from the same packet
+    :param buf: buffer containing the packet
+    :param start: offset of the packet in buf
+    :param caplen: number of bytes captured for the packet
+    :return: (length, ethertype, proto, src, dst, sport, dport, flags, payload_length) tuple,
+             flags are the TCP flags and payload_length the bytes of TCP/UDP data
+    """
+    end = start + caplen
+    # packet too short to have an ethernet header
+    if caplen < 14:
+        return caplen, 0, -1, 0, 0, 0, 0, 0, 0
+
+    ethertype = _eth_type.unpack_from(buf, start + 12)[0]
+    pos = start + 14
+
+    # skip up to two VLAN tags (double tagging aka QinQ)
+    if ethertype in ETH_TYPE_VLAN:
+        for unused_tag in range(2):
+            if pos + 4 > end:
+                return caplen, ethertype, -1, 0, 0, 0, 0, 0, 0
+            ethertype = _eth_type.unpack_from(buf, pos + 2)[0]
+            pos += 4
+            if ethertype != ETH_TYPE_VLAN[0]:
+                break
+    # skip MPLS labels and guess the next protocol like dpkt does
+    elif ethertype in ETH_TYPE_MPLS:
+        while pos + 4 <= end:
+            bottom_of_stack = buf[pos + 2] & 1
+            pos += 4
+            if bottom_of_stack:
+                break
+        if pos < end and buf[pos] == 0x45:
+            ethertype = ETH_TYPE_IP
+        elif pos < end and buf[pos] & 0xf0 == 0x60:
+            ethertype = ETH_TYPE_IP6
+        else:
+            return caplen, ethertype, -1, 0, 0, 0, 0, 0, 0
+
+    available = end - pos
+
+    if ethertype == ETH_TYPE_IP:
+        if available < 20:
+            return caplen, ethertype, -1, 0, 0, 0, 0, 0, 0
+        version_ihl, total_length, unused_id, flags_offset, proto, src, dst = _ipv4.unpack_from(buf, pos)
+        header_length = (version_ihl & 0xf) << 2
+        if header_length < 20:
+            return caplen, ethertype, -1, 0, 0, 0, 0, 0, 0
+        # dpkt trims ethernet padding using the IP total length
+        if total_length:
+            ip_length = min(max(total_length, header_length), available)
+        else:
+            ip_length = available
+        length = pos - start + ip_length
+        # ports are only present in the first fragment
+        sport = dport = flags = payload_length = 0
+        if proto in (IP_PROTO_TCP, IP_PROTO_UDP) and flags_offset & 0x1fff == 0 \
+                and ip_length >= header_length + 4:
+            sport, dport = _ports.unpack_from(buf, pos + header_length)
+            payload_length = transport_payload(buf, proto, pos + header_length, pos + ip_length)
+            if proto == IP_PROTO_TCP and ip_length >= header_length + 14:
+                flags = buf[pos + header_length + 13]
+        return length, ethertype, proto, src, dst, sport, dport, flags, payload_length
+
+    if ethertype == ETH_TYPE_IP6:
+        if available < 40:
+            return caplen, ethertype, -1, 0, 0, 0, 0, 0, 0
+        payload_length, proto = _ipv6_plen.unpack_from(buf, pos + 4)
+        if payload_length:
+            ip_length = 40 + min(payload_length, available - 40)
+        else:
+            ip_length = available
+        length = pos - start + ip_length
+        ip_end = pos + ip_length
+        pos += 40
+        first_fragment = True
+        # walk extension headers to find the payload protocol
+        while proto in IP6_EXT_HEADERS and pos + 8 <= ip_end:
+            next_proto = buf[pos]
+            if proto == 44:
+                first_fragment = _eth_type.unpack_from(buf, pos + 2)[0] >> 3 == 0
+                pos += 8
+            elif proto == 51:
+                pos += (buf[pos + 1] + 2) * 4
+            else:
+                pos += (buf[pos + 1] + 1) * 8
+            proto = next_proto
+        sport = dport = flags = payload_length = 0
+        if proto in (IP_PROTO_TCP, IP_PROTO_UDP) and first_fragment and pos + 4 <= ip_end:
+            sport, dport = _ports.unpack_from(buf, pos)
+            payload_length = transport_payload(buf, proto, pos, ip_end)
+            if proto == IP_PROTO_TCP and pos + 14 <= ip_end:
+                flags = buf[pos + 13]
+        return length, ethertype, proto, 0, 0, sport, dport, flags, payload_length
+
+    return caplen, ethertype, -1, 0, 0, 0, 0, 0, 0
+
+
+class PacketView:
+    """
+    lazy view of one packet
+    header fields are decoded once on first use, eth is the full dpkt decode
+    len() is the length of the frame as dpkt would decode it, without ethernet padding
+    """
+    __slots__ = ('buf', '_headers', '_eth')
+
+    def __init__(self, buf: bytes):
+        """
+        :param buf: bytes of the packet, starting with the ethernet header
+        """
+        self.buf = buf
+        self._headers = None
+        self._eth = None
+
+    @property
+    def headers(self) -> tuple:
+        """
+        :return: (length, ethertype, proto, src, dst, sport, dport, flags, payload_length) tuple
+                 from decode_headers
+        """
+        if self._headers is None:
+            self._headers = decode_headers(self.buf, 0, len(self.buf))
+        return self._headers
+
+    def read_headers(self) -> tuple:
+        """
+        decode the header fields now rather than on first use, e.g. so parsing is measured on its own
+        :return: header fields tuple, as headers
+        """
+        return self.headers
+
+    @property
+    def ethertype(self) -> int:
+        """
+        :return: ethernet type after any VLAN tags or MPLS labels
+        """
+        return self.headers[1]
+
+    @property
+    def proto(self) -> int:
+        """
+        :return: IP protocol number, -1 if the packet has no IPv4/IPv6 layer
+        """
+        return self.headers[2]
+
+    @property
+    def src(self) -> int:
+        """
+        :return: IPv4 source address as an integer, 0 if not IPv4
+        """
+        return self.headers[3]
+
+    @property
+    def dst(self) -> int:
+        """
+        :return: IPv4 destination address as an integer, 0 if not IPv4
+        """
+        return self.headers[4]
+
+    @property
+    def sport(self) -> int:
+        """
+        :return: TCP/UDP source port, 0 if the packet has no ports
+        """
+        return self.headers[5]
+
+    @property
+    def dport(self) -> int:
+        """
+        :return: TCP/UDP destination port, 0 if the packet has no ports
+        """
+        return self.headers[6]
+
+    @property
+    def flags(self) -> int:
+        """
+        :return: TCP flags, 0 if the packet has no TCP header
+        """
+        return self.headers[7]
+
+    @property
+    def payload_length(self) -> int:
+        """
+        :return: bytes of TCP/UDP data, 0 if the packet has no ports
+        """
+        return self.headers[8]
+
+    @property
+    def payload(self) -> bytes:
+        """
+        :return: TCP/UDP data sliced from the raw bytes, empty if the packet has no ports
+        """
+        headers = self.headers
+        return self.buf[headers[0] - headers[8]:headers[0]]
+
+    @property
+    def ipv4(self) -> bool:
+        """
+        :return: True if the packet has an IPv4 layer
+        """
+        headers = self.headers
+        return headers[1] == ETH_TYPE_IP and headers[2] >= 0
+
+    @property
+    def eth(self) -> dpkt.ethernet.Ethernet:
+        """
+        decode the whole packet with dpkt, only done the first time it is used
+        :return: ethernet layer of packet
+        """
+        if self._eth is None:
+            self._eth = dpkt.ethernet.Ethernet(self.buf)
+            counters['dpkt_decodes'] += 1
+            # dpkt leaves layers it cannot decode as bytes, the headers say there is a TCP/UDP layer
+            if self.proto in (IP_PROTO_TCP, IP_PROTO_UDP) and \
+                    not isinstance(getattr(self._eth.data, 'data', None), (dpkt.tcp.TCP, dpkt.udp.UDP)):
+                counters['dpkt_decode_failures'] += 1
+        return self._eth
+
+    def __len__(self) -> int:
+        return self.headers[0]
@@ -1,27 +1,102 @@
 """parse_pcap.py
-   script to parse a pcap file with dpkt
-   returns a list of (packet_timestamp, ethernet_layer) tuples
+   script to parse a pcap file
+   returns a list of (packet_timestamp, packet_view) tuples
+   or streams the tuples one packet at a time
+   packets are only decoded with dpkt when an analyser needs the full packet
+
+   a capture can be split into byte ranges that start and end on record boundaries
+   so each range can be parsed on its own
+
+   a compiled filter (pcap_filter) is tested on the raw bytes of each record,
+   packets it rejects are skipped before a packet view is made
 """
+import os
 import sys
-import dpkt
+import mmap
+import struct
+from collections.abc import Callable, Iterator
+from typing import Optional
+from packet_view import PacketView
 
+# size of the global header at the start of every pcap file
+FILE_HEADER_SIZE = 24
 
-def packet_list(pcap_file: str) -> list[tuple]:
+# magic number: (byte order, record header format, timestamp divisor)
+PCAP_MAGIC = {0xa1b2c3d4: ('>', 'IIII', 1E6),
+              0xa1b23c4d: ('>', 'IIII', 1E9),
+              0xa1b2cd34: ('>', 'IIIIIHBB', 1E6),
+              0xd4c3b2a1: ('<', 'IIII', 1E6),
+              0x4d3cb2a1: ('<', 'IIII', 1E9),
+              0x34cdb2a1: ('<', 'IIIIIHBB', 1E6)}
+
+
+def pcap_header(buf: bytes) -> tuple[struct.Struct, float]:
     """
-    read in a pcap file and return a list of tuples
-    containing a packets timestamp and ethernet layer
+    read the global header of a pcap file
+    :param buf: first bytes of the pcap file
+    :return: (record header struct, timestamp divisor) for records in the file
+    """
+    if len(buf) < FILE_HEADER_SIZE:
+        raise ValueError('invalid tcpdump header')
+    # magic number is written in the byte order of the machine that captured the file
+    magic = struct.unpack_from('>I', buf)[0]
+    if magic not in PCAP_MAGIC:
+        raise ValueError('invalid tcpdump header')
+
+    byte_order, record_format, divisor = PCAP_MAGIC[magic]
+    return struct.Struct(byte_order + record_format), divisor
+
+
+def read_records(open_file, record_header: struct.Struct, divisor: float,
+                 offset: int, end: Optional[int] = None) -> Iterator[tuple]:
+    """
+    read the records of a pcap file from the current position of an open file
+    stops at the end of the file, the first incomplete record or end
+    :param open_file: pcap file opened in binary mode
+    :param record_header: struct for the record headers in the file
+    :param divisor: divisor to turn the fractional part of a timestamp into seconds
+    :param offset: current position in the file
+    :param end: offset to stop reading records at, None to read to the end of the file
+    :return: generator of (packet_timestamp, packet_bytes) tuples
+    """
+    header_size = record_header.size
+    unpack_record = record_header.unpack
+    read = open_file.read
+
+    while end is None or offset < end:
+        header = read(header_size)
+        if len(header) < header_size:
+            break
+        ts_sec, ts_frac, caplen = unpack_record(header)[:3]
+        buf = read(caplen)
+        if len(buf) < caplen:
+            break
+        offset += header_size + caplen
+        yield ts_sec + ts_frac / divisor, buf
+
+
+def packet_stream(pcap_file: str, start: Optional[int] = None, end: Optional[int] = None,
+                  predicate: Optional[Callable[[float, bytes], bool]] = None) -> Iterator[tuple]:
+    """
+    read in a pcap file one packet at a time
+    yields a tuple containing a packets timestamp and a lazy view of the packet
+    only the packet currently being analysed is held in memory
     :param pcap_file: relative path to pcap file
-    :return: list of (packet_timestamp, packet_bytes) tuples
+    :param start: offset of the first record to read, None for the first record in the file
+    :param end: offset to stop reading records at, None to read to the end of the file
+    :param predicate: compiled filter taking (timestamp, packet bytes), None to read every packet
+    :return: generator of (packet_timestamp, packet_view) tuples
     """
     try:
         with open(pcap_file, 'rb') as open_file:
-            pcap = dpkt.pcap.Reader(open_file)
-            packets = []
-            # add timestamp and ethernet layer tuple from each packet to list
-            for (timestamp, buf) in pcap:
-                packet = timestamp, dpkt.ethernet.Ethernet(buf)
-                packets.append(packet)
-            return packets
+            record_header, divisor = pcap_header(open_file.read(FILE_HEADER_SIZE))
+            if start is None:
+                start = FILE_HEADER_SIZE
+            open_file.seek(start)
+            # yield timestamp and packet view tuple for each packet
+            for (timestamp, buf) in read_records(open_file, record_header, divisor, start, end):
+                if predicate is None or predicate(timestamp, buf):
+                    yield timestamp, PacketView(buf)
     # specified file does not exist
     except FileNotFoundError as err:
         print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
@@ -34,3 +109,91 @@ def packet_list(pcap_file: str) -> list[tuple]:
     except ValueError as err:
         print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
         sys.exit()
+
+
+def split_capture(pcap_file: str, parts: int, start: Optional[int] = None,
+                  end: Optional[int] = None) -> list[tuple[int, int]]:
+    """
+    split a pcap file into byte ranges of roughly equal size
+    every range starts and ends on a record boundary
+    :param pcap_file: relative path to pcap file
+    :param parts: number of ranges to split the file into
+    :param start: offset of the first record to split from, None for the first record in the file
+    :param end: offset to stop splitting at, None to split to the end of the file
+    :return: list of (start offset, end offset) tuples in file order
+    """
+    size = os.path.getsize(pcap_file)
+    if end is not None:
+        size = min(size, end)
+    if start is None:
+        start = FILE_HEADER_SIZE
+    with open(pcap_file, 'rb') as open_file:
+        record_header, unused_divisor = pcap_header(open_file.read(FILE_HEADER_SIZE))
+        # nothing to split when there are no records after start
+        if size <= start:
+            return []
+        with mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            header_size = record_header.size
+            # caplen is the third field of the record header
+            unpack_caplen = struct.Struct(record_header.format[0] + 'I').unpack_from
+
+            boundaries = [start]
+            target = start + (size - start) // parts
+            offset = start
+            # walk the record headers, cutting at the first record past each target
+            while offset + header_size <= size:
+                caplen = unpack_caplen(buf, offset + 8)[0]
+                # stop at an incomplete record at the end of the file
+                if offset + header_size + caplen > size:
+                    break
+                if offset >= target and len(boundaries) < parts:
+                    boundaries.append(offset)
+                    target = start + (size - start) * len(boundaries) // parts
+                offset += header_size + caplen
+
+    boundaries.append(offset)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def records_end(pcap_file: str, start: Optional[int] = None) -> int:
+    """
+    find where the last complete record in a pcap file ends,
+    e.g. to know where to carry on reading a capture still being written
+    :param pcap_file: relative path to pcap file
+    :param start: offset of a record to start walking the record headers from, None for the first record
+    :return: offset after the last complete record
+    """
+    chunks = split_capture(pcap_file, 1, start)
+    if not chunks:
+        return FILE_HEADER_SIZE if start is None else start
+    return chunks[-1][1]
+
+
+def first_timestamp(pcap_file: str, predicate: Optional[Callable[[float, bytes], bool]] = None,
+                    start: Optional[int] = None) -> Optional[float]:
+    """
+    read the timestamp of the first packet in a pcap file
+    :param pcap_file: relative path to pcap file
+    :param predicate: compiled filter, the first packet it keeps is used
+    :param start: offset of a record to start reading from, None for the first record in the file
+    :return: timestamp of the first packet, None if the file has no packets
+    """
+    with open(pcap_file, 'rb') as open_file:
+        record_header, divisor = pcap_header(open_file.read(FILE_HEADER_SIZE))
+        if start is None:
+            start = FILE_HEADER_SIZE
+        open_file.seek(start)
+        for timestamp, buf in read_records(open_file, record_header, divisor, start):
+            if predicate is None or predicate(timestamp, buf):
+                return timestamp
+    return None
+
+
+def packet_list(pcap_file: str) -> list[tuple]:
+    """
+    read in a pcap file and return a list of tuples
+    containing a packets timestamp and a lazy view of the packet
+    :param pcap_file: relative path to pcap file
+    :return: list of (packet_timestamp, packet_view) tuples
+    """
+    return list(packet_stream(pcap_file))
@@ -5,20 +5,461 @@
    Summary of packets,
    find emails in TO: and FROM: fields,
    find image files in http requests,
-   count packets send to/from IP pairs
+   count packets send to/from IP pairs,
+   flows with the most bytes and the longest flows (only with --stages flows)
    KML file with geolocation of valid destination IPs,
    graph of packets over time
+
+   each output is a stage that can be chosen with --stages,
+   the modules of a stage and their dependencies (tabulate, regex, geoip2, matplotlib)
+   are only imported when the stage runs, so a run of a few stages starts quickly
+
+   with --approx the IP pairs and destinations are counted in fixed memory with sketches,
+   and --sample counts 1 in N packets in the activity graph, for captures too large to count exactly
+   with --memory-limit the IP pairs, emails and images are counted exactly,
+   spilling to sorted runs in temporary files once they use their share of the limit
 """
 
+import math
 import os
+import sys
 import argparse
-from parse_pcap import packet_list
-from pcap_summary import protocol_info, protocol_table
-from pcap_emails import find_emails
-from pcap_images import find_images
-from ip_pairs import find_ip_pairs, print_ip_pairs_ordered
-from packet_geolocation import packet_geolocation
-from pcap_plot import plot_packet_activity
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from copy import deepcopy
+from typing import TYPE_CHECKING, Optional
+from analysis_cache import cache_path, load_cache, save_cache
+from pcap_batch import find_captures, is_batch, run_batch
+from parse_pcap import first_timestamp, packet_stream, records_end
+from pcap_filter import compile_filter
+from pcap_follow import WindowedAnalysers, follow, slice_length
+from pcap_index import PacketIndex
+from pcap_pipeline import Analyser, run_index, run_index_profiled, run_parallel, run_pipeline, run_profiled
+from pcap_profile import Profiler
+from pcap_report import OutputStage, capture_output, run_stages
+from table_writer import FORMATS, begin_report, end_report, status_stream, write_table
+from packet_geolocation import CLUSTER_MODES, DEFAULT_DATABASE
+from time_index import load_time_index, parse_window_time
+
+if TYPE_CHECKING:
+    from pcap_summary import ProtocolSummary
+    from pcap_emails import EmailFinder
+    from pcap_images import ImageFinder
+    from ip_pairs import ApproxIpPairCounter, IpPairCounter
+    from pcap_flows import FlowTracker
+    from packet_geolocation import GeoLocator
+    from pcap_plot import PacketActivity
+
+# stages in the order their output is printed
+STAGES = ('summary', 'emails', 'images', 'pairs', 'flows', 'geolocation', 'plot')
+
+# stages run when none are chosen
+DEFAULT_STAGES = ('summary', 'emails', 'images', 'pairs', 'geolocation', 'plot')
+
+# stages reported on when following a capture
+FOLLOW_STAGES = ('summary', 'emails', 'pairs', 'plot')
+
+
+def analyse(pcap_file_path: str, analysers: list[Analyser], workers: int = 1, use_index: bool = False,
+            start: Optional[int] = None, end: Optional[int] = None,
+            profiler: Optional[Profiler] = None, packet_filter: Optional[str] = None,
+            timestamp: Optional[float] = None, position: int = 0) -> int:
+    """
+    feed the packets in a pcap file to each analyser
+    :param pcap_file_path: relative path to pcap file
+    :param analysers: analysers to feed the packets to
+    :param workers: number of worker processes
+    :param use_index: build a packet index instead of decoding every packet
+    :param start: offset of the first record to read, None for the first record in the file
+    :param end: offset to stop reading records at, None to read to the end of the file
+    :param profiler: profiler measuring each stage, a profiled run is analysed in this process
+    :param packet_filter: filter expression packets must match, None for every packet
+    :param timestamp: timestamp of the first packet in the capture when reading from part way through,
+                      None for the first packet read
+    :param position: number of packets in the capture before start
+    :return: number of packets read
+    """
+    profiling = profiler is not None and profiler.enabled
+    predicate = compile_filter(packet_filter) if packet_filter else None
+    if workers > 1 and not profiling:
+        try:
+            return run_parallel(pcap_file_path, analysers, workers, use_index, start, end,
+                                packet_filter, timestamp, position)
+        # file does not exist, cannot be read or is not in the correct format
+        except (FileNotFoundError, PermissionError, ValueError) as err:
+            print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
+            sys.exit()
+    elif use_index:
+        try:
+            if profiling:
+                with profiler.stage('parse') as stage:
+                    index = PacketIndex(pcap_file_path, start, end, predicate)
+                    stage.packets += len(index)
+            else:
+                index = PacketIndex(pcap_file_path, start, end, predicate)
+        # file does not exist, cannot be read or is not in the correct format
+        except (FileNotFoundError, PermissionError, ValueError) as err:
+            print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
+            sys.exit()
+        # analysers only decode the packets they need from the index
+        with index:
+            if profiling:
+                return run_index_profiled(index, analysers, profiler)
+            return run_index(index, analysers)
+    elif profiling:
+        return run_profiled(packet_stream(pcap_file_path, start, end, predicate), analysers, profiler)
+    # read the pcap file once, feeding every packet to each analyser
+    return run_pipeline(packet_stream(pcap_file_path, start, end, predicate), analysers)
+
+
+def summary_report(pcap_name: str, summary: 'ProtocolSummary', output_format: str, profiler: Profiler) -> None:
+    """
+    print the table of protocols in the capture
+    finish builds each analysers result, rendering covers building and printing tables
+    :param pcap_name: name of pcap file
+    :param summary: protocol summary fed every packet
+    :param output_format: format of the table, one of FORMATS
+    :param profiler: profiler measuring the analyser and render stages
+    """
+    from pcap_summary import PROTOCOL_HEADERS, protocol_rows
+
+    print(f'\nBuilding table for {pcap_name} ...', file=status_stream(output_format))
+    with profiler.stage(summary.name):
+        protocols = summary.finish()
+    with profiler.stage('render'):
+        write_table('protocols', PROTOCOL_HEADERS, protocol_rows(protocols), output_format)
+
+
+def emails_report(pcap_name: str, email_finder: 'EmailFinder', output_format: str, profiler: Profiler) -> None:
+    """
+    print the table of emails found in the capture
+    :param pcap_name: name of pcap file
+    :param email_finder: email finder fed every packet
+    :param output_format: format of the table, one of FORMATS
+    :param profiler: profiler measuring the analyser and render stages
+    """
+    from pcap_emails import EMAIL_HEADERS, NO_EMAILS, email_rows
+
+    print(f'\nSearching for Emails in {pcap_name} ...', file=status_stream(output_format))
+    with profiler.stage(email_finder.name):
+        emails_from, emails_to = email_finder.found()
+    with profiler.stage('render'):
+        write_table('emails', EMAIL_HEADERS, email_rows(emails_from, emails_to), output_format, NO_EMAILS)
+
+
+def images_report(pcap_name: str, image_finder: 'ImageFinder', output_format: str, profiler: Profiler) -> None:
+    """
+    print the table of images requested in the capture
+    :param pcap_name: name of pcap file
+    :param image_finder: image finder fed every packet
+    :param output_format: format of the table, one of FORMATS
+    :param profiler: profiler measuring the analyser and render stages
+    """
+    from pcap_images import IMAGE_HEADERS, NO_IMAGES, image_rows
+
+    print(f'\nSearching for Image files in {pcap_name} ...', file=status_stream(output_format))
+    with profiler.stage(image_finder.name):
+        images = image_finder.found()
+    with profiler.stage('render'):
+        write_table('images', IMAGE_HEADERS, image_rows(images), output_format, NO_IMAGES, stralign='left')
+
+
+def ip_pairs_report(ip_pair_counter: 'IpPairCounter', conversations: bool, top: Optional[int],
+                    output_format: str, profiler: Profiler) -> None:
+    """
+    print the packets sent between IP pairs
+    :param ip_pair_counter: IP pair counter fed every packet
+    :param conversations: merge both directions between two IPs
+    :param top: only print this many IP pairs with the most packets
+    :param output_format: format of the table, one of FORMATS
+    :param profiler: profiler measuring the analyser and render stages
+    """
+    from ip_pairs import print_conversations_ordered, print_ip_pairs_ordered
+
+    status = status_stream(output_format)
+    with profiler.stage(ip_pair_counter.name):
+        ip_pairs = ip_pair_counter.finish()
+    with profiler.stage('render'):
+        if conversations:
+            print('\nCounting packets and bytes in conversations between IP pairs', file=status)
+            print_conversations_ordered(ip_pairs, top, output_format)
+        else:
+            print('\nCounting packets between Source and Destination IP pairs', file=status)
+            print_ip_pairs_ordered(ip_pairs, top, output_format)
+
+
+def approx_ip_pairs_report(ip_pair_counter: 'ApproxIpPairCounter', top: Optional[int],
+                           output_format: str, profiler: Profiler) -> None:
+    """
+    print the estimated packets and bytes sent between the IP pairs with the most packets
+    :param ip_pair_counter: approximate IP pair counter fed every packet
+    :param top: only print this many IP pairs with the most packets
+    :param output_format: format of the tables, one of FORMATS
+    :param profiler: profiler measuring the analyser and render stages
+    """
+    from ip_pairs import print_approx_ip_pairs
+
+    status = status_stream(output_format)
+    with profiler.stage(ip_pair_counter.name):
+        ip_pairs = ip_pair_counter.finish()
+    with profiler.stage('render'):
+        print('\nEstimating packets between Source and Destination IP pairs', file=status)
+        print(f'Every pair with more than {ip_pair_counter.packets.error_bound()} packets is listed, '
+              f'bytes are within the error {ip_pair_counter.bytes.confidence():.0%} of the time', file=status)
+        print_approx_ip_pairs(ip_pair_counter, ip_pairs, top, output_format)
+
+
+def flows_report(pcap_name: str, flow_tracker: 'FlowTracker', output_format: str, profiler: Profiler) -> None:
+    """
+    print the flows with the most bytes and the longest flows
+    :param pcap_name: name of pcap file
+    :param flow_tracker: flow tracker fed every packet
+    :param output_format: format of the tables, one of FORMATS
+    :param profiler: profiler measuring the analyser and render stages
+    """
+    from pcap_flows import print_top_flows
+
+    status = status_stream(output_format)
+    with profiler.stage(flow_tracker.name):
+        top_bytes, top_duration = flow_tracker.finish()
+    with profiler.stage('render'):
+        print(f'\nFollowing flows in {pcap_name}: {flow_tracker.flows} flows, '
+              f'top {flow_tracker.top} by bytes then by duration', file=status)
+        print_top_flows(top_bytes, top_duration, output_format)
+        if flow_tracker.out_file is not None:
+            print(f'Flows Saved as {flow_tracker.out_file}', file=status)
+
+
+def geolocation_report(pcap_name: str, geo_locator: 'GeoLocator', output_format: str, profiler: Profiler) -> None:
+    """
+    look up the location of destination IPs and save them to a KML file
+    :param pcap_name: name of pcap file
+    :param geo_locator: geo locator fed every packet
+    :param output_format: format of tables, messages go to stderr for structured formats
+    :param profiler: profiler measuring the analyser stage
+    """
+    status = status_stream(output_format)
+    print(f'\nFinding Geolocation for all destination IPs in {pcap_name} ...', file=status)
+    with profiler.stage(geo_locator.name):
+        geolocation = geo_locator.finish()
+    print(geolocation, file=status)
+
+
+def activity_report(pcap_name: str, packet_activity: 'PacketActivity', output_format: str,
+                    profiler: Profiler) -> None:
+    """
+    save the graphs of packet activity
+    :param pcap_name: name of pcap file
+    :param packet_activity: packet activity fed every packet
+    :param output_format: format of tables, messages go to stderr for structured formats
+    :param profiler: profiler measuring the analyser stage
+    """
+    status = status_stream(output_format)
+    print(f'\nPlotting packet activity for {pcap_name} ...', file=status)
+    # the names of the files saved are printed as messages
+    with profiler.stage(packet_activity.name), redirect_stdout(status):
+        packet_activity.finish()
+
+
+def build_analysers(stages: list[str], pcap_name: str, kml_file: str,
+                    args: argparse.Namespace, headless: bool, keep_lookup: bool = False) -> list[Analyser]:
+    """
+    create the analyser of each stage, only the modules of the stages chosen are imported
+    :param stages: names of stages to run, in the order of STAGES
+    :param pcap_name: name of pcap file
+    :param kml_file: name of KML file for the geolocation stage
+    :param args: command line arguments
+    :param headless: save graphs without opening a window
+    :param keep_lookup: keep the IP location database open for the next capture analysed in this process
+    :return: one analyser for each stage
+    """
+    # the memory limit is shared between the stages that can spill to disk,
+    # and between the worker processes and the process merging their analysers
+    memory_limit = None
+    spilling = [stage for stage in stages if stage in ('emails', 'images') or (stage == 'pairs' and not args.approx)]
+    if args.memory_limit is not None and spilling:
+        processes = args.workers + 1 if args.workers > 1 else 1
+        memory_limit = args.memory_limit * 2 ** 20 // len(spilling) // processes
+
+    analysers = []
+    for stage in stages:
+        if stage == 'summary':
+            from pcap_summary import ProtocolSummary
+            analysers.append(ProtocolSummary())
+        elif stage == 'emails':
+            from pcap_emails import EmailFinder
+            analysers.append(EmailFinder(args.mail_only, memory_limit=memory_limit, spill_dir=args.spill_dir))
+        elif stage == 'images':
+            from pcap_images import ImageFinder
+            analysers.append(ImageFinder(memory_limit=memory_limit, spill_dir=args.spill_dir))
+        elif stage == 'pairs' and args.approx:
+            from ip_pairs import ApproxIpPairCounter
+            analysers.append(ApproxIpPairCounter(args.approx_size))
+        elif stage == 'pairs':
+            from ip_pairs import IpPairCounter
+            analysers.append(IpPairCounter(memory_limit, args.spill_dir))
+        elif stage == 'flows':
+            from pcap_flows import TOP_FLOWS, FlowTracker
+            analysers.append(FlowTracker(args.top or TOP_FLOWS, args.idle_timeout, args.active_timeout,
+                                         args.flows_out))
+        elif stage == 'geolocation' and args.approx:
+            from packet_geolocation import ApproxGeoLocator
+            analysers.append(ApproxGeoLocator(kml_file, args.geoip_db, args.geo_cache, args.cluster, keep_lookup,
+                                              args.approx_size))
+        elif stage == 'geolocation':
+            from packet_geolocation import GeoLocator
+            analysers.append(GeoLocator(kml_file, args.geoip_db, args.geo_cache, args.cluster, keep_lookup))
+        elif stage == 'plot':
+            from pcap_plot import PacketActivity
+            analysers.append(PacketActivity(pcap_name, args.interval, headless, args.export, args.sample))
+    return analysers
+
+
+def output_stages(pcap_name: str, analysers: list[Analyser], args: argparse.Namespace,
+                  profiler: Profiler) -> list[OutputStage]:
+    """
+    :param pcap_name: name of pcap file
+    :param analysers: analysers from build_analysers, fed every packet
+    :param args: command line arguments
+    :param profiler: profiler measuring the stages
+    :return: output stage printing the result of each analyser
+    """
+    stages = []
+    for analyser in analysers:
+        if analyser.name == 'summary':
+            stages.append(OutputStage(summary_report, pcap_name, analyser, args.format, profiler))
+        elif analyser.name == 'emails':
+            stages.append(OutputStage(emails_report, pcap_name, analyser, args.format, profiler))
+        elif analyser.name == 'images':
+            stages.append(OutputStage(images_report, pcap_name, analyser, args.format, profiler))
+        elif analyser.name == 'pairs' and args.approx:
+            stages.append(OutputStage(approx_ip_pairs_report, analyser, args.top, args.format, profiler))
+        elif analyser.name == 'pairs':
+            stages.append(OutputStage(ip_pairs_report, analyser, args.conversations, args.top, args.format,
+                                      profiler))
+        elif analyser.name == 'flows':
+            # flows still going are written to the flow file by this process
+            stages.append(OutputStage(flows_report, pcap_name, analyser, args.format, profiler,
+                                      local=analyser.out_file is not None))
+        elif analyser.name == 'geolocation':
+            stages.append(OutputStage(geolocation_report, pcap_name, analyser, args.format, profiler))
+        elif analyser.name == 'plot':
+            # a graph shown in a window has to stay in this process
+            stages.append(OutputStage(activity_report, pcap_name, analyser, args.format, profiler,
+                                      local=not analyser.headless))
+    return stages
+
+
+def run_report(name: str, stages: list[OutputStage], args: argparse.Namespace, workers: int = 1) -> None:
+    """
+    run the output stages of a report, with --format json their tables are one document
+    :param name: name of the report, e.g. the pcap file name
+    :param stages: output stages from output_stages
+    :param args: command line arguments
+    :param workers: number of processes the stages run in
+    """
+    begin_report(name, args.format)
+    run_stages(stages, workers)
+    end_report(args.format)
+
+
+def analyse_capture(pcap_file: str, stages: list[str], args: argparse.Namespace,
+                    packet_filter: Optional[str], timestamp: float) -> tuple[str, list[Analyser]]:
+    """
+    analyse one capture of a batch and build its report, run in a worker process by run_batch
+    graphs are saved without opening a window and the KML file is named after the capture
+    :param pcap_file: relative path to pcap file
+    :param stages: names of stages to run
+    :param args: command line arguments
+    :param packet_filter: filter expression packets must match, None for every packet
+    :param timestamp: timestamp of the first packet of the batch
+    :return: (report of the capture, or the file it is saved in with --memory-limit,
+             analysers to merge into the report of every capture) tuple
+    """
+    pcap_name = os.path.basename(pcap_file)
+    analysers = build_analysers(stages, pcap_name, f'{pcap_name.split(".")[0]}.kml', args, True, True)
+    # the graph of the capture starts at its first packet, the merged graph at the first packet of the batch,
+    # so packets are also counted in the time intervals of the merged graph
+    merged = list(analysers)
+    if 'plot' in stages:
+        timeline = build_analysers(['plot'], pcap_name, '', args, True)[0]
+        timeline.begin(timestamp)
+        merged[stages.index('plot')] = timeline
+        analyse(pcap_file, analysers + [timeline], use_index=args.index, packet_filter=packet_filter)
+    else:
+        analyse(pcap_file, analysers, use_index=args.index, packet_filter=packet_filter)
+
+    # the report finishes copies of the analysers so their state can still be merged
+    if args.memory_limit is not None:
+        # the report is written to a file so its tables are not held in memory
+        handle, report_file = tempfile.mkstemp(prefix='report-', dir=args.spill_dir)
+        with open(handle, 'w') as report, redirect_stdout(report):
+            capture_report(pcap_name, deepcopy(analysers), args)
+        return report_file, merged
+    report = capture_output(capture_report, (pcap_name, deepcopy(analysers), args))
+    return report, merged
+
+
+def capture_report(pcap_name: str, analysers: list[Analyser], args: argparse.Namespace) -> None:
+    """
+    print the report of one capture of a batch
+    :param pcap_name: name of pcap file
+    :param analysers: analysers fed every packet in the capture
+    :param args: command line arguments
+    """
+    print(f'\nFile: {pcap_name} read successfully', file=status_stream(args.format))
+    run_report(pcap_name, output_stages(pcap_name, analysers, args, Profiler(False)), args)
+
+
+def analyse_batch(path: str, stages: list[str], kml_file: str, args: argparse.Namespace,
+                  packet_filter: Optional[str]) -> None:
+    """
+    analyse every capture in a directory or matching a glob pattern, printing a report for each one
+    then a report of every capture merged: protocols across captures, IP pairs,
+    every email and image and one activity graph from the first packet to the last
+    :param path: directory or glob pattern
+    :param stages: names of stages to run
+    :param kml_file: name of KML file of the merged report
+    :param args: command line arguments
+    :param packet_filter: filter expression packets must match, None for every packet
+    """
+    captures = find_captures(path)
+    if not captures:
+        print(f'Exceptions (FileNotFoundError): no pcap files found in {path}', file=sys.stderr)
+        sys.exit()
+
+    # the merged graph is saved next to the KML file and measures time from the first packet of any capture
+    batch_name = os.path.splitext(kml_file)[0]
+    merged = build_analysers(stages, batch_name, kml_file, args, args.headless, True)
+    predicate = compile_filter(packet_filter) if packet_filter else None
+    timestamps = [first_timestamp(pcap_file, predicate) for pcap_file in captures]
+    timestamp = min((timestamp for timestamp in timestamps if timestamp is not None), default=0.0)
+
+    # captures are analysed in the order of their first packet, so merging them in turn gives one timeline
+    for report, analysers in run_batch(captures, analyse_capture, args.workers, stages, args, packet_filter,
+                                       timestamp):
+        if args.memory_limit is not None:
+            with open(report) as report_file:
+                shutil.copyfileobj(report_file, sys.stdout)
+            os.remove(report)
+        else:
+            sys.stdout.write(report)
+        for analyser, capture_analyser in zip(merged, analysers):
+            analyser.merge(capture_analyser)
+
+    print(f'\nMerged report of {len(captures)} pcap files in {path}', file=status_stream(args.format))
+    run_report(batch_name, output_stages(batch_name, merged, args, Profiler(False)), args, args.render_workers)
+
+
+def follow_report(pcap_name: str, analysers: list[Analyser], args: argparse.Namespace) -> None:
+    """
+    print the tables for the packets in the window of a followed pcap file and save the graph
+    :param pcap_name: name of pcap file being followed
+    :param analysers: analysers of the window, from build_analysers
+    :param args: command line arguments
+    """
+    run_report(pcap_name, output_stages(pcap_name, analysers, args, Profiler(False)), args)
 
 
 def main() -> None:
@@ -30,13 +471,225 @@ def main() -> None:
                                                  'for input file')
     parser.add_argument('-i', '--input',
                         metavar='',
-                        help='name of file to be read in')
+                        help='name of file to be read in, or a directory or glob pattern '
+                             'of files to report on one by one and merged')
 
     parser.add_argument('-o', '--output',
                         metavar='',
-                        help='name kml file created')
+                        help='name kml file created, a name ending in .kmz saves a zipped kml file')
+
+    parser.add_argument('--cluster',
+                        choices=CLUSTER_MODES,
+                        help='make one KML point for the IPs at the same coordinates or in the same city')
+
+    parser.add_argument('-s', '--stages',
+                        metavar='',
+                        default=','.join(DEFAULT_STAGES),
+                        help=f'comma separated stages to run from {",".join(STAGES)} '
+                             f'(default {",".join(DEFAULT_STAGES)}), e.g. summary,pairs for a quick look')
+
+    parser.add_argument('-x', '--index',
+                        action='store_true',
+                        help='memory map the file and build a packet index '
+                             'instead of decoding every packet')
+
+    parser.add_argument('-w', '--workers',
+                        metavar='',
+                        type=int,
+                        default=1,
+                        help='number of processes to split the file between, '
+                             'or to share the files of a directory or glob pattern between')
+
+    parser.add_argument('-g', '--geoip-db',
+                        metavar='',
+                        default=DEFAULT_DATABASE,
+                        help='path of the GeoIP2/GeoLite2 City database')
+
+    parser.add_argument('--geo-cache',
+                        metavar='',
+                        help='file to keep geolocation lookups in between runs')
+
+    parser.add_argument('-t', '--interval',
+                        metavar='',
+                        type=float,
+                        nargs='+',
+                        default=[1.5],
+                        help='seconds in each time interval of the activity graph, '
+                             'one graph is saved for each interval given')
+
+    parser.add_argument('--headless',
+                        action='store_true',
+                        help='save the activity graph without opening a window')
+
+    parser.add_argument('--export',
+                        choices=['csv', 'npy'],
+                        help='save packets and bytes in each time interval to a csv or npy file')
+
+    parser.add_argument('--mail-only',
+                        action='store_true',
+                        help='only search connections on mail ports or starting with a mail server banner for emails')
+
+    parser.add_argument('--top',
+                        metavar='K',
+                        type=int,
+                        help='only print the K IP pairs with the most packets, or K flows in each flow table')
+
+    parser.add_argument('--format',
+                        choices=FORMATS,
+                        default='pretty',
+                        help='write tables as pretty tables (default), or stream their rows as json, '
+                             'json lines or csv with other messages on stderr')
+
+    parser.add_argument('--conversations',
+                        action='store_true',
+                        help='merge both directions between two IPs and print packets and bytes each way')
+
+    parser.add_argument('--flows-out',
+                        metavar='PATH',
+                        help='write every flow to a csv file, or json lines for a name ending in .jsonl, '
+                             'as it finishes (flows stage)')
+
+    parser.add_argument('--idle-timeout',
+                        metavar='S',
+                        type=float,
+                        default=120.0,
+                        help='seconds without a packet before a flow ends (default 120)')
+
+    parser.add_argument('--active-timeout',
+                        metavar='S',
+                        type=float,
+                        default=1800.0,
+                        help='seconds after which a flow still going is written out and started again (default 1800)')
+
+    parser.add_argument('--approx',
+                        action='store_true',
+                        help='count the IP pairs and destinations with the most packets in fixed memory, '
+                             'with the error of each count, for captures too large to count exactly')
+
+    parser.add_argument('--approx-size',
+                        metavar='K',
+                        type=int,
+                        default=10000,
+                        help='number of IP pairs and destinations counted with --approx (default 10000)')
+
+    parser.add_argument('--sample',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help='count 1 in N packets in the activity graph, scaled up by N (default 1, every packet)')
+
+    parser.add_argument('--memory-limit',
+                        metavar='MB',
+                        type=int,
+                        help='megabytes the IP pairs, emails and images may use before they are spilled '
+                             'to sorted runs in temporary files, results are the same as counting in memory')
+
+    parser.add_argument('--spill-dir',
+                        metavar='DIR',
+                        help='directory the temporary files of --memory-limit are made in '
+                             '(default the system temporary directory)')
+
+    parser.add_argument('--cache',
+                        metavar='PATH',
+                        nargs='?',
+                        const='',
+                        help='keep the analysis in a cache file (default <pcap file>.cache), '
+                             'later runs only read packets added to the capture since')
+
+    parser.add_argument('-f', '--follow',
+                        action='store_true',
+                        help='keep reading the capture as it is written, reporting on the latest packets')
+
+    parser.add_argument('--refresh',
+                        metavar='',
+                        type=float,
+                        default=10.0,
+                        help='seconds between reports when following a capture (default 10)')
+
+    parser.add_argument('--window',
+                        metavar='',
+                        type=float,
+                        default=3600.0,
+                        help='seconds of the latest packets reported on when following a capture (default 3600)')
+
+    parser.add_argument('--filter',
+                        metavar='EXPR',
+                        help="only analyse packets matching a tcpdump style filter, "
+                             "e.g. 'tcp port 25 and net 10.1.0.0/16', after/before times are in UTC")
+
+    parser.add_argument('--start',
+                        metavar='TIME',
+                        help='only analyse packets from this time, as seconds since the epoch, '
+                             'a date and time (2019-02-12T14:02) or a time of day (14:02), in UTC like the tables')
+
+    parser.add_argument('--end',
+                        metavar='TIME',
+                        help='only analyse packets before this time')
+
+    parser.add_argument('--profile',
+                        metavar='PATH',
+                        nargs='?',
+                        const='',
+                        help='save the time, packets per second and counters of each stage '
+                             'as JSON (default <pcap file>.profile.json)')
+
+    parser.add_argument('--profile-memory',
+                        action='store_true',
+                        help='also trace the peak memory of each stage with tracemalloc (slower)')
+
+    parser.add_argument('--profile-dump',
+                        metavar='DIR',
+                        help='also save a cProfile dump of each stage to a directory (slower)')
+
+    parser.add_argument('--render-workers',
+                        metavar='',
+                        type=int,
+                        default=1,
+                        help='number of processes to build the tables, KML file and graphs in at the same time')
 
     args = parser.parse_args()
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown or not stages:
+        parser.error(f'--stages must be chosen from {",".join(STAGES)}')
+    # stages always run in the same order, once each
+    stages = [stage for stage in STAGES if stage in stages]
+    if args.approx and args.conversations:
+        parser.error('--conversations cannot be used with --approx')
+    if args.approx_size < 1 or args.sample < 1:
+        parser.error('--approx-size and --sample must be at least 1')
+    # nan and inf are read as floats, an interval has to split the capture into a finite number of steps
+    if any(not (interval > 0 and math.isfinite(interval)) for interval in args.interval):
+        parser.error('--interval must be a number of seconds above 0')
+    if args.top is not None and args.top < 1:
+        parser.error('--top must be at least 1')
+    if args.idle_timeout <= 0 or args.active_timeout <= 0:
+        parser.error('--idle-timeout and --active-timeout must be above 0')
+    if args.flows_out is not None and (args.workers > 1 or args.follow or args.cache is not None):
+        parser.error('--flows-out writes flows from one process, not with --workers, --follow or --cache')
+    if (args.start is not None or args.end is not None) and (args.follow or args.cache is not None):
+        parser.error('--start/--end cannot be used with --follow or --cache')
+    if args.memory_limit is not None and (args.memory_limit < 1 or args.follow or args.cache is not None):
+        parser.error('--memory-limit must be at least 1 and cannot be used with --follow or --cache')
+    # a pretty table, or the output of a render worker, holds every row in memory
+    if args.memory_limit is not None and args.format == 'pretty':
+        unbounded = [stage for stage in stages
+                     if stage in ('emails', 'images') or (stage == 'pairs' and not args.approx and args.top is None)]
+        if unbounded:
+            parser.error(f'--memory-limit cannot keep the pretty {",".join(unbounded)} tables within the limit, '
+                         f'use --format csv, json or jsonl (or --top for pairs)')
+    if args.memory_limit is not None and args.render_workers > 1:
+        parser.error('--memory-limit writes tables as they are read, not with --render-workers')
+
+    # files spilled over the memory limit are kept in a directory removed when the run ends
+    if args.memory_limit is not None:
+        try:
+            spill_dir = tempfile.TemporaryDirectory(prefix='pcap-spill-', dir=args.spill_dir)
+        # directory does not exist or cannot be written to
+        except (FileNotFoundError, PermissionError) as err:
+            print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
+            sys.exit()
+        args.spill_dir = spill_dir.name
 
     pcap_file_path = args.input
     kml_file = args.output
@@ -45,36 +698,120 @@ def main() -> None:
     if pcap_file_path is None:
         pcap_file_path = input('Enter a pcap file to read: ')
     pcap_name = os.path.basename(pcap_file_path)
+    # a directory or glob pattern analyses each capture then merges them
+    batch = is_batch(pcap_file_path)
+    if batch and (args.follow or args.cache is not None or args.profile is not None
+                  or args.start is not None or args.end is not None or args.flows_out is not None):
+        parser.error('--follow, --cache, --profile, --start/--end and --flows-out need a single pcap file')
     if kml_file is None:
         # use pcap file name for kml file if one is not given
-        kml_file = f'{pcap_name.split(".")[0]}'
+        kml_file = 'merged' if batch else f'{pcap_name.split(".")[0]}'
 
-    # append .kml to KML file name specified if not already present
-    if any(extension not in kml_file for extension in ['.kml', '.KML']):
+    # append .kml to KML file name specified if not already present, .kmz saves a zipped KML file
+    if not kml_file.lower().endswith(('.kml', '.kmz')):
         kml_file += ".kml"
 
-    packets: list[tuple] = packet_list(pcap_file_path)
-    print(f'\nFile: {pcap_name} read successfully')
+    # a time window is read from the blocks of the time index that can hold its packets,
+    # packets either side of the window in those blocks are dropped by the filter
+    packet_filter = args.filter
+    window_start = window_end = None
+    if args.start is not None or args.end is not None:
+        try:
+            start_time = parse_window_time(args.start, pcap_file_path) if args.start is not None else None
+            end_time = parse_window_time(args.end, pcap_file_path) if args.end is not None else None
+            window_start, window_end = load_time_index(pcap_file_path).window(start_time, end_time)
+        # file does not exist, cannot be read or is not in the correct format, or a time is invalid
+        except (FileNotFoundError, PermissionError, ValueError) as err:
+            print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
+            sys.exit()
+        terms = [f'({args.filter})'] if args.filter is not None else []
+        if start_time is not None:
+            terms.append(f'after {start_time!r}')
+        if end_time is not None:
+            terms.append(f'before {end_time!r}')
+        packet_filter = ' and '.join(terms)
+
+    # check the filter before reading anything, the compiled filter is kept for later use
+    if packet_filter is not None:
+        try:
+            predicate = compile_filter(packet_filter)
+        # expression is not a valid filter, e.g. a bad address or a time that is not a finite number
+        except ValueError as err:
+            parser.error(f'--filter: {err}')
+    else:
+        predicate = None
+
+    if batch:
+        analyse_batch(pcap_file_path, stages, kml_file, args, packet_filter)
+        return
+
+    if args.follow:
+        # the tables and graph are built from a window of the latest packets,
+        # the graph is saved without opening a window so following is never blocked
+        follow_stages = [stage for stage in stages if stage in FOLLOW_STAGES]
+        if not follow_stages:
+            parser.error(f'--follow reports on the {",".join(FOLLOW_STAGES)} stages')
+        windowed = WindowedAnalysers(lambda: build_analysers(follow_stages, pcap_name, kml_file, args, True),
+                                     args.window, slice_length(args.window, args.interval[0]))
+        try:
+            follow(pcap_file_path, windowed,
+                   lambda analysers: follow_report(pcap_name, analysers, args), args.refresh,
+                   predicate=predicate)
+        # file is not in the correct format
+        except ValueError as err:
+            print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
+            sys.exit()
+        return
 
-    print(f'\nBuilding table for {pcap_name} ...')
-    protocols_dict = protocol_info(packets)
-    print(protocol_table(protocols_dict))
+    profiler = Profiler(args.profile is not None, args.profile_memory, args.profile_dump)
 
-    print(f'\nSearching for Emails in {pcap_name} ...')
-    print(find_emails(packets))
+    analysers = build_analysers(stages, pcap_name, kml_file, args, args.headless)
 
-    print(f'\nSearching for Image files in {pcap_name} ...')
-    print(find_images(packets))
+    if args.cache is None:
+        packets = analyse(pcap_file_path, analysers, args.workers, args.index, window_start, window_end,
+                          profiler, packet_filter)
+    else:
+        cache_file = args.cache or cache_path(pcap_file_path)
+        try:
+            with profiler.stage('cache'):
+                cached = load_cache(cache_file, pcap_file_path, analysers, args.filter)
+            start = cached[0] if cached else None
+            # packets are counted on from the cached ones, so a sampled graph keeps the same packets
+            position = cached[2] if cached else 0
+            # only records complete now are read, so the next run knows where to carry on
+            end = records_end(pcap_file_path, start)
+            timestamp = first_timestamp(pcap_file_path, predicate) if cached else None
+        # file does not exist, cannot be read or is not in the correct format
+        except (FileNotFoundError, PermissionError, ValueError) as err:
+            print(f'Exceptions ({err.__class__.__name__}): {err}', file=sys.stderr)
+            sys.exit()
 
-    print('\nCounting packets between Source and Destination IP pairs')
-    ip_pairs = find_ip_pairs(packets)
-    print_ip_pairs_ordered(ip_pairs)
+        # new packets are fed to copies of the analysers before any state is added to them,
+        # measuring time from the start of the whole capture
+        new_analysers = deepcopy(analysers)
+        if timestamp is not None:
+            for analyser in new_analysers:
+                analyser.begin(timestamp, position)
+        packets = analyse(pcap_file_path, new_analysers, args.workers, args.index, start, end,
+                          profiler, args.filter, timestamp, position)
+        with profiler.stage('cache'):
+            if cached:
+                for analyser, cached_analyser in zip(analysers, cached[1]):
+                    analyser.merge(cached_analyser)
+            for analyser, new_analyser in zip(analysers, new_analysers):
+                analyser.merge(new_analyser)
+            save_cache(cache_file, pcap_file_path, analysers, end, args.filter, position + packets)
+    print(f'\nFile: {pcap_name} read successfully', file=status_stream(args.format))
 
-    print(f'\nFinding Geolocation for all destination IPs in {pcap_name} ...')
-    print(packet_geolocation(packets, kml_file))
+    # once every analyser has all its packets the output stages are independent,
+    # a profiled run renders in this process so each stage is measured
+    run_report(pcap_name, output_stages(pcap_name, analysers, args, profiler), args,
+               1 if profiler.enabled else args.render_workers)
 
-    print(f'\nPlotting packet activity for {pcap_name} ...')
-    plot_packet_activity(packets, pcap_name)
+    if profiler.enabled:
+        profile_file = args.profile or f'{pcap_file_path}.profile.json'
+        profiler.save(profile_file, packets)
+        print(f'\nProfile Saved as {profile_file}', file=status_stream(args.format))
 
 
 if __name__ == '__main__':
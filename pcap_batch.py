@@ -0,0 +1,80 @@
+"""pcap_batch.py
+   script to find the captures in a directory or glob pattern
+   and analyse each one in a pool of processes
+
+   e.g. the hourly rotated files a sensor writes are analysed in one run,
+   paying for interpreter startup and opening the GeoIP database once per worker
+   rather than once per file
+
+   captures are ordered by their first packet, so the results of each capture
+   can be merged in order as if they were one capture read from start to finish
+"""
+import glob
+import os
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from parse_pcap import FILE_HEADER_SIZE, first_timestamp, pcap_header
+
+
+def is_batch(path: str) -> bool:
+    """
+    :param path: input path from the command line
+    :return: True for a directory or a glob pattern, False for a single file
+    """
+    if os.path.isfile(path):
+        return False
+    return os.path.isdir(path) or glob.escape(path) != path
+
+
+def is_capture(pcap_file: str) -> bool:
+    """
+    :param pcap_file: path of a file
+    :return: True if the file starts with a pcap file header
+    """
+    try:
+        with open(pcap_file, 'rb') as open_file:
+            pcap_header(open_file.read(FILE_HEADER_SIZE))
+    # not a capture, e.g. an index or cache file kept next to a capture, or cannot be read
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def find_captures(path: str) -> list[str]:
+    """
+    find the captures in a directory or matching a glob pattern, ordered by their first packet
+    files that are not captures are skipped, captures with no packets are last
+    :param path: directory or glob pattern, e.g. 'sensor/*.pcap'
+    :return: paths of captures
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in os.listdir(path)]
+    else:
+        files = glob.glob(path)
+    captures = sorted(pcap_file for pcap_file in files if os.path.isfile(pcap_file) and is_capture(pcap_file))
+
+    # sorting by name first keeps captures starting at the same time in name order
+    timestamps = {pcap_file: first_timestamp(pcap_file) for pcap_file in captures}
+    return sorted(captures, key=lambda pcap_file: (timestamps[pcap_file] is None, timestamps[pcap_file] or 0))
+
+
+def run_batch(captures: list[str], function: Callable, workers: int, *args) -> Iterator:
+    """
+    call a function for each capture, in a pool of processes when there is more than one worker
+    :param captures: paths of captures
+    :param function: function called with the path of a capture and args, must be importable by the workers
+    :param workers: number of worker processes, 1 to analyse the captures in this process
+    :param args: other arguments of the function
+    :return: iterator of the result for each capture, in the order of captures
+    """
+    if workers <= 1:
+        for pcap_file in captures:
+            yield function(pcap_file, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = deque(pool.submit(function, pcap_file, *args) for pcap_file in captures)
+        # results are dropped once they are handed on, so memory is not held for every capture
+        while futures:
+            yield futures.popleft().result()
@@ -0,0 +1,187 @@
+"""pcap_benchmark.py
+   script to benchmark each stage of the analysis on synthetic captures of increasing size
+   captures are written by synthetic_pcap with a fixed seed and geolocation uses a tiny
+   test database from mmdb_writer, so runs on different machines read the same packets
+
+   each stage runs in a new process so its peak memory is measured on its own
+   packets per second, wall time and peak RSS of each stage are saved as JSON
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from mmdb_writer import write_test_mmdb
+from synthetic_pcap import write_capture
+
+# stages in the order they are run, named after the function each one measures
+STAGES = ('packet_list',
+          'protocol_info',
+          'find_emails',
+          'find_images',
+          'find_ip_pairs',
+          'find_flows',
+          'packet_geolocation',
+          'plot_packet_activity')
+
+# default number of packets in each capture
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+
+def build_analysers(stage: str, pcap_file: str, database: str) -> list:
+    """
+    :param stage: name of stage from STAGES
+    :param pcap_file: path of pcap file
+    :param database: path of IP location database
+    :return: analysers fed the packets of the stage, empty for packet_list
+    """
+    # analysers are imported here so each stage process only pays for its own imports
+    if stage == 'packet_list':
+        return []
+    if stage == 'protocol_info':
+        from pcap_summary import ProtocolSummary
+        return [ProtocolSummary()]
+    if stage == 'find_emails':
+        from pcap_emails import EmailFinder
+        return [EmailFinder()]
+    if stage == 'find_images':
+        from pcap_images import ImageFinder
+        return [ImageFinder()]
+    if stage == 'find_ip_pairs':
+        from ip_pairs import IpPairCounter
+        return [IpPairCounter()]
+    if stage == 'find_flows':
+        from pcap_flows import FlowTracker
+        return [FlowTracker()]
+    if stage == 'packet_geolocation':
+        from packet_geolocation import GeoLocator
+        return [GeoLocator(f'{pcap_file}.kml', database)]
+    if stage == 'plot_packet_activity':
+        from pcap_plot import PacketActivity
+        return [PacketActivity(os.path.basename(pcap_file), headless=True)]
+    raise ValueError(f'unknown stage {stage}')
+
+
+def run_stage(stage: str, pcap_file: str, database: str) -> dict:
+    """
+    read a pcap file and run one stage, called in a new process
+    :param stage: name of stage from STAGES
+    :param pcap_file: path of pcap file
+    :param database: path of IP location database
+    :return: dictionary of packets, wall time, packets per second and peak RSS of the stage
+    """
+    from parse_pcap import packet_stream
+    from pcap_pipeline import run_pipeline
+
+    # graphs and KML files are saved next to the capture
+    os.chdir(os.path.dirname(os.path.abspath(pcap_file)))
+    pcap_file = os.path.basename(pcap_file)
+    analysers = build_analysers(stage, pcap_file, database)
+
+    start = time.perf_counter()
+    if analysers:
+        packets = run_pipeline(packet_stream(pcap_file), analysers)
+        for analyser in analysers:
+            analyser.finish()
+    else:
+        packets = len(list(packet_stream(pcap_file)))
+    wall_time = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return {'packets': packets,
+            'wall_time': round(wall_time, 6),
+            'packets_per_second': round(packets / wall_time, 1) if wall_time else None,
+            'peak_rss_kib': peak_rss}
+
+
+def benchmark(sizes: list[int], stages: list[str], work_dir: str, seed: int = 0) -> dict:
+    """
+    write a capture of each size and run each stage on it
+    :param sizes: number of packets in each capture
+    :param stages: names of stages to run
+    :param work_dir: directory captures, the test database and outputs are written to
+    :param seed: seed of the synthetic capture generator
+    :return: dictionary of the machine, seed and the results of each stage for each size
+    """
+    database = os.path.abspath(os.path.join(work_dir, 'test-city.mmdb'))
+    write_test_mmdb(database)
+
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'processor': platform.processor(),
+               'seed': seed,
+               'sizes': []}
+    # spawn gives each stage a fresh interpreter, nothing is inherited from earlier stages
+    context = get_context('spawn')
+    for size in sizes:
+        pcap_file = os.path.abspath(os.path.join(work_dir, f'synthetic-{size}.pcap'))
+        packets = write_capture(pcap_file, size, seed)
+        result = {'packets': packets,
+                  'file_size': os.path.getsize(pcap_file),
+                  'stages': {}}
+        print(f'\n{packets} packets ({result["file_size"]} bytes)')
+
+        for stage in stages:
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                stage_result = executor.submit(run_stage, stage, pcap_file, database).result()
+            result['stages'][stage] = stage_result
+            print(f'{stage:<22}{stage_result["wall_time"]:>10.3f} s'
+                  f'{stage_result["packets_per_second"] or 0:>14.0f} packets/s'
+                  f'{stage_result["peak_rss_kib"] / 1024:>10.1f} MiB')
+        results['sizes'].append(result)
+    return results
+
+
+def main() -> None:
+    """
+    process command line arguments, run the benchmark and save the results
+    """
+    parser = argparse.ArgumentParser(description='Benchmark each analysis stage on synthetic captures')
+    parser.add_argument('-n', '--packets',
+                        metavar='',
+                        type=int,
+                        nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help='number of packets in each capture (default 1000 10000 100000 1000000)')
+    parser.add_argument('-s', '--stages',
+                        metavar='',
+                        nargs='+',
+                        choices=STAGES,
+                        default=list(STAGES),
+                        help='stages to run (default all)')
+    parser.add_argument('--seed',
+                        metavar='',
+                        type=int,
+                        default=0,
+                        help='seed of the synthetic capture generator (default 0)')
+    parser.add_argument('-d', '--work-dir',
+                        metavar='',
+                        help='directory to write captures to (default a temporary directory)')
+    parser.add_argument('-o', '--output',
+                        metavar='',
+                        default='benchmark.json',
+                        help='JSON file the results are saved to (default benchmark.json)')
+    args = parser.parse_args()
+
+    if args.work_dir is None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = benchmark(args.packets, args.stages, work_dir, args.seed)
+    else:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = benchmark(args.packets, args.stages, args.work_dir, args.seed)
+
+    with open(args.output, 'w') as open_file:
+        json.dump(results, open_file, indent=2)
+    print(f'\nResults Saved as {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,59 +2,255 @@
    script uses regular expressions to find any emails
    in To: and From: fields of the TCP data of a packet
 
-   store lists of emails found in To: field and emails found in From: field
-   uses both list to create a table for all emails found and in what field
-   output generated with tabulate
+   TCP streams are reassembled so fields split between segments are found,
+   one compiled bytes regex finds every field in each complete line of a stream
+
+   store sets of emails found in To: field and emails found in From: field
+   uses both sets to create a table for all emails found and in what field
+   with a memory limit the sets are spill.SpillStores, spilled to sorted runs on disk
+   and joined at the end, giving the same rows as sets in memory
+   output generated with tabulate, or streamed as CSV or JSON, by table_writer
 """
 import regex as re
-from tabulate import tabulate
+from collections.abc import Iterable, Iterator
+from typing import Optional
+import dpkt
+import numpy as np
+from packet_view import IP_PROTO_TCP, PacketView
+from pcap_pipeline import Analyser, run_pipeline
+from pcap_profile import counters
+from spill import SpillStore, external_sorted
+from table_writer import pretty_table
+from tcp_streams import TCP_FIN, TCP_RST, TCP_SYN, StreamTable, TcpStream
+
+
+# regular expression to find emails in To: and From: fields
+# To/From: <{email}>
+EMAIL_REGEX = re.compile(rb'(From|To):.+<((?:[a-zA-Z0-9](?:[\.-])?)+@(?:[a-zA-Z0-9](?:[\.-])?)+[a-zA-Z0-9]+)>')
+
+# ports used by SMTP, submission, POP3 and IMAP
+MAIL_PORTS = (25, 587, 110, 143)
+# greetings SMTP, IMAP and POP3 servers start a connection with
+MAIL_BANNERS = (b'220 ', b'220-', b'* OK', b'+OK')
+
+# most bytes of an unfinished line kept for each stream
+MAX_LINE = 8192
+# bytes kept from the end of a line too long to keep, in case a field was split
+MAX_FIELD = 1024
+
+
+class EmailFinder(Analyser):
+    """
+    analyser searching reassembled TCP streams for email addresses in To: and From: fields
+    finish returns a table for all emails found and in what field
+    """
+    name = 'emails'
+
+    def __init__(self, mail_only: bool = False, idle_timeout: float = 120.0,
+                 max_streams: int = 65536, memory_limit: Optional[int] = None, spill_dir: Optional[str] = None):
+        """
+        :param mail_only: only search connections on mail ports or starting with a mail server banner
+        :param idle_timeout: seconds without a segment before a stream is evicted
+        :param max_streams: most streams being reassembled at once
+        :param memory_limit: bytes the emails may use before they are spilled to disk, None to keep them in memory
+        :param spill_dir: directory run files are made in, None for the system temporary directory
+        """
+        self.mail_only = mail_only
+        self.streams = StreamTable(idle_timeout, max_streams)
+        # sets to store emails found in each field, dict keys keep the order they were found in
+        self.emails_from: dict[str, None] = {}
+        self.emails_to: dict[str, None] = {}
+        if memory_limit is not None:
+            # each field gets half the limit
+            self.emails_from = SpillStore(memory_limit // 2, spill_dir)
+            self.emails_to = SpillStore(memory_limit // 2, spill_dir)
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        add the TCP data of a packet to its stream and search any complete lines for emails
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        # only TCP packets are decoded in full
+        if packet.proto != IP_PROTO_TCP:
+            return
+        # segments without data only matter when they start or end a stream,
+        # both are read from the headers so these segments are never decoded
+        if not packet.payload_length and not packet.flags & (TCP_SYN | TCP_FIN | TCP_RST):
+            return
+        if self.mail_only and not self._can_be_mail(packet):
+            return
+        ip = packet.eth.data
+        tcp = getattr(ip, 'data', None)
+        # packets without a TCP layer are skipped (e.g. ARP, UDP)
+        if not isinstance(tcp, dpkt.tcp.TCP):
+            return
+
+        key = (ip.src, ip.dst, tcp.sport, tcp.dport)
+        stream, data = self.streams.add(key, timestamp, tcp.seq, tcp.flags, tcp.data)
+        if data:
+            self._read(key, stream, data)
+
+        # search whatever is left of streams that have ended
+        if tcp.flags & (TCP_FIN | TCP_RST):
+            self._close(self.streams.remove(key), self.emails_from, self.emails_to)
+        for unused_key, evicted in self.streams.expire(timestamp):
+            self._close(evicted, self.emails_from, self.emails_to)
+
+    def _read(self, key: tuple, stream: TcpStream, data: bytes) -> None:
+        """
+        add data to a streams line buffer and search the complete lines
+        :param key: key of stream
+        :param stream: stream the data belongs to
+        :param data: data in sequence order
+        """
+        if self.mail_only and not self._is_mail(key, stream, data):
+            return
+
+        buffer = stream.buffer
+        buffer += data
+        # only search complete lines since a field can be split between segments
+        end = buffer.rfind(b'\n') + 1
+        if end:
+            search_emails(buffer[:end], self.emails_from, self.emails_to)
+            del buffer[:end]
+        elif len(buffer) > MAX_LINE:
+            search_emails(buffer, self.emails_from, self.emails_to)
+            del buffer[:-MAX_FIELD]
+
+    def _can_be_mail(self, packet: PacketView) -> bool:
+        """
+        check from the headers if a packet can be part of a mail connection, before it is decoded
+        either end uses a mail port, its stream is already being read, the other direction is mail,
+        or it starts a stream with a mail server banner
+        :param packet: lazy view of a TCP packet
+        :return: False if the packet cannot be part of a mail connection
+        """
+        if packet.sport in MAIL_PORTS or packet.dport in MAIL_PORTS:
+            return True
+        # IPv6 addresses are not read from the headers, so the stream cannot be looked up
+        if not packet.ipv4:
+            return True
+        key = (packet.src.to_bytes(4, 'big'), packet.dst.to_bytes(4, 'big'), packet.sport, packet.dport)
+        if key in self.streams.streams:
+            return True
+        reverse = self.streams.reverse(key)
+        return (reverse is not None and reverse.state is True) or packet.payload.startswith(MAIL_BANNERS)
+
+    def _is_mail(self, key: tuple, stream: TcpStream, data: bytes) -> bool:
+        """
+        check if a stream is part of a mail connection
+        either end uses a mail port, or either direction starts with a mail server banner
+        :param key: key of stream
+        :param stream: stream the data belongs to
+        :param data: data in sequence order
+        :return: True if the stream is part of a mail connection
+        """
+        reverse = self.streams.reverse(key)
+        if not stream.state:
+            stream.state = (key[2] in MAIL_PORTS or key[3] in MAIL_PORTS
+                            or (stream.delivered == len(data) and data.startswith(MAIL_BANNERS))
+                            or (reverse is not None and reverse.state is True))
+        # the other direction of a mail connection is also searched
+        if stream.state and reverse is not None:
+            reverse.state = True
+        return stream.state
+
+    def _close(self, stream: TcpStream, emails_from: dict, emails_to: dict) -> None:
+        """
+        search the data left in a stream that has ended
+        :param stream: stream that has ended
+        :param emails_from: set to add emails found in From: fields to
+        :param emails_to: set to add emails found in To: fields to
+        """
+        if stream is not None and (stream.state or not self.mail_only):
+            search_emails(stream.remaining(), emails_from, emails_to)
+
+    def found(self) -> tuple[dict, dict]:
+        """
+        emails found so far, including any in the unfinished lines of open streams
+        :return: (emails in From: fields, emails in To: fields) tuple of ordered sets, dicts or SpillStores
+        """
+        emails_from = self.emails_from.copy()
+        emails_to = self.emails_to.copy()
+        for stream in self.streams.streams.values():
+            self._close(stream, emails_from, emails_to)
+        return emails_from, emails_to
+
+    def wanted(self, records: np.ndarray) -> np.ndarray:
+        """
+        only TCP packets in a packet index need to be decoded
+        :param records: numpy structured array of packet index rows
+        :return: boolean mask of TCP packets
+        """
+        return records['proto'] == IP_PROTO_TCP
+
+    def options(self) -> tuple:
+        """
+        :return: whether only mail connections are searched
+        """
+        return (self.mail_only,)
+
+    def merge(self, other: 'EmailFinder') -> None:
+        """
+        add emails found in packets following this finders packets
+        streams are not joined across the two sets of packets
+        :param other: email finder fed the following packets
+        """
+        emails_from, emails_to = other.found()
+        self.emails_from.update(emails_from)
+        self.emails_to.update(emails_to)
+
+    def finish(self) -> str:
+        """
+        create a table do display all emails found
+        and which fields they were present in
+        :return: table for all emails found and in what field
+        """
+        emails_from, emails_to = self.found()
+        return pretty_table(EMAIL_HEADERS, email_rows(emails_from, emails_to), NO_EMAILS)
+
+
+def search_emails(data: bytes, emails_from: dict, emails_to: dict) -> None:
+    """
+    find every email in To: and From: fields of some TCP data
+    :param data: TCP data
+    :param emails_from: set to add emails found in From: fields to
+    :param emails_to: set to add emails found in To: fields to
+    """
+    counters['email_regex_searches'] += 1
+    # overlapped so a To: field after a From: field on the same line is also found
+    for match in EMAIL_REGEX.finditer(data, overlapped=True):
+        email = match.group(2).decode('ascii')
+        if match.group(1) == b'From':
+            emails_from[email] = None
+        else:
+            emails_to[email] = None
 
 
 def find_emails(packet_list: list[tuple]) -> str:
     """
     search TCP data for email addresses in To: and From: fields
-    keep lists of emails found in each field
+    keep sets of emails found in each field
 
     create a table do display all emails found
     and which fields they were present in
     :param packet_list: list of (packet_timestamp, packet_bytes) tuples
     :return: table for all emails found and in what field
     """
+    email_finder = EmailFinder()
+    run_pipeline(packet_list, [email_finder])
+    return email_finder.finish()
+
 
-    # lists to store emails found in each field
-    emails_from = []
-    emails_to = []
-
-    # regular expression strings to find emails in To: and From: field
-    # To/From: <{email}>
-    from_regex = r'From:.+<((?:[a-zA-Z0-9](?:[\.-])?)+@(?:[a-zA-Z0-9](?:[\.-])?)+[a-zA-Z0-9]+)>'
-    to_regex = r'To:.+<((?:[a-zA-Z0-9](?:[\.-])?)+@(?:[a-zA-Z0-9](?:[\.-])?)+[a-zA-Z0-9]+)>'
-
-    for (unused_timestamp, eth) in packet_list:
-        ip = eth.data
-        try:
-            protocol = ip.p
-            # check if protocol is TCP
-            if protocol == 6:
-                tcp = ip.data
-                decoded_tcp_data = tcp.data.decode('utf-8', errors='replace')
-
-                # search tcp data for emails in From: field
-                match = re.search(from_regex, decoded_tcp_data)
-                # if emails has not been found before add to list
-                if match and match.group(1) not in emails_from:
-                    emails_from.append(match.group(1))
-
-                # search tcp data for emails in To: field
-                match = re.search(to_regex, decoded_tcp_data)
-                # if emails has not been found before add to list
-                if match and match.group(1) not in emails_to:
-                    emails_to.append(match.group(1))
-        # packets without ip layer are skipped (e.g. ARP)
-        except AttributeError:
-            continue
-
-    return build_email_table(emails_from, emails_to)
+# column headers of the email table
+EMAIL_HEADERS = ['Email Address',
+                 'In From:',
+                 'In To:'
+                 ]
+
+# printed instead of an email table with no rows
+NO_EMAILS = '[!] No Email Addresses Found!'
 
 
 def build_email_table(emails_from: list[str], emails_to: list[str]) -> str:
@@ -65,21 +261,8 @@ def build_email_table(emails_from: list[str], emails_to: list[str]) -> str:
     :param emails_to: list of emails in To: field
     :return: table for unique emails found and fields it was found in
     """
-    # list of headers for table
-    headers = ['Email Address',
-               'In From:',
-               'In To:'
-               ]
-
-    # create list of rows for the table
-    rows = create_rows(emails_from, emails_to)
-
     # if no emails are found rows will be empty
-    if not rows:
-        return '[!] No Email Addresses Found!'
-
-    # return table of emails found
-    return tabulate(rows, headers, tablefmt='pretty')
+    return pretty_table(EMAIL_HEADERS, create_rows(emails_from, emails_to), NO_EMAILS)
 
 
 def create_rows(emails_from: list, emails_to: list) -> list[tuple]:
@@ -89,32 +272,66 @@ def create_rows(emails_from: list, emails_to: list) -> list[tuple]:
     :param emails_to: list of emails found in To: field
     :return: list of rows with email and fields it was found in
     """
-    rows = []
     yes = 'Y'
     no = 'N'
     # possible row configurations
     # (email, 'Y', 'N') only in From:
     # (email, 'N', 'Y') only in To:
     # (email, 'Y', 'Y') in To: and From:
+    in_from = set(emails_from)
+    in_to = set(emails_to)
 
-    # loop through emails found in From: field
-    for email in emails_from:
-        rows.append((email, yes, no))
-
-    # loop through emails found in To: field
-    for email in emails_to:
-        for row_num, row in enumerate(rows):
-            # if email already has a row both values are ✔
-            if email == row[0]:
-                rows[row_num] = (email, yes, yes)
-                index = emails_to.index(email)
-                # set email to None, so it isn't duplicated in next step
-                emails_to[index] = None
-
-    # loop through emails found in To: field
-    for email in emails_to:
-        # if email has not been set to None it was only present in emails_to
-        if email:
-            rows.append((email, no, yes))
+    # one row for each email found in From: field
+    rows = [(email, yes, yes if email in in_to else no) for email in emails_from]
+    # followed by emails only present in To: field
+    rows.extend((email, no, yes) for email in emails_to if email not in in_from)
 
     return rows
+
+
+def email_rows(emails_from, emails_to) -> Iterable[tuple]:
+    """
+    rows of the email table from the ordered sets found, in the same order as create_rows
+    :param emails_from: ordered set of emails found in From: field, a dict or SpillStore
+    :param emails_to: ordered set of emails found in To: field, a dict or SpillStore
+    :return: list of rows with email and fields it was found in, or a generator for spilled sets
+    """
+    if isinstance(emails_from, SpillStore) and (emails_from.spilled or emails_to.spilled):
+        return spilled_rows(emails_from, emails_to)
+    return create_rows(list(emails_from), list(emails_to))
+
+
+def spilled_rows(emails_from: SpillStore, emails_to: SpillStore) -> Iterator[tuple]:
+    """
+    join two spilled sets of emails by walking both in email order,
+    then sort the rows back into the order of create_rows within the memory limit
+    :param emails_from: set of emails found in From: field
+    :param emails_to: set of emails found in To: field
+    :return: generator of rows with email and fields it was found in
+    """
+    yes = 'Y'
+    no = 'N'
+    # (email, position first found) in email order
+    found_from = ((email, position) for email, position, unused_value in emails_from.records())
+    found_to = ((email, position) for email, position, unused_value in emails_to.records())
+
+    def joined():
+        # (0, position in From:, row) for emails found in From: field,
+        # (1, position in To:, row) for emails only present in To: field
+        email_to, position_to = next(found_to, (None, None))
+        for email, position in found_from:
+            while email_to is not None and email_to < email:
+                yield 1, position_to, (email_to, no, yes)
+                email_to, position_to = next(found_to, (None, None))
+            if email_to == email:
+                yield 0, position, (email, yes, yes)
+                email_to, position_to = next(found_to, (None, None))
+            else:
+                yield 0, position, (email, yes, no)
+        while email_to is not None:
+            yield 1, position_to, (email_to, no, yes)
+            email_to, position_to = next(found_to, (None, None))
+
+    for unused_field, unused_position, row in external_sorted(joined(), emails_from.max_bytes,
+                                                              emails_from.directory, key=lambda item: item[:2]):
+        yield row
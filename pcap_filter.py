@@ -0,0 +1,350 @@
+"""pcap_filter.py
+   script to compile a capture filter expression into a predicate over the raw bytes of a packet
+   packets are filtered as they are read, before any header decoding or dpkt objects
+
+   expressions are a subset of the tcpdump (BPF) filter syntax:
+     [src|dst] host ADDRESS     IPv4 or IPv6 address
+     [src|dst] net CIDR         e.g. net 10.1.0.0/16
+     [src|dst] port PORT        TCP or UDP port number or service name, e.g. port 25, port smtp
+     ip, ip6, arp, tcp, udp, icmp, proto N or proto \\NAME (tcp, udp, icmp), e.g. ip proto 17
+     after TIME, before TIME    timestamp as seconds since the epoch or an ISO date and time in UTC
+     vlan [ID]                  802.1Q/802.1ad tagged frames, optionally with a VLAN ID
+   joined with and/&&, or/||, not/! and parentheses
+
+   like tcpdump, header offsets are those of an untagged ethernet frame
+   and each vlan keyword moves the offsets of the primitives after it past one tag,
+   e.g. 'vlan and tcp port 25' for tagged mail traffic
+   IPv4 ports follow the IP options, IPv6 ports must follow the fixed IPv6 header
+   and fragments after the first never match a port
+
+   the expression is compiled to the source of one Python function made of slice comparisons,
+   so a rejected packet costs a few byte comparisons
+"""
+import ipaddress
+import math
+import re
+import socket
+from collections.abc import Callable
+from datetime import datetime, timezone
+from functools import lru_cache
+
+# offset of the first byte after the ethernet header
+ETH_HEADER_SIZE = 14
+
+# ethernet frame types, as bytes before the network layer
+_ETH_TYPE = {'ip': b'\x08\x00', 'ip6': b'\x86\xdd', 'arp': b'\x08\x06'}
+_ETH_TYPE_VLAN = (b'\x81\x00', b'\x88\xa8', b'\x91\x00')
+
+# protocols that can be named: (IPv4 protocol number, IPv6 next header)
+_PROTOCOLS = {'tcp': (6, 6), 'udp': (17, 17), 'icmp': (1, 58)}
+
+_TOKEN = re.compile(r'\s*(&&|\|\||[()!]|[^\s()!&|]+)')
+
+Predicate = Callable[[float, bytes], bool]
+
+
+def tokenise(expression: str) -> list[str]:
+    """
+    split a filter expression into words, operators and parentheses
+    :param expression: filter expression
+    :return: list of tokens
+    """
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError(f'invalid filter: cannot read {expression[position:]!r}')
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class FilterParser:
+    """
+    recursive descent parser turning filter tokens into a Python expression
+    over b (the packet bytes), n (its length) and timestamp
+    """
+
+    def __init__(self, tokens: list[str]):
+        """
+        :param tokens: tokens from tokenise
+        """
+        self.tokens = tokens
+        self.position = 0
+        # offset of the network layer, moved past a tag by each vlan keyword
+        self.base = ETH_HEADER_SIZE
+
+    def peek(self):
+        """
+        :return: next token, None at the end of the expression
+        """
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self) -> str:
+        """
+        :return: next token, moving past it
+        """
+        token = self.peek()
+        if token is None:
+            raise ValueError('invalid filter: expression ends too soon')
+        self.position += 1
+        return token
+
+    def parse(self) -> str:
+        """
+        :return: Python expression for the whole filter
+        """
+        expression = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f'invalid filter: unexpected {self.peek()!r}')
+        return expression
+
+    def parse_or(self) -> str:
+        """
+        :return: Python expression for terms joined by or
+        """
+        terms = [self.parse_and()]
+        while self.peek() in ('or', '||'):
+            self.take()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else f'({" or ".join(terms)})'
+
+    def parse_and(self) -> str:
+        """
+        :return: Python expression for factors joined by and
+        """
+        factors = [self.parse_not()]
+        while self.peek() in ('and', '&&'):
+            self.take()
+            factors.append(self.parse_not())
+        return factors[0] if len(factors) == 1 else f'({" and ".join(factors)})'
+
+    def parse_not(self) -> str:
+        """
+        :return: Python expression for a negated factor, bracketed expression or primitive
+        """
+        token = self.peek()
+        if token in ('not', '!'):
+            self.take()
+            return f'(not {self.parse_not()})'
+        if token == '(':
+            self.take()
+            expression = self.parse_or()
+            if self.take() != ')':
+                raise ValueError('invalid filter: missing )')
+            return expression
+        return self.parse_primitive()
+
+    def parse_primitive(self) -> str:
+        """
+        :return: Python expression for one primitive, e.g. src host 10.0.0.1
+        """
+        token = self.take().lower()
+        direction = None
+        if token in ('src', 'dst'):
+            direction = token
+            token = self.take().lower()
+
+        if token == 'host':
+            return host_test(self.take(), direction, self.base)
+        if token == 'net':
+            return net_test(self.take(), direction, self.base)
+        if token == 'port':
+            return port_test(self.take(), direction, self.base)
+        if direction is not None:
+            raise ValueError(f'invalid filter: {direction} must be followed by host, net or port')
+
+        if token in _ETH_TYPE or token in _PROTOCOLS:
+            if token in _PROTOCOLS:
+                test = protocol_test(*_PROTOCOLS[token], self.base)
+            else:
+                test = eth_type_test(token, self.base)
+            # a protocol can qualify the primitive after it, e.g. tcp port 25
+            if self.peek() in ('src', 'dst', 'host', 'net', 'port', 'proto'):
+                return f'({test} and {self.parse_primitive()})'
+            return test
+        if token == 'proto':
+            number = self.take()
+            # a protocol name is escaped with a backslash, e.g. proto \tcp
+            if number is not None and number.lstrip('\\') in _PROTOCOLS:
+                return protocol_test(*_PROTOCOLS[number.lstrip('\\')], self.base)
+            if number is None or not number.isdigit() or int(number) > 255:
+                raise ValueError(f'invalid filter: bad protocol number {number!r}')
+            return protocol_test(int(number), int(number), self.base)
+        if token == 'vlan':
+            test = vlan_test(self.base)
+            if self.peek() is not None and self.peek().isdigit():
+                vlan_id = int(self.take())
+                if vlan_id > 4095:
+                    raise ValueError(f'invalid filter: bad VLAN ID {vlan_id}')
+                test = f'({test} and b[{self.base}] & 15 == {vlan_id >> 8} and b[{self.base + 1}] == {vlan_id & 0xff})'
+            self.base += 4
+            return test
+        if token == 'after':
+            return f'timestamp >= {parse_time(self.take())!r}'
+        if token == 'before':
+            return f'timestamp < {parse_time(self.take())!r}'
+        raise ValueError(f'invalid filter: unknown primitive {token!r}')
+
+
+def eth_type_test(name: str, base: int) -> str:
+    """
+    :param name: 'ip', 'ip6' or 'arp'
+    :param base: offset of the network layer
+    :return: Python expression matching frames of the type long enough to hold its header
+    """
+    header_size = {'ip': 20, 'ip6': 40, 'arp': 0}[name]
+    return f'(n >= {base + header_size} and b[{base - 2}:{base}] == {_ETH_TYPE[name]!r})'
+
+
+def vlan_test(base: int) -> str:
+    """
+    :param base: offset of the network layer before the tag
+    :return: Python expression matching frames with a VLAN tag
+    """
+    return f'(n >= {base + 4} and b[{base - 2}:{base}] in {_ETH_TYPE_VLAN!r})'
+
+
+def host_test(address: str, direction, base: int) -> str:
+    """
+    :param address: IPv4 or IPv6 address
+    :param direction: 'src', 'dst' or None for either
+    :param base: offset of the network layer
+    :return: Python expression matching packets to or from the address
+    """
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        raise ValueError(f'invalid filter: bad host address {address!r}') from None
+    return net_test(str(ipaddress.ip_network(address)), direction, base)
+
+
+def net_test(network: str, direction, base: int) -> str:
+    """
+    compare the whole bytes of the network prefix, then the bits left over in the next byte
+    :param network: network in CIDR notation, or an address for a single host
+    :param direction: 'src', 'dst' or None for either
+    :param base: offset of the network layer
+    :return: Python expression matching packets to or from the network
+    """
+    try:
+        network = ipaddress.ip_network(network, strict=False)
+    except ValueError:
+        raise ValueError(f'invalid filter: bad network {network!r}') from None
+
+    if network.version == 4:
+        family, offsets = eth_type_test('ip', base), {'src': base + 12, 'dst': base + 16}
+    else:
+        family, offsets = eth_type_test('ip6', base), {'src': base + 8, 'dst': base + 24}
+    prefix = network.network_address.packed
+    whole, bits = divmod(network.prefixlen, 8)
+
+    tests = []
+    for name in ('src', 'dst'):
+        if direction not in (None, name):
+            continue
+        offset = offsets[name]
+        parts = []
+        if whole:
+            parts.append(f'b[{offset}:{offset + whole}] == {prefix[:whole]!r}')
+        if bits:
+            mask = (0xff << (8 - bits)) & 0xff
+            parts.append(f'b[{offset + whole}] & {mask} == {prefix[whole]}')
+        tests.append(' and '.join(parts) or 'True')
+    match = tests[0] if len(tests) == 1 else ' or '.join(f'({test})' for test in tests)
+    return f'({family} and ({match}))'
+
+
+def port_test(port: str, direction, base: int) -> str:
+    """
+    :param port: TCP/UDP port number or service name
+    :param direction: 'src', 'dst' or None for either
+    :param base: offset of the network layer
+    :return: Python expression matching TCP/UDP packets from or to the port
+    """
+    if port.isdigit():
+        number = int(port)
+    else:
+        try:
+            number = socket.getservbyname(port)
+        except OSError:
+            raise ValueError(f'invalid filter: unknown port {port!r}') from None
+    if number > 65535:
+        raise ValueError(f'invalid filter: bad port {port!r}')
+    value = number.to_bytes(2, 'big')
+
+    # only TCP/UDP packets that are not a later fragment have ports,
+    # IPv4 ports follow any IP options
+    ip_ports = f'b[{base + 9}] in (6, 17) and not b[{base + 6}] & 0x1f and not b[{base + 7}]'
+    ip6_ports = f'b[{base + 6}] in (6, 17)'
+    tests = []
+    for family, ports, start in ((eth_type_test('ip', base), ip_ports, f'{base} + (b[{base}] & 15) * 4'),
+                                 (eth_type_test('ip6', base), ip6_ports, f'{base + 40}')):
+        # sport is the first two bytes of the TCP/UDP header, dport the next two
+        compare = []
+        if direction in (None, 'src'):
+            compare.append(f'b[{start}:{start} + 2] == {value!r}')
+        if direction in (None, 'dst'):
+            compare.append(f'b[{start} + 2:{start} + 4] == {value!r}')
+        tests.append(f'({family} and {ports} and ({" or ".join(compare)}))')
+    return f'({" or ".join(tests)})'
+
+
+def protocol_test(ip_proto: int, ip6_next_header: int, base: int) -> str:
+    """
+    :param ip_proto: IPv4 protocol number
+    :param ip6_next_header: IPv6 next header number
+    :param base: offset of the network layer
+    :return: Python expression matching IPv4 and IPv6 packets of the protocol
+    """
+    return (f'(({eth_type_test("ip", base)} and b[{base + 9}] == {ip_proto}) or '
+            f'({eth_type_test("ip6", base)} and b[{base + 6}] == {ip6_next_header}))')
+
+
+def parse_time(value: str) -> float:
+    """
+    :param value: seconds since the epoch, or an ISO date and time e.g. 2019-02-12T19:33:25,
+                  read as UTC unless it has a UTC offset
+    :return: seconds since the epoch
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date_time = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f'invalid time {value!r}') from None
+        # times are read in UTC like the timestamps printed in the tables, not the zone of the machine
+        if date_time.tzinfo is None:
+            date_time = date_time.replace(tzinfo=timezone.utc)
+        seconds = date_time.timestamp()
+    # the time is written into the predicate source as a number
+    if not math.isfinite(seconds):
+        raise ValueError(f'invalid time {value!r}')
+    return seconds
+
+
+def filter_source(expression: str) -> str:
+    """
+    :param expression: filter expression
+    :return: Python source of the predicate function for the expression
+    """
+    test = FilterParser(tokenise(expression)).parse()
+    return (f'def predicate(timestamp, b):\n'
+            f'    n = len(b)\n'
+            f'    return bool({test})\n')
+
+
+@lru_cache(maxsize=16)
+def compile_filter(expression: str) -> Predicate:
+    """
+    compile a filter expression into a predicate
+    :param expression: filter expression, e.g. 'tcp port 25 and net 10.1.0.0/16'
+    :return: function taking (timestamp, packet bytes) returning True for packets to keep
+    """
+    namespace = {}
+    # only numbers and bytes from the parsed expression are written into the source
+    exec(compile(filter_source(expression), f'<filter {expression!r}>', 'exec'), namespace)
+    return namespace['predicate']
@@ -0,0 +1,319 @@
+"""pcap_flows.py
+   script to follow the flows (connections) in a packet capture
+   and find the flows with the most bytes and the longest flows
+
+   each flow is both directions of a 5-tuple (source IP, destination IP, source port,
+   destination port, protocol) with packets and bytes each way, first and last packet,
+   duration, mean time between packets and the TCP flags seen
+
+   flows are kept in a flow_table.FlowTable, finished flows are handed to a sink as they end,
+   only the top flows are kept in memory and every flow can be streamed to a CSV or JSON lines file
+   output generated with tabulate, or streamed as CSV or JSON, by table_writer
+"""
+import csv
+import json
+from array import array
+from datetime import datetime, timedelta
+from typing import Optional, TextIO
+import numpy as np
+from flow_table import FLOW_DTYPE, FlowTable
+from packet_view import ETH_TYPE_IP, IP_PROTO_TCP, IP_PROTO_UDP, PacketView
+from pcap_index import PacketIndex
+from pcap_pipeline import Analyser, run_pipeline
+from table_writer import field_name, write_table
+
+# number of packets buffered by FlowTracker.feed before they are added together
+BATCH_SIZE = 65536
+
+# number of flows in each top flows table
+TOP_FLOWS = 10
+
+# names of the protocols shown instead of their number
+PROTOCOL_NAMES = {1: 'ICMP', IP_PROTO_TCP: 'TCP', IP_PROTO_UDP: 'UDP'}
+
+# names of the TCP flags, lowest bit first
+TCP_FLAG_NAMES = ('FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG', 'ECE', 'CWR')
+
+FLOW_HEADERS = ['Source',
+                'Destination',
+                'Protocol',
+                'Packets',
+                'Bytes',
+                'Reverse Packets',
+                'Reverse Bytes',
+                'Start',
+                'Duration',
+                'Mean Inter-arrival',
+                'TCP Flags']
+
+
+class FlowWriter:
+    """
+    sink writing every finished flow to a file as it is handed over,
+    as JSON lines for a name ending in .jsonl, otherwise as CSV
+    """
+
+    def __init__(self, file_name: str):
+        """
+        :param file_name: name of file, created when the first flows are written
+        """
+        self.file_name = file_name
+        self._file: Optional[TextIO] = None
+
+    def write(self, flows: np.ndarray) -> None:
+        """
+        write finished flows
+        :param flows: numpy structured array of FLOW_DTYPE rows
+        """
+        fields = [field_name(header) for header in FLOW_HEADERS]
+        if self._file is None:
+            self._file = open(self.file_name, 'w', newline='')
+            if not self.file_name.endswith('.jsonl'):
+                csv.writer(self._file, lineterminator='\n').writerow(fields)
+
+        if self.file_name.endswith('.jsonl'):
+            for row in flow_rows(flows):
+                self._file.write(json.dumps(dict(zip(fields, row))))
+                self._file.write('\n')
+        else:
+            csv.writer(self._file, lineterminator='\n').writerows(flow_rows(flows))
+
+    def close(self) -> None:
+        """
+        close the file, if any flows were written
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FlowTracker(Analyser):
+    """
+    analyser following the IPv4 flows in a capture in a FlowTable
+    finish returns the flows with the most bytes and the longest flows
+    """
+    name = 'flows'
+
+    def __init__(self, top: int = TOP_FLOWS, idle_timeout: float = 120.0, active_timeout: float = 1800.0,
+                 out_file: Optional[str] = None):
+        """
+        :param top: number of flows in each top flows table
+        :param idle_timeout: seconds without a packet before a flow ends
+        :param active_timeout: seconds after which a flow still going is handed out and started again
+        :param out_file: file to write every flow to as it finishes, None to only keep the top flows
+        """
+        self.top = top
+        self.out_file = out_file
+        self.table = FlowTable(idle_timeout, active_timeout)
+        # number of flows finished
+        self.flows = 0
+        self.top_bytes = np.zeros(0, dtype=FLOW_DTYPE)
+        self.top_duration = np.zeros(0, dtype=FLOW_DTYPE)
+        # finished flows that may carry on from packets before this trackers packets,
+        # held until they are merged or the tracker finishes
+        self.heads = np.zeros(0, dtype=FLOW_DTYPE)
+        self._writer: Optional[FlowWriter] = None
+        # packets waiting to be added to the table
+        self._columns = {'timestamps': array('d'), 'lengths': array('d'),
+                         'src': array('L'), 'dst': array('L'), 'sport': array('H'), 'dport': array('H'),
+                         'proto': array('h'), 'flags': array('B')}
+
+    def __getstate__(self) -> dict:
+        # an open file cannot be copied to another process
+        state = self.__dict__.copy()
+        state['_writer'] = None
+        return state
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        buffer the header fields of an IPv4 packet, added to the table once BATCH_SIZE are buffered
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        # skip non-IPv4 packets
+        if not packet.ipv4:
+            return
+
+        columns = self._columns
+        columns['timestamps'].append(timestamp)
+        columns['lengths'].append(len(packet))
+        columns['src'].append(packet.src)
+        columns['dst'].append(packet.dst)
+        columns['sport'].append(packet.sport)
+        columns['dport'].append(packet.dport)
+        columns['proto'].append(packet.proto)
+        columns['flags'].append(packet.flags)
+        if len(columns['timestamps']) >= BATCH_SIZE:
+            self._flush()
+
+    def feed_index(self, index: PacketIndex) -> None:
+        """
+        add IPv4 packets to their flows using the packet index columns
+        :param index: packet index of the pcap file
+        """
+        self._flush()
+        records = index.records
+        # skip non-IPv4 packets
+        ipv4 = records[(records['ethertype'] == ETH_TYPE_IP) & (records['proto'] >= 0)]
+        self._finished(self.table.add(ipv4['timestamp'], ipv4['length'], ipv4['src'], ipv4['dst'],
+                                      ipv4['sport'], ipv4['dport'], ipv4['proto'], ipv4['flags']))
+
+    def _flush(self) -> None:
+        """
+        add the packets buffered by feed to the table
+        """
+        columns = self._columns
+        if not columns['timestamps']:
+            return
+        arrays = [np.array(column) for column in columns.values()]
+        self._finished(self.table.add(*arrays))
+        for column in columns.values():
+            del column[:]
+
+    def _finished(self, flows: np.ndarray) -> None:
+        """
+        hold finished flows that may carry on from packets before this trackers packets, emit the others
+        :param flows: numpy structured array of FLOW_DTYPE rows
+        """
+        held = flows['start'] <= self.table.first + self.table.idle_timeout if len(flows) else np.zeros(0, bool)
+        self.heads = np.concatenate((self.heads, flows[held]))
+        self._emit(flows[~held])
+
+    def _emit(self, flows: np.ndarray) -> None:
+        """
+        hand finished flows to the top flows tables and the flow file
+        :param flows: numpy structured array of FLOW_DTYPE rows
+        """
+        if not len(flows):
+            return
+        self.flows += len(flows)
+        self.top_bytes = top_flows(np.concatenate((self.top_bytes, flows)), flow_bytes, self.top)
+        self.top_duration = top_flows(np.concatenate((self.top_duration, flows)), flow_duration, self.top)
+        if self.out_file is not None:
+            if self._writer is None:
+                self._writer = FlowWriter(self.out_file)
+            self._writer.write(flows)
+
+    def options(self) -> tuple:
+        """
+        :return: flow timeouts
+        """
+        return self.table.idle_timeout, self.table.active_timeout
+
+    def merge(self, other: 'FlowTracker') -> None:
+        """
+        add the flows of a tracker fed the following packets to this tracker,
+        flows going when this trackers packets end carry on into the other trackers flows
+        :param other: tracker fed the following packets
+        """
+        self._flush()
+        other._flush()
+        self._finished(self.table.merge(other.table, other.heads))
+        self.flows += other.flows
+        self.top_bytes = top_flows(np.concatenate((self.top_bytes, other.top_bytes)), flow_bytes, self.top)
+        self.top_duration = top_flows(np.concatenate((self.top_duration, other.top_duration)),
+                                      flow_duration, self.top)
+
+    def finish(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        end every flow still going
+        :return: (flows with the most bytes, longest flows) tuple of FLOW_DTYPE arrays
+        """
+        self._flush()
+        self._emit(self.heads)
+        self.heads = np.zeros(0, dtype=FLOW_DTYPE)
+        self._emit(self.table.close())
+        if self._writer is not None:
+            self._writer.close()
+        return self.top_bytes, self.top_duration
+
+
+def flow_bytes(flows: np.ndarray) -> np.ndarray:
+    """
+    :param flows: numpy structured array of FLOW_DTYPE rows
+    :return: bytes sent both ways in each flow
+    """
+    return flows['bytes'] + flows['reverse_bytes']
+
+
+def flow_duration(flows: np.ndarray) -> np.ndarray:
+    """
+    :param flows: numpy structured array of FLOW_DTYPE rows
+    :return: seconds from the first to the last packet of each flow
+    """
+    return flows['end'] - flows['start']
+
+
+def top_flows(flows: np.ndarray, key, number: int) -> np.ndarray:
+    """
+    :param flows: numpy structured array of FLOW_DTYPE rows
+    :param key: function giving the value of each flow to rank by, e.g. flow_bytes
+    :param number: number of flows kept
+    :return: the number flows with the highest value, highest first, earlier flows first on a tie
+    """
+    order = np.lexsort((flows['start'], -key(flows)))
+    return flows[order[:number]]
+
+
+def endpoint(address: int, port: int, proto: int) -> str:
+    """
+    :param address: IPv4 address as an integer
+    :param port: TCP/UDP port
+    :param proto: IP protocol
+    :return: address, followed by the port for TCP and UDP
+    """
+    ip_address = '.'.join(str(address >> shift & 0xff) for shift in (24, 16, 8, 0))
+    return f'{ip_address}:{port}' if proto in (IP_PROTO_TCP, IP_PROTO_UDP) else ip_address
+
+
+def tcp_flags(flags: int) -> str:
+    """
+    :param flags: TCP flags
+    :return: names of the flags set, e.g. SYN,ACK
+    """
+    return ','.join(name for bit, name in enumerate(TCP_FLAG_NAMES) if flags >> bit & 1)
+
+
+def flow_rows(flows: np.ndarray):
+    """
+    :param flows: numpy structured array of FLOW_DTYPE rows
+    :return: generator of a FLOW_HEADERS row for each flow
+    """
+    for (src, dst, sport, dport, proto, packets, size, reverse_packets, reverse_size,
+         start, end, flags) in flows.tolist():
+        duration = end - start
+        gaps = packets + reverse_packets - 1
+        yield [endpoint(src, sport, proto),
+               endpoint(dst, dport, proto),
+               PROTOCOL_NAMES.get(proto, str(proto)),
+               packets,
+               size,
+               reverse_packets,
+               reverse_size,
+               str(datetime(1970, 1, 1) + timedelta(microseconds=round(start * 1E6))),
+               round(duration, 6),
+               round(duration / gaps, 6) if gaps else 0,
+               tcp_flags(flags)]
+
+
+def print_top_flows(top_bytes: np.ndarray, top_duration: np.ndarray, output_format: str = 'pretty') -> None:
+    """
+    Prints the flows with the most bytes and the longest flows
+    :param top_bytes: flows with the most bytes, from FlowTracker.finish
+    :param top_duration: longest flows, from FlowTracker.finish
+    :param output_format: format of the tables, one of table_writer.FORMATS
+    """
+    write_table('top_flows_by_bytes', FLOW_HEADERS, flow_rows(top_bytes), output_format, empty='No IPv4 flows')
+    write_table('top_flows_by_duration', FLOW_HEADERS, flow_rows(top_duration), output_format,
+                empty='No IPv4 flows')
+
+
+def find_flows(packet_list: list[tuple], top: int = TOP_FLOWS) -> None:
+    """
+    Prints the flows with the most bytes and the longest flows in a list of packets
+    :param packet_list: list of (packet_timestamp, packet_bytes) tuples
+    :param top: number of flows in each table
+    """
+    flow_tracker = FlowTracker(top)
+    run_pipeline(packet_list, [flow_tracker])
+    print_top_flows(*flow_tracker.finish())
@@ -0,0 +1,228 @@
+"""pcap_follow.py
+   script to follow a pcap file that is still being written (e.g. by tcpdump -w)
+   new records are read as they are completed, partly written records are read again later
+   when the file is rotated or truncated the new file is read from its start
+
+   packets are fed to a ring of time slices, each with its own set of analysers
+   slices older than the window are evicted so memory stays bounded however long it runs
+   reports merge the slices in the window without reading any packets again
+"""
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from typing import Optional
+from packet_view import PacketView
+from parse_pcap import FILE_HEADER_SIZE, pcap_header, read_records
+from pcap_pipeline import Analyser
+
+# number of time slices a window is split into
+WINDOW_SLICES = 60
+
+
+def follow_records(pcap_file: str, poll_interval: float = 1.0,
+                   predicate: Optional[Callable[[float, bytes], bool]] = None) -> Iterator[Optional[tuple]]:
+    """
+    read records from a pcap file forever, waiting for new records to be written
+    yields None each time there is no complete record to read, then sleeps
+    :param pcap_file: relative path to pcap file
+    :param poll_interval: seconds to wait for new records
+    :param predicate: compiled filter taking (timestamp, packet bytes), None to read every packet
+    :return: generator of (packet_timestamp, packet_view) tuples or None
+    """
+    open_file = None
+    try:
+        while True:
+            if open_file is None:
+                open_file, record_header, divisor = open_capture(pcap_file)
+                offset = FILE_HEADER_SIZE
+                # file not created yet, or its header is not written yet
+                if open_file is None:
+                    yield None
+                    time.sleep(poll_interval)
+                    continue
+
+            # start from the last complete record, an incomplete one is read again
+            open_file.seek(offset)
+            for (timestamp, buf) in read_records(open_file, record_header, divisor, offset):
+                offset += record_header.size + len(buf)
+                if predicate is None or predicate(timestamp, buf):
+                    yield timestamp, PacketView(buf)
+
+            # read the new file once every record of the old file has been read
+            if rotated(pcap_file, open_file, offset):
+                open_file.close()
+                open_file = None
+                continue
+
+            yield None
+            time.sleep(poll_interval)
+    finally:
+        if open_file is not None:
+            open_file.close()
+
+
+def open_capture(pcap_file: str) -> tuple:
+    """
+    open a pcap file and read its global header
+    :param pcap_file: relative path to pcap file
+    :return: (open file, record header struct, timestamp divisor) tuple,
+             (None, None, None) if the file does not exist or has no header yet
+    """
+    try:
+        open_file = open(pcap_file, 'rb')
+    except FileNotFoundError:
+        return None, None, None
+
+    header = open_file.read(FILE_HEADER_SIZE)
+    if len(header) < FILE_HEADER_SIZE:
+        open_file.close()
+        return None, None, None
+    try:
+        record_header, divisor = pcap_header(header)
+    except ValueError:
+        open_file.close()
+        raise
+    return open_file, record_header, divisor
+
+
+def rotated(pcap_file: str, open_file, offset: int) -> bool:
+    """
+    check if a pcap file has been replaced by a new file or truncated
+    :param pcap_file: relative path to pcap file
+    :param open_file: file being read
+    :param offset: offset after the last record read
+    :return: True if the file should be opened again
+    """
+    try:
+        status = os.stat(pcap_file)
+    # renamed away and not replaced yet, keep waiting on the old file
+    except FileNotFoundError:
+        return False
+    return status.st_ino != os.fstat(open_file.fileno()).st_ino or status.st_size < offset
+
+
+class WindowedAnalysers:
+    """
+    ring of time slices of the capture, each fed to its own set of analysers
+    slices that end before the window are evicted as newer packets arrive
+    """
+
+    def __init__(self, build_analysers: Callable[[], list[Analyser]], window: float, slice_length: float):
+        """
+        :param build_analysers: function creating a new set of analysers
+        :param window: seconds of packets kept, ending at the latest packet
+        :param slice_length: seconds of packets in each slice
+        """
+        self.build_analysers = build_analysers
+        self.window = window
+        self.slice_length = slice_length
+        # slice number: analysers, oldest first
+        self.slices: OrderedDict = OrderedDict()
+        # timestamp slices are counted from
+        self.origin: Optional[float] = None
+        self.packets = 0
+        self._current = None
+        self._feeds = []
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        feed a packet to the analysers of its time slice
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        if self.origin is None:
+            self.origin = timestamp
+        number = int((timestamp - self.origin) // self.slice_length)
+
+        if number != self._current:
+            # packets from slices already evicted are counted in the current slice
+            if number in self.slices or self._current is None or number > self._current:
+                self._start(number)
+
+        for feed in self._feeds:
+            feed(timestamp, packet)
+        self.packets += 1
+
+    def _start(self, number: int) -> None:
+        """
+        switch to the analysers of a slice, creating the slice if it is new
+        and evicting slices that end before the window
+        :param number: slice number
+        """
+        if number not in self.slices:
+            analysers = self.build_analysers()
+            # every analyser in a slice measures time from the start of the slice
+            for analyser in analysers:
+                analyser.begin(self.slice_start(number))
+            self.slices[number] = analysers
+
+            # evict slices ending before the window of the newest slice
+            newest = max(self.slices)
+            for old in [old for old in self.slices if (newest - old) * self.slice_length >= self.window]:
+                del self.slices[old]
+
+        self._current = number
+        self._feeds = [analyser.feed for analyser in self.slices[number]]
+
+    def slice_start(self, number: int) -> float:
+        """
+        :param number: slice number
+        :return: timestamp the slice starts at
+        """
+        return self.origin + number * self.slice_length
+
+    def merged(self) -> list[Analyser]:
+        """
+        merge the slices in the window into one new set of analysers, oldest slice first
+        :return: analysers holding the state of every packet in the window
+        """
+        analysers = self.build_analysers()
+        if not self.slices:
+            return analysers
+
+        for analyser in analysers:
+            analyser.begin(self.slice_start(min(self.slices)))
+        for number in sorted(self.slices):
+            for analyser, slice_analyser in zip(analysers, self.slices[number]):
+                analyser.merge(slice_analyser)
+        return analysers
+
+
+def slice_length(window: float, time_interval: float, slices: int = WINDOW_SLICES) -> float:
+    """
+    length of the slices a window is split into, a whole number of time intervals
+    so time interval groups of each slice line up when the slices are merged
+    :param window: seconds of packets kept
+    :param time_interval: seconds in each time interval group
+    :param slices: number of slices to split the window into
+    :return: seconds of packets in each slice
+    """
+    return max(1, -(-window // (slices * time_interval))) * time_interval
+
+
+def follow(pcap_file: str, windowed: WindowedAnalysers, report: Callable[[list[Analyser]], None],
+           refresh: float = 10.0, poll_interval: float = 1.0,
+           predicate: Optional[Callable[[float, bytes], bool]] = None) -> None:
+    """
+    feed records to windowed analysers as they are written to a pcap file
+    and report on the packets in the window every refresh seconds, until interrupted
+    :param pcap_file: relative path to pcap file
+    :param windowed: analysers to feed the packets to
+    :param report: function called with the merged analysers of the window
+    :param refresh: seconds between reports
+    :param poll_interval: seconds to wait for new records
+    :param predicate: compiled filter taking (timestamp, packet bytes), None to read every packet
+    """
+    next_report = time.monotonic() + refresh
+    try:
+        for record in follow_records(pcap_file, poll_interval, predicate):
+            if record is not None:
+                windowed.feed(*record)
+            # time is only checked every so often while records keep arriving
+            if (record is None or windowed.packets % 1024 == 0) and time.monotonic() >= next_report:
+                report(windowed.merged())
+                next_report = time.monotonic() + refresh
+    # stop following with ctrl-c, reporting the packets read since the last report
+    except KeyboardInterrupt:
+        report(windowed.merged())
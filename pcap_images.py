@@ -1,55 +1,375 @@
 """pcap_images.py
    script to find image files present in http requests
    uses regular expression to identify image files
-   stores the images and their URIs in lists and create a table
-   output generated with tabulate
+   stores the images and their URIs in an ordered set and create a table
+   with a memory limit the ordered set is a spill.SpillStore, spilled to sorted runs on disk
+   and merged at the end, giving the same rows as a set in memory
+   output generated with tabulate, or streamed as CSV or JSON, by table_writer
+
+   request and response heads are reassembled from TCP segments and matched with
+   bytes regular expressions, segments not starting a message are skipped before any parsing
+   responses with an image Content-Type or image magic bytes also add the URI requested,
+   bodies are skipped by their Content-Length so pipelined responses are paired with their own request
+   and a request after a body is still read
 """
 import regex as re
 import os
+from collections import deque
+from collections.abc import Iterable
+from typing import Optional
 import dpkt
-from tabulate import tabulate
+import numpy as np
+from packet_view import PacketView
+from pcap_pipeline import Analyser, run_pipeline
+from pcap_profile import counters
+from spill import SpillStore
+from table_writer import pretty_table
+from tcp_streams import TCP_FIN, TCP_RST, StreamTable, TcpStream
+
+# request methods dpkt.http.Request accepts
+HTTP_METHODS = (b'GET', b'PUT', b'ICY', b'COPY', b'HEAD', b'LOCK', b'MOVE', b'POLL', b'POST',
+                b'BCOPY', b'BMOVE', b'MKCOL', b'TRACE', b'LABEL', b'MERGE', b'DELETE', b'SEARCH',
+                b'UNLOCK', b'REPORT', b'UPDATE', b'NOTIFY', b'BDELETE', b'CONNECT', b'OPTIONS',
+                b'CHECKIN', b'PROPFIND', b'CHECKOUT', b'CCM_POST', b'SUBSCRIBE', b'PROPPATCH',
+                b'BPROPFIND', b'BPROPPATCH', b'UNCHECKOUT', b'MKACTIVITY', b'MKWORKSPACE',
+                b'UNSUBSCRIBE', b'RPC_CONNECT', b'VERSION-CONTROL', b'BASELINE-CONTROL')
+
+# method token and space at the start of a request
+REQUEST_START = re.compile(rb'(?:' + b'|'.join(HTTP_METHODS) + rb') ')
+# request line: {method} {uri} [HTTP/{version}]
+REQUEST_LINE = re.compile(rb'[A-Z_-]+ +(\S+)(?: +(\S*))?[ \t]*\r?\n')
+# status line at the start of a response
+RESPONSE_START = re.compile(rb'HTTP/\d\.\d +(\d{3})')
+# blank line ending the head of a request or response
+HEAD_END = re.compile(rb'\r?\n\r?\n')
+# Host: header of a request
+HOST_HEADER = re.compile(rb'^host:[ \t]*([^\r\n]*?)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+# Content-Length: header of a request or response
+CONTENT_LENGTH = re.compile(rb'^content-length:[ \t]*(\d+)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+# Content-Type: header of a response for an image
+IMAGE_CONTENT_TYPE = re.compile(rb'^content-type:[ \t]*image/', re.IGNORECASE | re.MULTILINE)
+# image file in a URI (.png|.gif|.jpg)
+IMAGE_REGEX = re.compile(rb'([a-zA-Z0-9-_]+\.(gif|png|jpg))', re.IGNORECASE)
+# first bytes of PNG, GIF and JPEG files
+IMAGE_MAGIC = (b'\x89PN', b'GIF', b'\xff\xd8\xff')
+MAGIC_SIZE = 3
+
+# most bytes of an unfinished head kept for each stream
+MAX_HEAD = 65536
+# most requests of a connection waiting for their response
+MAX_PENDING_REQUESTS = 64
+# state of a response stream with a body of unknown length, its responses are no longer paired
+UNFRAMED = -1
+
+
+class RequestState:
+    """
+    state of a stream of requests from a client
+    """
+    __slots__ = ('pending', 'body')
+
+    def __init__(self):
+        # URIs requested that are waiting for a response, in the order they were sent
+        self.pending: deque = deque(maxlen=MAX_PENDING_REQUESTS)
+        # bytes of a request body still to be skipped
+        self.body = 0
+
+
+class ImageFinder(Analyser):
+    """
+    analyser searching http requests and responses for image files (.png|.gif|.jpg)
+    finish returns a table with all image files found along with their full URIs
+    """
+    name = 'images'
+
+    def __init__(self, idle_timeout: float = 120.0, max_streams: int = 65536,
+                 memory_limit: Optional[int] = None, spill_dir: Optional[str] = None):
+        """
+        :param idle_timeout: seconds without a segment before a stream is evicted
+        :param max_streams: most streams being reassembled at once
+        :param memory_limit: bytes the images may use before they are spilled to disk, None to keep them in memory
+        :param spill_dir: directory run files are made in, None for the system temporary directory
+        """
+        self.streams = StreamTable(idle_timeout, max_streams)
+        # ordered set of full URIs found: image file name
+        self.images: dict[str, str] = {}
+        if memory_limit is not None:
+            # the image first found for a URI is kept, like setdefault
+            self.images = SpillStore(memory_limit, spill_dir)
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        add a http segment in a packet to its stream and search any complete heads for an image file
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        # only packets send to or from port 80 are decoded in full
+        if 80 not in (packet.sport, packet.dport):
+            return
+        ip = packet.eth.data
+        tcp = getattr(ip, 'data', None)
+        # skips packets with no TCP layer (e.g. UDP)
+        if not isinstance(tcp, dpkt.tcp.TCP):
+            return
+
+        key = (ip.src, ip.dst, tcp.sport, tcp.dport)
+        payload = tcp.data
+        # segments without data only matter when they end a stream
+        if payload or tcp.flags & (TCP_FIN | TCP_RST):
+            stream, data = self.streams.add(key, timestamp, tcp.seq, tcp.flags, payload)
+            if data:
+                if tcp.dport == 80:
+                    self._read_requests(stream, data)
+                else:
+                    self._read_responses(key, stream, data)
+
+            if tcp.flags & (TCP_FIN | TCP_RST):
+                self._close(key, self.streams.remove(key), self.images)
+        for evicted_key, evicted in self.streams.expire(timestamp):
+            self._close(evicted_key, evicted, self.images)
+
+    def _read_requests(self, stream: TcpStream, data: bytes) -> None:
+        """
+        add request data to a streams buffer and read every complete request head,
+        skipping each body by its Content-Length so the next request in the stream is read
+        :param stream: stream of requests from a client
+        :param data: data in sequence order
+        """
+        if stream.state is None:
+            stream.state = RequestState()
+        state = stream.state
+        # the rest of a body started in an earlier segment is skipped
+        if state.body:
+            skipped = min(state.body, len(data))
+            state.body -= skipped
+            data = data[skipped:]
+
+        buffer = stream.buffer
+        # quick check before buffering anything, data not starting a request is a body,
+        # a method split between segments is kept until the rest of it arrives
+        if not buffer and not REQUEST_START.match(data, partial=True):
+            return
+        buffer += data
+
+        while buffer:
+            # data after a body that does not start a request, the bodies were not where they were expected
+            if not REQUEST_START.match(buffer, partial=True):
+                buffer.clear()
+                break
+            end = HEAD_END.search(buffer)
+            counters['image_regex_searches'] += 1
+            if end is None:
+                break
+            request = image_request(buffer[:end.start()])
+            if request is not None:
+                state.pending.append(request)
+                self._add(request, self.images)
+            content_length = CONTENT_LENGTH.search(buffer, 0, end.start())
+            length = int(content_length.group(1)) if content_length is not None else 0
+            del buffer[:end.end()]
+            if length > len(buffer):
+                state.body = length - len(buffer)
+                buffer.clear()
+                return
+            del buffer[:length]
+
+        if len(buffer) > MAX_HEAD:
+            self._add(image_request(buffer), self.images)
+            buffer.clear()
+
+    def _read_responses(self, key: tuple, stream: TcpStream, data: bytes) -> None:
+        """
+        add response data to a streams buffer and read every complete response head,
+        skipping each body by its Content-Length so the next response is paired with the next request
+        the URI of a response for an image is taken from the request it answers
+        :param key: key of stream
+        :param stream: stream of responses from a server
+        :param data: data in sequence order
+        """
+        # the request stream holds the URIs waiting for a response, in the order they were sent
+        request_stream = self.streams.reverse(key)
+        pending = request_stream.state.pending if request_stream is not None and request_stream.state else None
+        # once a body of unknown length is seen responses cannot be paired with requests
+        if stream.state == UNFRAMED:
+            if pending:
+                pending.clear()
+            return
+        # the rest of a body started in an earlier segment is skipped
+        if stream.state:
+            skipped = min(stream.state, len(data))
+            stream.state -= skipped
+            data = data[skipped:]
+
+        buffer = stream.buffer
+        # quick check before buffering anything, data not starting a response is a body
+        if not buffer and not RESPONSE_START.match(data):
+            return
+        buffer += data
+
+        while buffer:
+            status = RESPONSE_START.match(buffer)
+            # data after a body that does not start a response, the bodies were not where they were expected
+            if status is None:
+                self._unframed(stream, pending)
+                return
+            end = HEAD_END.search(buffer)
+            counters['image_regex_searches'] += 1
+            if end is None:
+                if len(buffer) > MAX_HEAD:
+                    buffer.clear()
+                return
+
+            code = status.group(1)
+            if code.startswith(b'1') or code in (b'204', b'304'):
+                # informational and no content responses have no body
+                length = 0
+            else:
+                content_length = CONTENT_LENGTH.search(buffer, 0, end.start())
+                length = int(content_length.group(1)) if content_length is not None else None
+            body = buffer[end.end():end.end() + MAGIC_SIZE]
+            image_type = IMAGE_CONTENT_TYPE.search(buffer, 0, end.start())
+            # wait for the first bytes of the body when the head does not give the type
+            if not image_type and len(body) < (MAGIC_SIZE if length is None else min(length, MAGIC_SIZE)):
+                if len(buffer) > MAX_HEAD:
+                    buffer.clear()
+                return
+
+            # informational responses are followed by the real response
+            if not code.startswith(b'1') and pending:
+                request = pending.popleft()
+                if image_type or body.startswith(IMAGE_MAGIC):
+                    self._add(request, self.images, response_image=True)
+
+            if length is None:
+                # e.g. a chunked body or one ending when the connection closes
+                self._unframed(stream, pending)
+                return
+            del buffer[:end.end()]
+            if length > len(buffer):
+                stream.state = length - len(buffer)
+                buffer.clear()
+                return
+            del buffer[:length]
+
+    @staticmethod
+    def _unframed(stream: TcpStream, pending: Optional[deque]) -> None:
+        """
+        stop pairing the responses of a connection with its requests,
+        rather than pairing them with the wrong requests
+        :param stream: stream of responses from a server
+        :param pending: requests to the server waiting for a response, None if none were seen
+        """
+        stream.state = UNFRAMED
+        stream.buffer.clear()
+        if pending:
+            pending.clear()
+
+    def _close(self, key: tuple, stream: Optional[TcpStream], images: dict) -> None:
+        """
+        read the request left in a stream that has ended
+        :param key: key of stream
+        :param stream: stream that has ended
+        :param images: ordered set of full URIs to add an image to
+        """
+        # requests are read even without a blank line at the end of the head
+        if stream is not None and key[3] == 80 and stream.buffer:
+            self._add(image_request(bytes(stream.buffer)), images)
+
+    @staticmethod
+    def _add(request: Optional[tuple[str, str, bool]], images: dict, response_image: bool = False) -> None:
+        """
+        add the image file of a request to an ordered set of full URIs
+        :param request: tuple from image_request
+        :param images: ordered set of full URIs
+        :param response_image: the response to the request was an image, add it even if the URI names no image file
+        """
+        if request is not None and (request[2] or response_image):
+            image, full_uri, unused_named = request
+            images.setdefault(full_uri, image)
+
+    def found(self) -> dict[str, str]:
+        """
+        images found so far, including any in unfinished request heads
+        :return: ordered set of full URIs found: image file name, a dict or SpillStore
+        """
+        images = self.images.copy()
+        for key, stream in self.streams.streams.items():
+            self._close(key, stream, images)
+        return images
+
+    def wanted(self, records: np.ndarray) -> np.ndarray:
+        """
+        only packets send to or from port 80 in a packet index need to be decoded
+        :param records: numpy structured array of packet index rows
+        :return: boolean mask of http packets
+        """
+        return (records['dport'] == 80) | (records['sport'] == 80)
+
+    def merge(self, other: 'ImageFinder') -> None:
+        """
+        add images found in packets following this finders packets
+        streams are not joined across the two sets of packets
+        :param other: image finder fed the following packets
+        """
+        for full_uri, image in other.found().items():
+            self.images.setdefault(full_uri, image)
+
+    def finish(self) -> str:
+        """
+        create a table do display all image files found along with their full URIs
+        :return: table with all image files found along with their full URIs
+        """
+        return pretty_table(IMAGE_HEADERS, image_rows(self.found()), NO_IMAGES, stralign='left')
+
+
+def image_request(head: bytes) -> Optional[tuple[str, str, bool]]:
+    """
+    read the URI and host from the head of a http request
+    :param head: request line and headers of a request
+    :return: (image file, full URI, True if the URI names an image file) tuple,
+             None if the head is not a request with a host
+    """
+    request_line = REQUEST_LINE.match(head)
+    if request_line is None or not REQUEST_START.match(head):
+        return None
+    # requests without HTTP/ are only valid without a version
+    version = request_line.group(2)
+    if version and not version.startswith(b'HTTP'):
+        return None
+    host = HOST_HEADER.search(head, request_line.end())
+    if host is None:
+        return None
+
+    uri = request_line.group(1).decode('ascii', 'ignore')
+    # remove the query portion of the uri
+    path = uri.split('?')[0]
+    # build full URI
+    full_uri = 'http://' + host.group(1).decode('ascii', 'ignore') + path
+    # isolate file name from uri
+    return os.path.basename(path), full_uri, IMAGE_REGEX.search(request_line.group(1)) is not None
 
 
 def find_images(packet_list: list[tuple]) -> str:
     """
     search https request data for image files (.png|.gif|.jpg)
-    keep lists of image file names and their associated URIs
+    keep an ordered set of image file names and their associated URIs
 
     create a table do display all image files found along with their full URIs
     :param packet_list: list of (packet_timestamp, packet_bytes) tuples
     :return: table with all image files found along with their full URIs
     """
-    images = []
-    uris = []
-    for (unused_timestamp, eth) in packet_list:
-        try:
-            ip = eth.data
-            tcp = ip.data
-            dport = tcp.dport
-        # skips packets with no ports specified (e.g. IGMP) or no transport layer (e.g. ARP)
-        except AttributeError:
-            continue
-
-        if dport == 80 and len(ip.data) > 0:
-            try:
-                http = dpkt.http.Request(tcp.data)
-                image = re.search(r'([a-zA-Z0-9-_]+\.(gif|png|jpg))', http.uri, re.IGNORECASE)
-
-                # true when image is found
-                if image:
-                    # remove the query portion of the uri
-                    uri = http.uri.split('?')[0]
-                    # isolate file name from uri
-                    image = os.path.basename(uri)
-
-                    # build full URI
-                    full_uri = "http://" + http.headers["host"] + uri
-                    uris.append(full_uri)
-                    images.append(image)
-            except dpkt.UnpackError:
-                continue
-
-    return build_image_table(images, uris)
+    image_finder = ImageFinder()
+    run_pipeline(packet_list, [image_finder])
+    return image_finder.finish()
+
+
+# column headers of the image table
+IMAGE_HEADERS = ['Image File',
+                 'Full Image URI'
+                 ]
+
+# printed instead of an image table with no rows
+NO_IMAGES = '[!] No Images Found!'
 
 
 def build_image_table(images: list, uris: list) -> str:
@@ -60,19 +380,8 @@ def build_image_table(images: list, uris: list) -> str:
     :param uris: list of uris associated with images
     :return: table for images and URIs
     """
-    headers = ['Image File',
-               'Full Image URI'
-               ]
-
-    # create list of rows for the table
-    rows = create_rows(images, uris)
-
     # if no images are found rows will be empty
-    if not rows:
-        return '[!] No Images Found!'
-
-    # return table of images found and their full URIs
-    return tabulate(rows, headers=headers, tablefmt='pretty', stralign='left')
+    return pretty_table(IMAGE_HEADERS, create_rows(images, uris), NO_IMAGES, stralign='left')
 
 
 def create_rows(images, uris):
@@ -89,3 +398,14 @@ def create_rows(images, uris):
         rows.append((images[i], uris[i]))
 
     return rows
+
+
+def image_rows(images) -> Iterable[tuple]:
+    """
+    rows of the image table from the ordered set found, in the same order as create_rows
+    :param images: ordered set of full URIs found: image file name, a dict or SpillStore
+    :return: list of rows with image name and associated URI, or a generator for a spilled set
+    """
+    if isinstance(images, SpillStore) and images.spilled:
+        return ((image, full_uri) for full_uri, image in images.items())
+    return create_rows(list(images.values()), list(images))
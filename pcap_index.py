@@ -0,0 +1,132 @@
+"""pcap_index.py
+   script to build a columnar index of the packets in a pcap file
+   the file is memory mapped and only the record and protocol headers are read
+   no dpkt objects are created while building the index
+
+   one row is stored for each packet in a numpy structured array
+   analysers that only need header fields can work on whole columns at once
+   packet data can be sliced from the mapped file by offset when it is needed
+"""
+import mmap
+from collections.abc import Callable
+from typing import Optional
+import numpy as np
+from packet_view import decode_headers
+from parse_pcap import FILE_HEADER_SIZE, pcap_header
+
+# one row per packet
+# proto is -1 when the packet has no IPv4/IPv6 layer
+# src and dst are only set for IPv4, sport and dport only for TCP and UDP, flags only for TCP
+INDEX_DTYPE = np.dtype([('timestamp', 'f8'),
+                        ('caplen', 'u4'),
+                        ('length', 'u4'),
+                        ('offset', 'u8'),
+                        ('ethertype', 'u2'),
+                        ('proto', 'i2'),
+                        ('src', 'u4'),
+                        ('dst', 'u4'),
+                        ('sport', 'u2'),
+                        ('dport', 'u2'),
+                        ('flags', 'u1')])
+
+# number of rows converted to a numpy array at a time while building the index
+CHUNK_ROWS = 65536
+
+
+class PacketIndex:
+    """
+    columnar index of the packets in a memory mapped pcap file
+    records is a numpy structured array with one INDEX_DTYPE row per packet
+    """
+
+    def __init__(self, pcap_file: str, start: Optional[int] = None, end: Optional[int] = None,
+                 predicate: Optional[Callable[[float, bytes], bool]] = None):
+        """
+        memory map a pcap file and index every complete record in it
+        :param pcap_file: relative path to pcap file
+        :param start: offset of the first record to index, None for the first record in the file
+        :param end: offset to stop indexing records at, None to index to the end of the file
+        :param predicate: compiled filter taking (timestamp, packet bytes), None to index every packet
+        """
+        with open(pcap_file, 'rb') as open_file:
+            self._map = mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.records = build_records(self._map, start, end, predicate)
+        except ValueError:
+            self._map.close()
+            raise
+
+    def packet(self, position: int) -> bytes:
+        """
+        slice the data of one packet from the mapped file
+        :param position: row of the packet in records
+        :return: bytes of the packet
+        """
+        offset = int(self.records['offset'][position])
+        return self._map[offset:offset + int(self.records['caplen'][position])]
+
+    def close(self) -> None:
+        """
+        unmap the pcap file
+        """
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused_exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+def build_records(buf, start: Optional[int] = None, end: Optional[int] = None,
+                  predicate: Optional[Callable[[float, bytes], bool]] = None) -> np.ndarray:
+    """
+    walk the record headers of a pcap file held in a buffer
+    and decode the header fields of each packet
+    :param buf: buffer containing a whole pcap file
+    :param start: offset of the first record to index, None for the first record in the file
+    :param end: offset to stop indexing records at, None to index to the end of the file
+    :param predicate: compiled filter taking (timestamp, packet bytes), None to index every packet
+    :return: numpy structured array with one INDEX_DTYPE row per packet
+    """
+    record_header, divisor = pcap_header(buf[:FILE_HEADER_SIZE])
+    header_size = record_header.size
+    unpack_record = record_header.unpack_from
+    view = memoryview(buf)
+    size = len(buf) if end is None else min(end, len(buf))
+
+    chunks = []
+    rows = []
+    offset = FILE_HEADER_SIZE if start is None else start
+    try:
+        # stop at the first incomplete record, e.g. a capture still being written
+        while offset + header_size <= size:
+            ts_sec, ts_frac, caplen = unpack_record(view, offset)[:3]
+            offset += header_size
+            if offset + caplen > size:
+                break
+
+            timestamp = ts_sec + ts_frac / divisor
+            # packets the filter rejects are not decoded or indexed
+            if predicate is not None and not predicate(timestamp, view[offset:offset + caplen]):
+                offset += caplen
+                continue
+
+            length, ethertype, proto, src, dst, sport, dport, flags, unused_payload_length = \
+                decode_headers(view, offset, caplen)
+            rows.append((timestamp, caplen, length, offset,
+                         ethertype, proto, src, dst, sport, dport, flags))
+            offset += caplen
+
+            if len(rows) == CHUNK_ROWS:
+                chunks.append(np.array(rows, dtype=INDEX_DTYPE))
+                rows = []
+    finally:
+        # views must be released before the mapped file can be closed
+        view.release()
+
+    chunks.append(np.array(rows, dtype=INDEX_DTYPE))
+    return np.concatenate(chunks)
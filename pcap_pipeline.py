@@ -0,0 +1,306 @@
+"""pcap_pipeline.py
+   single pass analysis engine for packets read from a pcap file
+   each packet is handed to every analyser as soon as it is read
+   so the capture only has to be read and decoded once
+
+   analysers keep their own summary state between packets
+   memory use is bounded by that state, not the size of the capture
+
+   analysers can also be fed from a columnar packet index,
+   decoding only the packets they need
+
+   a capture can be split into record aligned chunks analysed by a pool of processes
+   the state of each chunk is merged in file order, giving the same result as one pass
+
+   a profiled run reads packets in batches and feeds each batch to one analyser at a time,
+   so the time spent in each stage can be measured without timing every packet
+"""
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from itertools import accumulate, islice
+from typing import Optional
+import numpy as np
+from packet_view import PacketView
+from parse_pcap import first_timestamp, packet_stream, split_capture
+from pcap_filter import compile_filter
+from pcap_index import PacketIndex
+from pcap_profile import Profiler
+
+# number of packets read before each analyser is fed them in a profiled run
+PROFILE_BATCH_SIZE = 1024
+
+
+class Analyser:
+    """
+    base class for a pluggable packet analyser
+    feed is called once for every packet in the capture, in file order
+    finish is called after the last packet and returns the analysers result
+
+    merge adds the state of an analyser fed the packets that follow on
+    from the packets this analyser was fed
+    """
+    # name of the analysers stage in a profile
+    name = 'analyser'
+
+    def begin(self, timestamp: float, position: int = 0) -> None:
+        """
+        called before any packets are fed when the timestamp of the first packet
+        in the capture is known, e.g. when the capture is split into chunks
+        :param timestamp: timestamp of the first packet in the capture
+        :param position: number of packets in the capture before the first packet this analyser is fed
+        """
+
+    def needs_position(self) -> bool:
+        """
+        :return: True if the state of the analyser depends on the position of each packet in the capture,
+                 so a chunk has to be begun with the number of packets before it
+        """
+        return False
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        update the analysers state with one packet
+        header fields of the packet are read without a full decode,
+        packet.eth only decodes the whole packet with dpkt when the analyser needs it
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        raise NotImplementedError
+
+    def wanted(self, records: np.ndarray) -> Optional[np.ndarray]:
+        """
+        choose which packets in a packet index need to be decoded and fed
+        :param records: numpy structured array of packet index rows
+        :return: boolean mask over records, or None for every packet
+        """
+        return None
+
+    def feed_index(self, index: PacketIndex) -> None:
+        """
+        update the analysers state from a columnar packet index
+        only the packets chosen by wanted are sliced from the file and fed
+        analysers that only need header fields override this to use the columns
+        :param index: packet index of the pcap file
+        """
+        records = index.records
+        mask = self.wanted(records)
+        positions = range(len(records)) if mask is None else np.flatnonzero(mask)
+        timestamps = records['timestamp']
+
+        for position in positions:
+            self.feed(float(timestamps[position]), PacketView(index.packet(position)))
+
+    def options(self) -> tuple:
+        """
+        settings that change the state an analyser collects,
+        only analysers with the same options can be merged
+        :return: tuple of settings
+        """
+        return ()
+
+    def merge(self, other: 'Analyser') -> None:
+        """
+        add the state of another analyser of the same type to this analyser
+        :param other: analyser fed the packets following this analysers packets
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """
+        build the analysers result from the state collected so far
+        :return: result of the analyser
+        """
+        raise NotImplementedError
+
+
+def run_pipeline(packets: Iterable[tuple], analysers: list[Analyser]) -> int:
+    """
+    feed every packet to each analyser in a single pass over the packets
+    :param packets: iterable of (packet_timestamp, packet_view) tuples
+    :param analysers: analysers to feed each packet to
+    :return: number of packets read
+    """
+    # look up the feed methods once rather than for every packet
+    feeds = [analyser.feed for analyser in analysers]
+    packet_count = 0
+
+    for timestamp, packet in packets:
+        for feed in feeds:
+            feed(timestamp, packet)
+        packet_count += 1
+
+    return packet_count
+
+
+def run_profiled(packets: Iterable[tuple], analysers: list[Analyser], profiler: Profiler,
+                 batch_size: int = PROFILE_BATCH_SIZE) -> int:
+    """
+    feed every packet to each analyser like run_pipeline, measuring each stage
+    a batch of packets is read and parsed, then fed to one analyser after another
+    :param packets: iterable of (packet_timestamp, packet_view) tuples
+    :param analysers: analysers to feed each packet to
+    :param profiler: profiler measuring the parse stage and the stage of each analyser
+    :param batch_size: number of packets in each batch
+    :return: number of packets read
+    """
+    packets = iter(packets)
+    packet_count = 0
+
+    while True:
+        with profiler.stage('parse') as stage:
+            batch = list(islice(packets, batch_size))
+            # header fields are read as part of parsing, not by the first analyser to use them
+            for unused_timestamp, packet in batch:
+                packet.read_headers()
+            stage.packets += len(batch)
+        if not batch:
+            break
+
+        for analyser in analysers:
+            feed = analyser.feed
+            with profiler.stage(analyser.name) as stage:
+                for timestamp, packet in batch:
+                    feed(timestamp, packet)
+                stage.packets += len(batch)
+        packet_count += len(batch)
+
+    return packet_count
+
+
+def run_index(index: PacketIndex, analysers: list[Analyser]) -> int:
+    """
+    feed the packets in a packet index to each analyser
+    :param index: packet index of the pcap file
+    :param analysers: analysers to feed the packets to
+    :return: number of packets in the index
+    """
+    for analyser in analysers:
+        analyser.feed_index(index)
+
+    return len(index)
+
+
+def run_index_profiled(index: PacketIndex, analysers: list[Analyser], profiler: Profiler) -> int:
+    """
+    feed the packets in a packet index to each analyser like run_index, measuring each stage
+    :param index: packet index of the pcap file
+    :param analysers: analysers to feed the packets to
+    :param profiler: profiler measuring the stage of each analyser
+    :return: number of packets in the index
+    """
+    for analyser in analysers:
+        with profiler.stage(analyser.name) as stage:
+            analyser.feed_index(index)
+            stage.packets += len(index)
+
+    return len(index)
+
+
+def analyse_range(pcap_file: str, start: int, end: int, analysers: list[Analyser],
+                  use_index: bool = False, packet_filter: Optional[str] = None) -> tuple[list[Analyser], int]:
+    """
+    feed the packets in one record aligned byte range of a pcap file to each analyser
+    run in a worker process by run_parallel
+    :param pcap_file: relative path to pcap file
+    :param start: offset of the first record in the range
+    :param end: offset the range ends at
+    :param analysers: analysers to feed the packets to
+    :param use_index: build a packet index of the range instead of decoding every packet
+    :param packet_filter: filter expression packets must match, None for every packet
+    :return: (analysers, number of packets read) tuple
+    """
+    # compiled filters cannot be pickled, each worker compiles the expression itself
+    predicate = compile_filter(packet_filter) if packet_filter else None
+    if use_index:
+        with PacketIndex(pcap_file, start, end, predicate) as index:
+            packet_count = run_index(index, analysers)
+    else:
+        packet_count = run_pipeline(packet_stream(pcap_file, start, end, predicate), analysers)
+
+    return analysers, packet_count
+
+
+def begun(analysers: list[Analyser], timestamp: float, position: int) -> list[Analyser]:
+    """
+    :param analysers: analysers to copy
+    :param timestamp: timestamp of the first packet in the capture
+    :param position: number of packets in the capture before the first packet the copies are fed
+    :return: copies of the analysers begun at the position
+    """
+    copies = deepcopy(analysers)
+    for analyser in copies:
+        analyser.begin(timestamp, position)
+    return copies
+
+
+def count_range(pcap_file: str, start: int, end: int, packet_filter: Optional[str] = None) -> int:
+    """
+    count the packets in one record aligned byte range of a pcap file without decoding them
+    run in a worker process by run_parallel
+    :param pcap_file: relative path to pcap file
+    :param start: offset of the first record in the range
+    :param end: offset the range ends at
+    :param packet_filter: filter expression packets must match, None for every packet
+    :return: number of packets kept by the filter
+    """
+    predicate = compile_filter(packet_filter) if packet_filter else None
+    return sum(1 for unused_packet in packet_stream(pcap_file, start, end, predicate))
+
+
+def run_parallel(pcap_file: str, analysers: list[Analyser], workers: int,
+                 use_index: bool = False, start: Optional[int] = None,
+                 end: Optional[int] = None, packet_filter: Optional[str] = None,
+                 timestamp: Optional[float] = None, position: int = 0) -> int:
+    """
+    split a pcap file into one record aligned chunk for each worker,
+    analyse the chunks in a pool of processes
+    and merge the state of each chunk into the analysers in file order
+    :param pcap_file: relative path to pcap file
+    :param analysers: analysers to feed the packets to, each is copied to the workers
+    :param workers: number of worker processes
+    :param use_index: build a packet index of each chunk instead of decoding every packet
+    :param start: offset of the first record to analyse, None for the first record in the file
+    :param end: offset to stop analysing at, None to analyse to the end of the file
+    :param packet_filter: filter expression packets must match, None for every packet
+    :param timestamp: timestamp of the first packet in the capture,
+                      None for the first packet from start kept by the filter
+    :param position: number of packets in the capture before start
+    :return: number of packets read
+    """
+    chunks = split_capture(pcap_file, workers, start, end)
+    if not chunks:
+        return 0
+
+    # every chunk has to measure time from the first packet of the whole capture
+    if timestamp is None:
+        timestamp = first_timestamp(pcap_file, compile_filter(packet_filter) if packet_filter else None, start)
+    if timestamp is None:
+        return 0
+    for analyser in analysers:
+        analyser.begin(timestamp, position)
+
+    packet_count = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # analysers using the position of each packet, e.g. sampling 1 in N packets, are begun with
+        # the number of packets before their chunk, counted in the pool, so any number of workers gives the same result
+        positions = [position] * len(chunks)
+        if any(analyser.needs_position() for analyser in analysers):
+            counts = [pool.submit(count_range, pcap_file, chunk_start, chunk_end, packet_filter)
+                      for chunk_start, chunk_end in chunks[:-1]]
+            positions = list(accumulate((count.result() for count in counts), initial=position))
+
+        # each chunk gets its own copy of the analysers before any results are merged,
+        # arguments are only sent to the workers once a worker is free
+        futures = [pool.submit(analyse_range, pcap_file, chunk_start, chunk_end,
+                               begun(analysers, timestamp, chunk_position), use_index, packet_filter)
+                   for (chunk_start, chunk_end), chunk_position in zip(chunks, positions)]
+
+        # merge in file order so the result matches a single pass
+        for future in futures:
+            chunk_analysers, chunk_packets = future.result()
+            for analyser, chunk_analyser in zip(analysers, chunk_analysers):
+                analyser.merge(chunk_analyser)
+            packet_count += chunk_packets
+
+    return packet_count
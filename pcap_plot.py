@@ -2,11 +2,305 @@
    script to plot a graph of packets over time from a list of packets
    calculate and add a threshold line to graph
    when graph is above this line indicates periods of heavy traffic
+
+   packets and bytes are counted for one or more time intervals at once
+   timestamps are binned in batches with numpy
+   the binned series can be exported to CSV or NPY files
+
+   matplotlib is only imported when a graph is drawn, counting packets does not need it
+
+   packets can be sampled, keeping 1 in N and scaling the counts by N,
+   the graph then shows the error of each interval
+   packets are kept by their position in the whole capture, so a capture split into chunks keeps the same packets
 """
-from datetime import datetime
-from math import floor
-import matplotlib.pyplot as plt
-from numpy import std, arange
+from array import array
+from datetime import datetime, timedelta
+from typing import Optional
+import numpy as np
+from sketches import Z_95
+from packet_view import PacketView
+from pcap_index import PacketIndex
+from pcap_pipeline import Analyser, run_pipeline
+
+# number of packets buffered by PacketActivity.feed before they are binned together
+BATCH_SIZE = 65536
+
+# dtype of the exported series, one row for each time interval group
+SERIES_DTYPE = np.dtype([('timestamp', 'f8'),
+                         ('seconds', 'f8'),
+                         ('packets', 'i8'),
+                         ('bytes', 'i8')])
+
+
+class PacketActivity(Analyser):
+    """
+    analyser counting packets and bytes in each time interval of a capture
+    finish plots the graph of packets over time for each time interval
+    """
+    name = 'plot'
+
+    def __init__(self, pcap_name: str, time_intervals: tuple[float, ...] = (1.5,),
+                 headless: bool = False, export: Optional[str] = None, sample: int = 1):
+        """
+        :param pcap_name: name of pcap file packets came from
+        :param time_intervals: seconds in each time interval group, one graph is plotted for each
+        :param headless: save graphs without opening a window
+        :param export: also save the packets and bytes in each group as 'csv' or 'npy'
+        :param sample: count 1 in this many packets, scaled up to estimate every packet
+        """
+        self.pcap_name = pcap_name
+        self.time_intervals = tuple(time_intervals)
+        self.headless = headless
+        self.export = export
+        self.sample = sample
+        # packets in the capture before the first packet fed to this analyser, and packets fed to it,
+        # so every sample-th packet of the capture is kept however it is split into chunks
+        self._position = 0
+        self._seen = 0
+        # number of packets and bytes in each time interval group for each interval
+        self.time_groups = {interval: np.zeros(0, dtype=np.int64) for interval in self.time_intervals}
+        self.byte_groups = {interval: np.zeros(0, dtype=np.int64) for interval in self.time_intervals}
+        # timestamp of the first packet in whole microseconds
+        self.first_us: Optional[int] = None
+        # packets waiting to be binned
+        self._timestamps = array('d')
+        self._lengths = array('d')
+
+    def begin(self, timestamp: float, position: int = 0) -> None:
+        """
+        measure time intervals from the first packet of the whole capture
+        and sample packets by their position in the whole capture
+        :param timestamp: timestamp of the first packet in the capture
+        :param position: number of packets in the capture before the first packet this analyser is fed
+        """
+        self.first_us = int(to_microseconds(np.array([timestamp]))[0])
+        self._position = position
+
+    def needs_position(self) -> bool:
+        """
+        :return: True when packets are sampled, which packets are kept depends on their position
+        """
+        return self.sample > 1
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        buffer the timestamp and size of a packet, when it is one of the sampled packets
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        self._seen += 1
+        if self.sample > 1 and (self._position + self._seen - 1) % self.sample:
+            return
+
+        self._timestamps.append(timestamp)
+        self._lengths.append(len(packet))
+        if len(self._timestamps) >= BATCH_SIZE:
+            self._flush()
+
+    def feed_index(self, index: PacketIndex) -> None:
+        """
+        count packets and bytes in each time interval group using the packet index columns
+        :param index: packet index of the pcap file
+        """
+        self._flush()
+        records = index.records
+        if self.sample > 1:
+            # carry on sampling from the packets fed before
+            records = records[-(self._position + self._seen) % self.sample::self.sample]
+            self._seen += len(index.records)
+        self.feed_arrays(records['timestamp'], records['length'])
+
+    def feed_arrays(self, timestamps: np.ndarray, lengths: np.ndarray) -> None:
+        """
+        count a batch of packets in the time interval group each belongs to
+        :param timestamps: timestamp of each packet
+        :param lengths: size of each packet
+        """
+        if len(timestamps) == 0:
+            return
+
+        # timestamps are compared in whole microseconds, like datetime does
+        microseconds = to_microseconds(np.asarray(timestamps))
+        if self.first_us is None:
+            self.first_us = int(microseconds[0])
+        seconds = (microseconds - self.first_us) / 1E6
+
+        for interval in self.time_intervals:
+            # calculate which group each packet belongs to,
+            # packets before the first packet are counted in the first group
+            group_nums = np.maximum(np.floor(seconds / interval), 0).astype(np.int64)
+            size = max(int(group_nums.max()) + 1, len(self.time_groups[interval]))
+
+            packets = np.bincount(group_nums, minlength=size) * self.sample
+            packets[:len(self.time_groups[interval])] += self.time_groups[interval]
+            self.time_groups[interval] = packets
+
+            sizes = np.bincount(group_nums, weights=lengths, minlength=size).astype(np.int64) * self.sample
+            sizes[:len(self.byte_groups[interval])] += self.byte_groups[interval]
+            self.byte_groups[interval] = sizes
+
+    def _flush(self) -> None:
+        """
+        bin the packets buffered by feed
+        """
+        if not self._timestamps:
+            return
+        self.feed_arrays(np.frombuffer(self._timestamps), np.frombuffer(self._lengths))
+        self._timestamps = array('d')
+        self._lengths = array('d')
+
+    def options(self) -> tuple:
+        """
+        :return: time intervals the packets are counted in and packets sampled
+        """
+        return self.time_intervals, self.sample
+
+    def merge(self, other: 'PacketActivity') -> None:
+        """
+        add the packets counted by another analyser to this analysers time interval groups
+        the other analyser must measure time from the same first packet or a later one,
+        groups are moved by a whole number of intervals to line up with this analysers groups
+        :param other: analyser fed the following packets
+        """
+        self._flush()
+        other._flush()
+        self._seen += other._seen
+        if self.first_us is None:
+            self.first_us = other.first_us
+        # microseconds between the first packet of each analyser
+        offset = 0 if other.first_us is None else max(other.first_us - self.first_us, 0)
+
+        for groups, other_groups in ((self.time_groups, other.time_groups),
+                                     (self.byte_groups, other.byte_groups)):
+            for interval in self.time_intervals:
+                if not len(other_groups[interval]):
+                    continue
+                shift = int(round(offset / (interval * 1E6)))
+                size = max(len(groups[interval]), shift + len(other_groups[interval]))
+                combined = np.zeros(size, dtype=np.int64)
+                combined[:len(groups[interval])] += groups[interval]
+                combined[shift:shift + len(other_groups[interval])] += other_groups[interval]
+                groups[interval] = combined
+
+    def first_ts(self) -> datetime:
+        """
+        :return: UTC time of the first packet
+        """
+        return datetime(1970, 1, 1) + timedelta(microseconds=self.first_us)
+
+    def series(self, time_interval: float) -> np.ndarray:
+        """
+        packets and bytes in each group for one time interval
+        :param time_interval: one of the analysers time intervals
+        :return: numpy structured array with one SERIES_DTYPE row for each group
+        """
+        self._flush()
+        time_group = self.time_groups[time_interval]
+
+        rows = np.zeros(len(time_group), dtype=SERIES_DTYPE)
+        rows['seconds'] = np.arange(len(time_group)) * time_interval
+        if self.first_us is not None:
+            rows['timestamp'] = self.first_us / 1E6 + rows['seconds']
+        rows['packets'] = time_group
+        rows['bytes'] = self.byte_groups[time_interval]
+        return rows
+
+    def finish(self) -> None:
+        """
+        plot graph of packets over each time interval
+        and indicate when traffic was higher than calculated threshold
+        """
+        self._flush()
+        graph_name = self.pcap_name.split(".")[0]
+
+        # nothing to plot for a capture with no packets
+        if not len(self.time_groups[self.time_intervals[0]]):
+            print('No packets to plot')
+            return
+
+        for position, time_interval in enumerate(self.time_intervals):
+            # the first interval keeps the plain graph name
+            name = graph_name if position == 0 else f'{graph_name}_{time_interval:g}s'
+            self.plot(time_interval, name)
+            if self.export:
+                export_series(self.series(time_interval), f'{name}.{self.export}')
+                print(f'Series Saved as {name}.{self.export}')
+
+        if self.sample > 1:
+            print(f'Sampled 1 in {self.sample} packets, each interval within '
+                  f'±{self.sample_error(self.time_intervals[0])} packets (95%)')
+
+        if not self.headless:
+            import matplotlib.pyplot as plt
+            plt.show()
+
+    def sample_error(self, time_interval: float) -> int:
+        """
+        :param time_interval: one of the analysers time intervals
+        :return: most the packets of the busiest interval are off by with 95% confidence
+        """
+        # a binomial count of n / sample kept packets, scaled by sample, has a variance of n * (sample - 1)
+        busiest = int(self.time_groups[time_interval].max())
+        return int(np.ceil(Z_95 * np.sqrt(busiest * (self.sample - 1))))
+
+    def plot(self, time_interval: float, graph_name: str) -> None:
+        """
+        plot and save the graph of packets over one time interval
+        :param time_interval: one of the analysers time intervals
+        :param graph_name: name of the image file without extension
+        """
+        time_group = self.time_groups[time_interval]
+
+        # threshold calculated as mean packets per interval + 2 standard deviations
+        threshold = time_group.sum() / len(time_group) + np.std(time_group) * 2
+
+        y_axis = time_group
+        # using arange allows for a non-integer time_interval
+        x_axis = np.arange(0, len(y_axis) * time_interval, time_interval)
+
+        # headless graphs are drawn on a figure pyplot does not manage,
+        # so pyplot and a GUI backend are never loaded for them
+        if self.headless:
+            from matplotlib.figure import Figure
+            figure = Figure()
+        else:
+            import matplotlib.pyplot as plt
+            figure = plt.figure()
+        axes = figure.gca()
+        axes.plot(x_axis, y_axis, "g", label=f"packets per {time_interval} sec")
+        # add threshold line to graph
+        axes.axhline(y=threshold, color='r', linestyle='-', label=f"Threshhold={round(threshold, 2)}")
+        axes.set_xlabel(f"Seconds since: {self.first_ts()}")
+        axes.set_ylabel("Number of Packets")
+        axes.legend()
+
+        figure.savefig(f'{graph_name}.png')
+        print(f'Graph Saved as {graph_name}.png')
+
+
+def to_microseconds(timestamps: np.ndarray) -> np.ndarray:
+    """
+    round timestamps to whole microseconds the same way datetime.utcfromtimestamp does
+    :param timestamps: array of timestamps in seconds
+    :return: array of timestamps in microseconds
+    """
+    seconds = np.floor(timestamps)
+    # round half to even, like datetime
+    fraction = np.round((timestamps - seconds) * 1E6)
+    return seconds.astype(np.int64) * 1000000 + fraction.astype(np.int64)
+
+
+def export_series(rows: np.ndarray, file_name: str) -> None:
+    """
+    save the packets and bytes in each time interval group
+    :param rows: numpy structured array from PacketActivity.series
+    :param file_name: name of file, ending in .csv or .npy
+    """
+    if file_name.endswith('.npy'):
+        np.save(file_name, rows)
+    else:
+        np.savetxt(file_name, rows, fmt=['%.6f', '%g', '%d', '%d'], delimiter=',',
+                   header=','.join(SERIES_DTYPE.names), comments='')
 
 
 def plot_packet_activity(packet_list: list[tuple], pcap_name: str) -> None:
@@ -16,46 +310,6 @@ def plot_packet_activity(packet_list: list[tuple], pcap_name: str) -> None:
     :param packet_list: list of (packet_timestamp, packet_bytes) tuples
     :param pcap_name: name of pcap file packets came from
     """
-    graph_name = pcap_name.split(".")[0]
-    time_interval = 1.5
-
-    # list to store number of packets in each time interval group
-    time_group: list[int] = []
-    # get the timestamp of the first packet
-    first_ts = datetime.utcfromtimestamp(packet_list[0][0])
-
-    for timestamp, unused_data in packet_list:
-        current_ts = datetime.utcfromtimestamp(timestamp)
-        ts_diff = current_ts - first_ts
-        # convert difference between timestamps to seconds
-        seconds = ts_diff.total_seconds()
-        # calculate which group packet belongs to
-        group_num = floor(seconds / time_interval)
-
-        # group_num is used as an index to increment number of packets for that time interval group
-        # since a time interval could have no packets that index could be out of range of the list
-        # the while loop appends 0 to the list until the index is no longer out of range
-        while True:
-            try:
-                time_group[group_num] += 1
-                break
-            except IndexError:
-                time_group.append(0)
-
-    # threshold calculated as mean packets per interval + 2 standard deviations
-    threshold = sum(time_group) / len(time_group) + std(time_group) * 2
-
-    y_axis = time_group
-    # using arange allows for a non-integer time_interval
-    x_axis = arange(0, len(y_axis) * time_interval, time_interval)
-
-    plt.plot(x_axis, y_axis, "g", label=f"packets per {time_interval} sec")
-    # add threshold line to graph
-    plt.axhline(y=threshold, color='r', linestyle='-', label=f"Threshhold={round(threshold, 2)}")
-    plt.xlabel(f"Seconds since: {first_ts}")
-    plt.ylabel("Number of Packets")
-    plt.legend()
-
-    plt.savefig(graph_name)
-    print(f'Graph Saved as {graph_name}.png')
-    plt.show()
+    packet_activity = PacketActivity(pcap_name)
+    run_pipeline(packet_list, [packet_activity])
+    packet_activity.finish()
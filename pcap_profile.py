@@ -0,0 +1,156 @@
+"""pcap_profile.py
+   script to profile each stage of an analysis run (parse, each analyser and rendering)
+   records wall and CPU time, packets and packets per second of every stage,
+   and optionally peak memory with tracemalloc and a cProfile dump of each stage
+
+   stages are timed once per batch of packets rather than once per packet,
+   so timing adds little to a run and can be left on
+   tracemalloc and cProfile slow a run down and are only used when asked for
+
+   counters of work done in the hot paths (regex searches, dpkt decodes, GeoIP lookups)
+   are always counted, an increment costs far less than the work it counts
+"""
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Optional
+
+# work done in the hot paths, e.g. counters['geoip_lookups'] += 1
+counters: Counter = Counter()
+
+
+class StageProfile:
+    """
+    time, packets and memory of one stage, added up over every time the stage ran
+    """
+    __slots__ = ('wall_time', 'cpu_time', 'packets', 'peak_memory', 'allocated', 'profile')
+
+    def __init__(self, profile: Optional[cProfile.Profile] = None):
+        """
+        :param profile: profiler enabled while the stage runs, None to not profile the stage
+        """
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.packets = 0
+        # bytes, only measured when tracemalloc is tracing
+        self.peak_memory = 0
+        self.allocated = 0
+        self.profile = profile
+
+    def as_dict(self, memory: bool) -> dict:
+        """
+        :param memory: memory was measured with tracemalloc
+        :return: dictionary of the stages measurements
+        """
+        return {'wall_time': round(self.wall_time, 6),
+                'cpu_time': round(self.cpu_time, 6),
+                'packets': self.packets,
+                'packets_per_second': round(self.packets / self.wall_time, 1)
+                if self.packets and self.wall_time else None,
+                'peak_memory': self.peak_memory if memory else None,
+                'allocated': self.allocated if memory else None}
+
+
+class Profiler:
+    """
+    measures each stage of a run, stages are timed with 'with profiler.stage(name):'
+    a disabled profiler runs stages without measuring them
+    """
+
+    def __init__(self, enabled: bool = True, memory: bool = False, dump_dir: Optional[str] = None):
+        """
+        :param enabled: measure stages
+        :param memory: trace allocations with tracemalloc to find the peak memory of each stage
+        :param dump_dir: directory to save a cProfile dump of each stage to, None for no dumps
+        """
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.dump_dir = dump_dir if enabled else None
+        # stage name: measurements, in the order the stages first ran
+        self.stages: dict[str, StageProfile] = {}
+        self.peak_memory = 0
+        self._unused_stage = StageProfile()
+        self._wall_time = time.perf_counter()
+        self._cpu_time = time.process_time()
+
+        counters.clear()
+        if self.memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageProfile]:
+        """
+        measure a block of code as part of a stage
+        :param name: name of stage
+        :return: context manager giving the measurements of the stage, to add packets to
+        """
+        if not self.enabled:
+            yield self._unused_stage
+            return
+
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageProfile(cProfile.Profile() if self.dump_dir else None)
+        if self.memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        if stage.profile is not None:
+            stage.profile.enable()
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.wall_time += time.perf_counter() - wall_time
+            stage.cpu_time += time.process_time() - cpu_time
+            if stage.profile is not None:
+                stage.profile.disable()
+            if self.memory:
+                current_memory, peak_memory = tracemalloc.get_traced_memory()
+                stage.peak_memory = max(stage.peak_memory, peak_memory - start_memory)
+                stage.allocated += current_memory - start_memory
+                self.peak_memory = max(self.peak_memory, peak_memory)
+
+    def report(self, packets: int) -> dict:
+        """
+        :param packets: number of packets in the run
+        :return: dictionary of the measurements of the whole run, each stage and the counters
+        """
+        wall_time = time.perf_counter() - self._wall_time
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak_rss //= 1024
+        return {'total': {'wall_time': round(wall_time, 6),
+                          'cpu_time': round(time.process_time() - self._cpu_time, 6),
+                          'packets': packets,
+                          'packets_per_second': round(packets / wall_time, 1) if wall_time else None,
+                          'peak_memory': self.peak_memory if self.memory else None,
+                          'peak_rss_kib': peak_rss},
+                'stages': {name: stage.as_dict(self.memory) for name, stage in self.stages.items()},
+                'counters': dict(sorted(counters.items()))}
+
+    def save(self, file_name: str, packets: int) -> None:
+        """
+        save the report as JSON, and the cProfile dump of each stage
+        :param file_name: path of JSON file
+        :param packets: number of packets in the run
+        """
+        report = self.report(packets)
+        if self.memory:
+            tracemalloc.stop()
+        with open(file_name, 'w') as open_file:
+            json.dump(report, open_file, indent=2)
+
+        if self.dump_dir is not None:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            # each dump can be read with pstats or snakeviz
+            for name, stage in self.stages.items():
+                stage.profile.dump_stats(os.path.join(self.dump_dir, f'{name}.prof'))
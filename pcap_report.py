@@ -0,0 +1,66 @@
+"""pcap_report.py
+   script to run the output stages of an analysis (tables, KML file, graphs) concurrently
+   once the analysis has finished every stage has its inputs, so the stages are independent
+   and can run in a pool of processes, e.g. saving the KML file while graphs are drawn
+
+   everything a stage prints is captured and printed in stage order,
+   so the console output is the same as running the stages one after another
+"""
+import io
+import sys
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+
+class OutputStage:
+    """
+    one output stage, a function printing its part of the report
+    """
+
+    def __init__(self, function: Callable, *args, local: bool = False):
+        """
+        :param function: function printing the output of the stage, must be importable by the workers
+        :param args: arguments of the function, copied to a worker process
+        :param local: run in this process, e.g. a graph shown in a window
+        """
+        self.function = function
+        self.args = args
+        self.local = local
+
+
+def capture_output(function: Callable, args: tuple) -> str:
+    """
+    run a stage in a worker process, keeping what it prints
+    :param function: function printing the output of the stage
+    :param args: arguments of the function
+    :return: everything the stage printed
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        function(*args)
+    return output.getvalue()
+
+
+def run_stages(stages: list[OutputStage], workers: int = 1) -> None:
+    """
+    run output stages, in a pool of processes when there is more than one worker
+    the output of each stage is printed in order, as soon as the stages before it have printed
+    :param stages: output stages in the order their output is printed
+    :param workers: number of worker processes, 1 to run the stages one after another
+    """
+    if workers <= 1:
+        for stage in stages:
+            stage.function(*stage.args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [None if stage.local else pool.submit(capture_output, stage.function, stage.args)
+                   for stage in stages]
+        for stage, future in zip(stages, futures):
+            # local stages run while the workers carry on with the stages after them
+            if future is None:
+                stage.function(*stage.args)
+            else:
+                sys.stdout.write(future.result())
+                sys.stdout.flush()
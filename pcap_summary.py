@@ -1,10 +1,189 @@
 """pcap_summary.py
    script to create create a summary table from a pcap file
    one row represents one type of protocol
-   output generated with tabulate
+   packets are grouped by protocol with numpy,
+   names and timestamps are only converted when the table is built
+   output generated with tabulate, or streamed as CSV or JSON, by table_writer
 """
 import datetime
-from tabulate import tabulate
+from array import array
+from collections.abc import Iterator
+import dpkt
+import numpy as np
+from packet_view import PacketView
+from pcap_index import PacketIndex
+from pcap_pipeline import Analyser, run_pipeline
+from table_writer import pretty_table
+
+
+# protocol ids below this are IP protocol numbers,
+# packets without an ip layer use this plus their ethernet type
+ETH_TYPE_ID = 0x10000
+
+# number of packets buffered by ProtocolSummary.feed before they are summarised together
+BATCH_SIZE = 65536
+
+
+class ProtocolSummary(Analyser):
+    """
+    analyser collecting summary information about each protocol type
+    packets are summarised in batches of (protocol id, length, timestamp) arrays
+    finish returns a dictionary with summary information for each protocol
+    """
+    name = 'summary'
+
+    def __init__(self):
+        # protocol id: [number, sum_size, first packet, first timestamp, last packet, last timestamp]
+        self.groups: dict[int, list] = {}
+        # number of packets summarised so far
+        self.packets = 0
+        # packets waiting to be summarised
+        self._ids = array('q')
+        self._lengths = array('d')
+        self._timestamps = array('d')
+
+    def feed(self, timestamp: float, packet: PacketView) -> None:
+        """
+        buffer the protocol, size and timestamp of a packet
+        :param timestamp: timestamp of packet
+        :param packet: lazy view of packet
+        """
+        self._ids.append(packet_protocol_id(packet))
+        self._lengths.append(len(packet))
+        self._timestamps.append(timestamp)
+        if len(self._ids) >= BATCH_SIZE:
+            self._flush()
+
+    def feed_index(self, index: PacketIndex) -> None:
+        """
+        summarise each protocol from the packet index columns
+        :param index: packet index of the pcap file
+        """
+        records = index.records
+        protocol_ids = np.where(records['proto'] >= 0,
+                                records['proto'].astype(np.int64),
+                                records['ethertype'].astype(np.int64) + ETH_TYPE_ID)
+        self.feed_arrays(protocol_ids, records['length'], records['timestamp'])
+
+    def feed_arrays(self, protocol_ids: np.ndarray, lengths: np.ndarray, timestamps: np.ndarray) -> None:
+        """
+        summarise a batch of packets given as arrays, in file order
+        groups the packets by protocol to count them, sum their sizes
+        and find the first and last packet of each protocol
+        :param protocol_ids: protocol id of each packet
+        :param lengths: size of each packet
+        :param timestamps: timestamp of each packet
+        """
+        self._flush()
+        self._summarise(np.asarray(protocol_ids), np.asarray(lengths), np.asarray(timestamps))
+
+    def _flush(self) -> None:
+        """
+        summarise the packets buffered by feed
+        """
+        if not self._ids:
+            return
+        self._summarise(np.frombuffer(self._ids, dtype=np.int64),
+                        np.frombuffer(self._lengths),
+                        np.frombuffer(self._timestamps))
+        self._ids = array('q')
+        self._lengths = array('d')
+        self._timestamps = array('d')
+
+    def _summarise(self, protocol_ids: np.ndarray, lengths: np.ndarray, timestamps: np.ndarray) -> None:
+        """
+        add a batch of packets to the summary of each protocol
+        :param protocol_ids: protocol id of each packet
+        :param lengths: size of each packet
+        :param timestamps: timestamp of each packet
+        """
+        batch_size = len(protocol_ids)
+        if batch_size == 0:
+            return
+
+        unique_ids, first, inverse, counts = np.unique(protocol_ids, return_index=True,
+                                                       return_inverse=True, return_counts=True)
+        sums = np.bincount(inverse, weights=lengths, minlength=len(unique_ids))
+        # last packet of each protocol is the first one found searching backwards
+        last = batch_size - 1 - np.unique(protocol_ids[::-1], return_index=True)[1]
+
+        for (protocol_id, number, sum_size, first_packet, last_packet) in zip(unique_ids.tolist(),
+                                                                            counts.tolist(),
+                                                                            sums.tolist(),
+                                                                            first.tolist(),
+                                                                            last.tolist()):
+            group = self.groups.get(protocol_id)
+            if group is None:
+                self.groups[protocol_id] = [number, int(sum_size),
+                                            self.packets + first_packet, float(timestamps[first_packet]),
+                                            self.packets + last_packet, float(timestamps[last_packet])]
+            else:
+                group[0] += number
+                group[1] += int(sum_size)
+                group[4] = self.packets + last_packet
+                group[5] = float(timestamps[last_packet])
+
+        self.packets += batch_size
+
+    def merge(self, other: 'ProtocolSummary') -> None:
+        """
+        add the protocol summaries of packets following this summaries packets
+        :param other: summary of the following packets
+        """
+        self._flush()
+        other._flush()
+        for (protocol_id, other_group) in other.groups.items():
+            number, sum_size, first_packet, first_ts, last_packet, last_ts = other_group
+            group = self.groups.get(protocol_id)
+            if group is None:
+                self.groups[protocol_id] = [number, sum_size,
+                                            self.packets + first_packet, first_ts,
+                                            self.packets + last_packet, last_ts]
+            else:
+                # first packet is kept, the rest combine with the following packets
+                group[0] += number
+                group[1] += sum_size
+                group[4] = self.packets + last_packet
+                group[5] = last_ts
+
+        self.packets += other.packets
+
+    def finish(self) -> dict[str, dict]:
+        """
+        resolve protocol names and convert timestamps once for each protocol
+        protocols are ordered by the first packet of each protocol
+        :return: a dictionary with summary information for each protocol
+        """
+        self._flush()
+        # dictionary to store attributes of each protocol
+        protocols = {}
+        # packet numbers of the last packet of each protocol
+        last_packets = {}
+
+        for protocol_id, group in sorted(self.groups.items(), key=lambda item: item[1][2]):
+            number, sum_size, unused_first_packet, first_ts, last_packet, last_ts = group
+            protocol = protocol_name(protocol_id)
+
+            # different ids can share a name, e.g. a protocol number dpkt has no name for
+            if protocol in protocols:
+                protocols[protocol]['number'] += number
+                protocols[protocol]['sum_size'] += sum_size
+                if last_packet > last_packets[protocol]:
+                    protocols[protocol]['last'] = datetime.datetime.utcfromtimestamp(last_ts)
+                    last_packets[protocol] = last_packet
+            else:
+                # convert timestamps to UTC format
+                protocols[protocol] = {'number': number,
+                                       'first': datetime.datetime.utcfromtimestamp(first_ts),
+                                       'last': datetime.datetime.utcfromtimestamp(last_ts),
+                                       'mean_size': 0,
+                                       'sum_size': sum_size
+                                       }
+                last_packets[protocol] = last_packet
+
+            protocols[protocol]['mean_size'] = protocols[protocol]['sum_size'] / protocols[protocol]['number']
+
+        return protocols
 
 
 def protocol_info(packet_list: list[tuple]) -> dict[str, dict]:
@@ -15,72 +194,57 @@ def protocol_info(packet_list: list[tuple]) -> dict[str, dict]:
     :param packet_list: list of (packet_timestamp, packet_bytes) tuples
     :return: a dictionary with summary information for each protocol
     """
-    # dictionary to store attributes of each protocol
-    protocols = {}
-
-    for (timestamp, eth) in packet_list:
-        ip_layer = eth.data
-        # get protocol name from packet
-        try:
-            # protocol from ip layer
-            proto = ip_layer.get_proto(ip_layer.p).__name__
-        except AttributeError:
-            try:
-                # get protocol from ethernet layer if packet has no ip layer
-                proto = eth.get_type(eth.type).__name__
-            # if get_type fails to find protocol name use protocol number (e.g. LLDP = 35020)
-            except KeyError:
-                proto = eth.type
+    summary = ProtocolSummary()
+    run_pipeline(packet_list, [summary])
+    return summary.finish()
 
-        update_protocols(protocols, len(eth), proto, timestamp)
 
-    return protocols
+def packet_protocol_id(packet: PacketView) -> int:
+    """
+    get an id for the highest protocol dpkt would decode for a packet
+    :param packet: lazy view of packet
+    :return: IP protocol number, or ETH_TYPE_ID plus ethernet type if the packet has no ip layer
+    """
+    proto = packet.proto
+    # protocol from ip layer
+    if proto >= 0:
+        return proto
+    # protocol from ethernet layer if packet has no ip layer
+    return ETH_TYPE_ID + packet.ethertype
 
 
-def update_protocols(protocols: dict[str, dict], packet_size: int, protocol: str, timestamp: float) -> None:
+def protocol_name(protocol_id: int) -> str:
     """
-    add new protocol to protocols dictionary
-    updates info for a protocol in protocols dict
-    :param protocols: dictionary key: protocol value: protocol summary info
-    :param packet_size: size of packet
-    :param protocol: name of protocol for packet
-    :param timestamp: timestamp of packet
+    get the name of a protocol from its id
+    :param protocol_id: id from packet_protocol_id
+    :return: protocol name, or protocol number if it has no name
     """
-    # convert timestamp to UTC format
-    timestamp = datetime.datetime.utcfromtimestamp(timestamp)
+    try:
+        # protocol from ip layer
+        if protocol_id < ETH_TYPE_ID:
+            return dpkt.ip.IP.get_proto(protocol_id).__name__
+        # get protocol from ethernet layer if packet has no ip layer
+        return dpkt.ethernet.Ethernet.get_type(protocol_id - ETH_TYPE_ID).__name__
+    # if dpkt has no name for the protocol use protocol number (e.g. LLDP = 35020)
+    except KeyError:
+        return protocol_id if protocol_id < ETH_TYPE_ID else protocol_id - ETH_TYPE_ID
 
-    # set initial values in dictionary for new protocol
-    protocols.setdefault(protocol, {'number': 0,
-                                    'first': timestamp,
-                                    'last': timestamp,
-                                    'mean_size': 0,
-                                    'sum_size': 0
-                                    })
 
-    # calculates attributes new values for a protocol
-    protocols[protocol]['number'] += 1
-    protocols[protocol]['last'] = timestamp
-    protocols[protocol]['sum_size'] += packet_size
-    new_mean = protocols[protocol]['sum_size'] / protocols[protocol]['number']
-    protocols[protocol]['mean_size'] = new_mean
+# column headers of the protocol table
+PROTOCOL_HEADERS = ['Type',
+                    'Number',
+                    'First Timestamp',
+                    'Last Timestamp',
+                    'Mean Packet size'
+                    ]
 
 
-def protocol_table(protocols: dict[str, dict]) -> str:
+def protocol_rows(protocols: dict[str, dict]) -> Iterator[list]:
     """
-    create table from protocols dictionary
+    create a row of the protocol table for each protocol
     :param protocols: dictionary of with summary info for each protocol
-    :return: table information for each type of protocol
+    :return: iterator of rows with the PROTOCOL_HEADERS columns
     """
-    # list of headers for table
-    headers = ['Type',
-               'Number',
-               'First Timestamp',
-               'Last Timestamp',
-               'Mean Packet size'
-               ]
-    # list to store each row of table
-    rows = []
-
     # create a row for each type of protocol
     for (name, attributes) in protocols.items():
         # protocol type added to row
@@ -92,6 +256,13 @@ def protocol_table(protocols: dict[str, dict]) -> str:
         row.pop()
         # round mean_size as late as possible to reduces floating-point errors
         row[-1] = round(row[-1], 2)
-        rows.append(row)
+        yield row
+
 
-    return tabulate(rows, headers, tablefmt='pretty')
+def protocol_table(protocols: dict[str, dict]) -> str:
+    """
+    create table from protocols dictionary
+    :param protocols: dictionary of with summary info for each protocol
+    :return: table information for each type of protocol
+    """
+    return pretty_table(PROTOCOL_HEADERS, protocol_rows(protocols))
@@ -0,0 +1,308 @@
+"""sketches.py
+   fixed memory streaming sketches for captures too large to count exactly
+
+   SpaceSaving keeps the heaviest keys (e.g. top talker IP pairs) in a fixed number of counters,
+   each count is at most its error above the true count and every key with more than
+   total / capacity of the weight is kept
+   CountMin estimates the weight of any key (e.g. bytes of an IP pair) in a fixed table,
+   an estimate is never below the true weight and at most e / width of the total above it
+   with probability 1 - e^-depth
+   HyperLogLog estimates the number of distinct keys (e.g. source IPs) in 2^precision registers
+   with a relative standard error of 1.04 / sqrt(2^precision)
+
+   keys are unsigned integers up to 64 bits and are added in numpy batches,
+   sketches of the same size can be merged, so chunks of a capture can be sketched in parallel
+"""
+import heapq
+import math
+from typing import Optional
+import numpy as np
+
+# fixed seed so sketches built in different processes or runs can be merged
+SKETCH_SEED = 0x5eed
+
+# z score of a two sided 95% confidence interval
+Z_95 = 1.96
+
+_UINT64 = np.uint64
+
+
+def mix64(keys: np.ndarray) -> np.ndarray:
+    """
+    scramble keys with the splitmix64 finaliser so every bit of the hash depends on every bit of the key
+    :param keys: unsigned integer keys
+    :return: 64 bit hashes of the keys
+    """
+    hashes = keys.astype(_UINT64) + _UINT64(0x9e3779b97f4a7c15)
+    hashes = (hashes ^ (hashes >> _UINT64(30))) * _UINT64(0xbf58476d1ce4e5b9)
+    hashes = (hashes ^ (hashes >> _UINT64(27))) * _UINT64(0x94d049bb133111eb)
+    return hashes ^ (hashes >> _UINT64(31))
+
+
+def bit_length(values: np.ndarray) -> np.ndarray:
+    """
+    :param values: unsigned 64 bit integers
+    :return: number of bits needed for each value, 0 for 0
+    """
+    lengths = np.zeros(len(values), dtype=np.int64)
+    values = values.copy()
+    # binary search for the highest set bit
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >> _UINT64(shift)
+        found = high != 0
+        lengths[found] += shift
+        values[found] = high[found]
+    return lengths + values.astype(np.int64)
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters (Metwally et al.), the capacity heaviest keys with a count and error each
+    a new key takes over the counter of the lightest key, starting from its count
+    """
+
+    def __init__(self, capacity: int):
+        """
+        :param capacity: number of keys counted
+        """
+        self.capacity = capacity
+        # key: [count, error], the true weight of a key is between count - error and count
+        self.counters: dict[int, list[int]] = {}
+        # total weight added
+        self.total = 0
+        # (count, key) of each counter, counts of keys added to since are stale and refreshed when popped
+        self._heap: list[tuple[int, int]] = []
+
+    def update(self, keys: np.ndarray, weights: np.ndarray) -> None:
+        """
+        add a batch of keys, each key is added once with the sum of its weights
+        :param keys: unsigned integer keys
+        :param weights: weight of each key, e.g. 1 for each packet
+        """
+        if len(keys) == 0:
+            return
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse, weights=weights, minlength=len(unique_keys))
+        for key, weight in zip(unique_keys.tolist(), sums.astype(np.int64).tolist()):
+            self.add(key, weight)
+
+    def add(self, key: int, weight: int) -> None:
+        """
+        add weight to one key
+        :param key: unsigned integer key
+        :param weight: weight to add
+        """
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0]
+            heapq.heappush(self._heap, (weight, key))
+            return
+
+        # the lightest key gives up its counter, the new key may have been counted in it before
+        count, lightest = self._lightest()
+        heapq.heappop(self._heap)
+        del self.counters[lightest]
+        self.counters[key] = [count + weight, count]
+        heapq.heappush(self._heap, (count + weight, key))
+        # stale entries are dropped now and then so the heap stays the size of the counters
+        if len(self._heap) > 2 * self.capacity:
+            self._rebuild()
+
+    def _lightest(self) -> tuple[int, int]:
+        """
+        :return: (count, key) of the counter with the lowest count, at the top of the heap
+        """
+        heap = self._heap
+        while True:
+            count, key = heap[0]
+            counter = self.counters.get(key)
+            if counter is None:
+                heapq.heappop(heap)
+            elif counter[0] != count:
+                heapq.heapreplace(heap, (counter[0], key))
+            else:
+                return count, key
+
+    def _rebuild(self) -> None:
+        """
+        make the heap again from the counters
+        """
+        self._heap = [(count, key) for key, (count, unused_error) in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def min_count(self) -> int:
+        """
+        :return: lowest count when every counter is used, the most a key not counted can have, otherwise 0
+        """
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, unused_error in self.counters.values())
+
+    def merge(self, other: 'SpaceSaving') -> None:
+        """
+        add the keys counted by another sketch (Agarwal et al. mergeable summaries)
+        a key missing from one sketch may have up to its lowest count in it
+        :param other: sketch of the same capacity
+        """
+        own_min, other_min = self.min_count(), other.min_count()
+        combined = {}
+        for key in self.counters.keys() | other.counters.keys():
+            count, error = self.counters.get(key, (own_min, own_min))
+            other_count, other_error = other.counters.get(key, (other_min, other_min))
+            combined[key] = [count + other_count, error + other_error]
+
+        # only the heaviest keys are kept
+        if len(combined) > self.capacity:
+            combined = dict(heapq.nlargest(self.capacity, combined.items(), key=lambda item: item[1][0]))
+        self.counters = combined
+        self.total += other.total
+        self._rebuild()
+
+    def top(self, number: Optional[int] = None) -> list[tuple[int, int, int]]:
+        """
+        :param number: number of keys, None for every key counted
+        :return: list of (key, count, error) tuples, heaviest first
+        """
+        items = [(key, count, error) for key, (count, error) in self.counters.items()]
+        if number is not None:
+            return heapq.nlargest(number, items, key=lambda item: (item[1], item[0]))
+        return sorted(items, key=lambda item: (item[1], item[0]), reverse=True)
+
+    def error_bound(self) -> int:
+        """
+        :return: most any count is above the true count, every key heavier than this is counted
+        """
+        return self.total // self.capacity
+
+
+class CountMin:
+    """
+    Count-Min sketch (Cormode and Muthukrishnan), depth rows of width counters
+    each key adds to one counter in every row and is estimated by the smallest of them
+    """
+
+    def __init__(self, width: int = 1 << 16, depth: int = 4):
+        """
+        :param width: counters in each row, a power of two
+        :param depth: number of rows
+        """
+        if width & (width - 1):
+            raise ValueError('Count-Min width must be a power of two')
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+        # multiply-shift hashing, one odd multiplier for each row
+        generator = np.random.default_rng(SKETCH_SEED)
+        self._multipliers = generator.integers(0, 1 << 63, depth, dtype=np.uint64) * _UINT64(2) + _UINT64(1)
+        self._shift = _UINT64(64 - width.bit_length() + 1)
+
+    def _columns(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :param keys: unsigned integer keys
+        :return: depth x len(keys) array of the counter of each key in each row
+        """
+        hashes = mix64(keys)
+        return ((hashes[np.newaxis, :] * self._multipliers[:, np.newaxis]) >> self._shift).astype(np.intp)
+
+    def update(self, keys: np.ndarray, weights: np.ndarray) -> None:
+        """
+        add a batch of keys
+        :param keys: unsigned integer keys
+        :param weights: weight of each key, e.g. the size of each packet
+        """
+        if len(keys) == 0:
+            return
+        for row, columns in enumerate(self._columns(keys)):
+            self.table[row] += np.bincount(columns, weights=weights, minlength=self.width).astype(np.int64)
+        self.total += int(np.sum(weights))
+
+    def query(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :param keys: unsigned integer keys
+        :return: estimated weight of each key, never below the true weight
+        """
+        columns = self._columns(keys)
+        return self.table[np.arange(self.depth)[:, np.newaxis], columns].min(axis=0)
+
+    def merge(self, other: 'CountMin') -> None:
+        """
+        add the weights counted by another sketch of the same width and depth
+        :param other: sketch to add
+        """
+        self.table += other.table
+        self.total += other.total
+
+    def error_bound(self) -> int:
+        """
+        :return: most an estimate is above the true weight with probability confidence()
+        """
+        return math.ceil(math.e / self.width * self.total)
+
+    def confidence(self) -> float:
+        """
+        :return: probability an estimate is within error_bound of the true weight
+        """
+        return 1 - math.exp(-self.depth)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct counter (Flajolet et al.) with the linear counting correction for small counts
+    each register keeps the longest run of leading zero bits of the hashes sent to it
+    """
+
+    def __init__(self, precision: int = 14):
+        """
+        :param precision: log2 of the number of registers, 4 to 18
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError('HyperLogLog precision must be between 4 and 18')
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, keys: np.ndarray) -> None:
+        """
+        add a batch of keys
+        :param keys: unsigned integer keys
+        """
+        if len(keys) == 0:
+            return
+        hashes = mix64(keys)
+        bits = 64 - self.precision
+        registers = (hashes >> _UINT64(bits)).astype(np.intp)
+        rest = hashes & _UINT64((1 << bits) - 1)
+        # leading zeros of the remaining bits + 1, from the bit length found with integer shifts
+        # as rest can be above 2^53, where converting to float could round it up a bit
+        ranks = (bits + 1 - bit_length(rest)).astype(np.uint8)
+        np.maximum.at(self.registers, registers, ranks)
+
+    def count(self) -> int:
+        """
+        :return: estimated number of distinct keys added
+        """
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # few keys leave empty registers, counting those is more accurate
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        """
+        add the keys counted by another sketch of the same precision
+        :param other: sketch to add
+        """
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def relative_error(self) -> float:
+        """
+        :return: relative error of count with 95% confidence
+        """
+        return Z_95 * 1.04 / math.sqrt(len(self.registers))
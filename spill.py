@@ -0,0 +1,386 @@
+"""spill.py
+   script to keep the state of an analysis within a memory budget by spilling it to disk,
+   for captures with too many IP pairs, emails or URIs to count in memory
+
+   a SpillStore is used in place of a dict, once its entries use more than half its budget
+   they are written sorted by key to a run file and the store starts again empty,
+   reading the store merges every run with an external merge: a key found in several runs
+   has its values combined and keeps the place it was first added in,
+   so the items come out the same as from a dict that was never spilled
+
+   external_sorted sorts more items than fit in the budget the same way, in sorted runs merged at the end
+   runs are pickled in blocks of RUN_BLOCK items, only one block of each run is in memory while merging
+   run files are made in a directory the caller removes once the report is written
+"""
+import heapq
+import os
+import pickle
+import sys
+import tempfile
+from copy import deepcopy
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, Optional
+
+# items pickled together in a run file
+RUN_BLOCK = 256
+
+# bytes a dict uses for each entry besides its key and value (hash, pointers and free slots)
+DICT_ENTRY_BYTES = 48
+
+
+def item_size(item: Any) -> int:
+    """
+    :param item: key, value or row, e.g. a list of counts
+    :return: rough bytes used by the item and the values it holds
+    """
+    size = sys.getsizeof(item)
+    if isinstance(item, (list, tuple)):
+        size += sum(sys.getsizeof(value) for value in item)
+    return size
+
+
+def keep_first(first: Any, unused_later: Any) -> Any:
+    """
+    combine the values of a key by keeping the value it was first added with, like dict.setdefault
+    :param first: value the key was first added with
+    :param unused_later: value the key was added with later
+    :return: first
+    """
+    return first
+
+
+def add_counts(first: list[int], later: list[int]) -> list[int]:
+    """
+    combine the values of a key by adding up its counts, e.g. [packets, bytes]
+    :param first: counts the key was first added with
+    :param later: counts the key was added with later
+    :return: sum of each count
+    """
+    return [count + other for count, other in zip(first, later)]
+
+
+class RunFile:
+    """
+    items written in order to a temporary file, read back one block at a time
+    """
+
+    def __init__(self, items: Iterable, directory: Optional[str] = None):
+        """
+        :param items: items in the order they are read back
+        :param directory: directory the file is made in, None for the system temporary directory
+        """
+        handle, self.path = tempfile.mkstemp(prefix='run-', dir=directory)
+        # a run read by more than one store is left for the caller to remove with the directory
+        self.shared = False
+        with os.fdopen(handle, 'wb') as run:
+            block = []
+            for item in items:
+                block.append(item)
+                if len(block) == RUN_BLOCK:
+                    pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+                    block = []
+            if block:
+                pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self) -> Iterator:
+        with open(self.path, 'rb') as run:
+            while True:
+                try:
+                    block = pickle.load(run)
+                except EOFError:
+                    return
+                yield from block
+
+    def remove(self) -> None:
+        """
+        delete the file once it is not read again
+        """
+        os.remove(self.path)
+
+
+def merge_runs(runs: list, key: Callable, reverse: bool, fan_in: int, directory: Optional[str]) -> Iterator:
+    """
+    merge sorted runs into one sorted stream, equal items come from the earlier run first
+    when there are more runs than can be read at once, each fan_in runs next to each other
+    are merged into a longer run first, these runs are removed once read
+    :param runs: sorted iterables, e.g. RunFiles
+    :param key: sort key of an item
+    :param reverse: runs are sorted largest first
+    :param fan_in: most runs read at once
+    :param directory: directory runs are made in
+    :return: generator of every item in sorted order
+    """
+    runs = list(runs)
+    made = []
+    try:
+        while len(runs) > fan_in:
+            merged = [RunFile(heapq.merge(*runs[start:start + fan_in], key=key, reverse=reverse), directory)
+                      for start in range(0, len(runs), fan_in)]
+            for run in made:
+                run.remove()
+            runs = made = merged
+        yield from heapq.merge(*runs, key=key, reverse=reverse)
+    finally:
+        for run in made:
+            run.remove()
+
+
+def fan_in(max_bytes: int, size: int) -> int:
+    """
+    :param max_bytes: bytes the merge may use
+    :param size: rough bytes of an item
+    :return: number of runs whose blocks fit in the budget, at least two
+    """
+    return max(2, max_bytes // (RUN_BLOCK * max(size, 1)))
+
+
+def external_sorted(items: Iterable, max_bytes: int, directory: Optional[str] = None,
+                    key: Optional[Callable] = None, reverse: bool = False) -> Iterator:
+    """
+    sort items in memory while they fit in half the budget, otherwise in sorted runs merged at the end,
+    equal items come out in the order they were given, like sorted
+    :param items: items to sort
+    :param max_bytes: bytes the sort may use
+    :param directory: directory runs are made in, None for the system temporary directory
+    :param key: sort key of an item, None to compare the items
+    :param reverse: sort largest first
+    :return: generator of the items in sorted order
+    """
+    runs = []
+    chunk = []
+    size = 0
+    try:
+        for item in items:
+            chunk.append(item)
+            size += item_size(item) + 8
+            if size > max_bytes // 2:
+                chunk.sort(key=key, reverse=reverse)
+                runs.append(RunFile(chunk, directory))
+                chunk = []
+                size = 0
+        chunk.sort(key=key, reverse=reverse)
+        if not runs:
+            yield from chunk
+            return
+
+        # the items left are the last run, read straight from memory
+        item_bytes = item_size(chunk[0]) if chunk else 64
+        yield from merge_runs(runs + [chunk], key, reverse, fan_in(max_bytes // 2, item_bytes), directory)
+    finally:
+        for run in runs:
+            run.remove()
+
+
+def record_order(record: tuple[Any, int, Any]) -> tuple[Any, int]:
+    """
+    :param record: (key, position first added, value) record of a SpillStore run
+    :return: key then position, the order records are merged in
+    """
+    return record[0], record[1]
+
+
+class SpillStore:
+    """
+    ordered map kept within a memory budget, with the dict methods the analysers use
+    items are given in the order keys were first added, with the values of a key spilled
+    in different runs combined, e.g. counts added up
+    values got from the store are only changed in place until the next key is added
+    """
+
+    def __init__(self, max_bytes: int, directory: Optional[str] = None, combine: Callable = keep_first):
+        """
+        :param max_bytes: bytes the store may use, entries are spilled once they use half
+        :param directory: directory run files are made in, None for the system temporary directory
+        :param combine: function combining two values of a key, first added first, e.g. add_counts
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.combine = combine
+        # entries added since the last spill, in the order they were added
+        self.entries: dict = {}
+        self.size = 0
+        # run files of (key, position first added, value) records sorted by key, oldest first
+        self.runs: list[RunFile] = []
+        # number of times the records of each run have been merged
+        self.levels: list[int] = []
+        # position of the first entry in entries among every key added
+        self.base = 0
+        # rough bytes of an entry, measured at the last spill
+        self.entry_size = 64
+
+    @property
+    def spilled(self) -> bool:
+        """
+        :return: True once any entries have been written to a run
+        """
+        return bool(self.runs)
+
+    def empty_like(self, combine: Optional[Callable] = None) -> 'SpillStore':
+        """
+        :param combine: function combining two values of a key, None for this stores function
+        :return: empty store with the same budget and directory
+        """
+        return SpillStore(self.max_bytes, self.directory, combine or self.combine)
+
+    def _reserve(self, key: Any, value: Any) -> None:
+        """
+        count a new entry against the budget, spilling the entries first if it does not fit
+        :param key: key of the entry
+        :param value: value of the entry
+        """
+        size = DICT_ENTRY_BYTES + item_size(key) + item_size(value)
+        if self.entries and self.size + size > self.max_bytes // 2:
+            self.spill()
+        self.size += size
+
+    def spill(self) -> None:
+        """
+        write the entries to a run sorted by key and start again empty
+        """
+        if not self.entries:
+            return
+        self.entry_size = max(self.size // len(self.entries), 1)
+        records = sorted(((key, self.base + position, value)
+                          for position, (key, value) in enumerate(self.entries.items())),
+                         key=lambda record: record[0])
+        self.runs.append(RunFile(records, self.directory))
+        self.levels.append(0)
+        del records
+        self.base += len(self.entries)
+        self.entries = {}
+        self.size = 0
+        self._compact()
+
+    def _compact(self) -> None:
+        """
+        while the last runs are fan_in runs of the same level, merge them into one run of the next level
+        with the values of each key combined, so the runs are read with one merge however many spills there were
+        """
+        width = fan_in(self.max_bytes // 4, self.entry_size)
+        while len(self.levels) >= width and len(set(self.levels[-width:])) == 1:
+            runs = self.runs[-width:]
+            merged = RunFile(self._fold(heapq.merge(*runs, key=record_order)), self.directory)
+            for run in runs:
+                if not run.shared:
+                    run.remove()
+            self.runs[-width:] = [merged]
+            self.levels[-width:] = [self.levels[-1] + 1]
+
+    def _fold(self, records: Iterable[tuple[Any, int, Any]]) -> Iterator[tuple[Any, int, Any]]:
+        """
+        :param records: (key, position first added, value) records sorted by key then position
+        :return: generator of one record for each key, at its first position with its values combined
+        """
+        current = None
+        for key, position, value in records:
+            if current is not None and current[0] == key:
+                current[2] = self.combine(current[2], value)
+            else:
+                if current is not None:
+                    yield tuple(current)
+                current = [key, position, value]
+        if current is not None:
+            yield tuple(current)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """
+        :param key: key of an entry
+        :param default: returned when the key has not been added since the last spill
+        :return: value of the key added since the last spill, or default
+        """
+        return self.entries.get(key, default)
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        """
+        add a key, or replace the value it was added with since the last spill
+        """
+        if key not in self.entries:
+            self._reserve(key, value)
+        self.entries[key] = value
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        """
+        :param key: key of an entry
+        :param default: value of a key not added since the last spill
+        :return: value of the key
+        """
+        if key not in self.entries:
+            self._reserve(key, default)
+            self.entries[key] = default
+        return self.entries[key]
+
+    def update(self, other) -> None:
+        """
+        add every item of a dict or store in order, replacing the value of keys added since the last spill
+        :param other: dict or SpillStore
+        """
+        for key, value in other.items():
+            self[key] = value
+
+    def copy(self) -> 'SpillStore':
+        """
+        :return: store with the same items, sharing the run files of a spilled store
+        """
+        copy = self.empty_like()
+        if self.spilled:
+            # the entries are spilled so both stores read them from the same file
+            self.spill()
+            for run in self.runs:
+                run.shared = True
+            copy.runs = list(self.runs)
+            copy.levels = list(self.levels)
+            copy.base = self.base
+            copy.entry_size = self.entry_size
+        else:
+            copy.entries = dict(self.entries)
+            copy.size = self.size
+        return copy
+
+    def __deepcopy__(self, memo: dict) -> 'SpillStore':
+        # run files are shared rather than copied, so neither store removes a file the other reads
+        copy = self.copy()
+        copy.entries = deepcopy(copy.entries, memo)
+        return copy
+
+    def records(self) -> Iterator[tuple[Any, int, Any]]:
+        """
+        :return: generator of (key, position first added, value) records for each key, sorted by key,
+                 with every value of a key combined in the order they were added
+        """
+        self.spill()
+        return self._fold(merge_runs(self.runs, record_order, False, fan_in(self.max_bytes // 4, self.entry_size),
+                                     self.directory))
+
+    def items(self) -> Iterator[tuple[Any, Any]]:
+        """
+        :return: generator of (key, value) tuples in the order the keys were first added
+        """
+        if not self.spilled:
+            yield from self.entries.items()
+            return
+        for key, unused_position, value in external_sorted(self.records(), self.max_bytes // 2, self.directory,
+                                                           key=lambda record: record[1]):
+            yield key, value
+
+    def __iter__(self) -> Iterator:
+        return (key for key, unused_value in self.items())
+
+    def values(self) -> Iterator:
+        """
+        :return: generator of the values in the order their keys were first added
+        """
+        return (value for unused_key, value in self.items())
+
+
+def sort_rows(rows: Iterable, like, key: Optional[Callable] = None, reverse: bool = False) -> list:
+    """
+    sort the rows of a table built from a dict or SpillStore
+    :param rows: rows to sort
+    :param like: dict or SpillStore the rows were built from, a SpillStore sorts within its budget
+    :param key: sort key of a row
+    :param reverse: sort largest first
+    :return: list of sorted rows, or a generator for a spilled store
+    """
+    if isinstance(like, SpillStore) and like.spilled:
+        return external_sorted(rows, like.max_bytes, like.directory, key, reverse)
+    return sorted(rows, key=key, reverse=reverse)
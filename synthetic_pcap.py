@@ -0,0 +1,274 @@
+"""synthetic_pcap.py
+   script to write a deterministic synthetic pcap file for benchmarks
+   the same size, mix and seed always give a byte for byte identical capture
+
+   packets are a mix of ARP, LLDP, ICMP, UDP (DNS), SMTP headers split over segments,
+   HTTP image requests and responses and other TCP traffic between many IP pairs
+   frames are built from raw bytes so millions of packets can be written quickly
+"""
+import argparse
+import random
+import socket
+import struct
+from mmdb_writer import TEST_LOCATIONS
+
+# fraction of packets of each kind
+DEFAULT_MIX = {'arp': 0.04,
+               'lldp': 0.01,
+               'icmp': 0.05,
+               'udp': 0.25,
+               'smtp': 0.10,
+               'http': 0.15,
+               'tcp': 0.40}
+
+# timestamp of the first packet
+START_TIME = 1550000000.0
+
+IMAGES = ('logo.png', 'banner.gif', 'photo.JPG', 'index.html', 'thumb.jpg', 'style.css')
+IMAGE_MAGIC = {'png': b'\x89PNG\r\n\x1a\n', 'gif': b'GIF89a', 'jpg': b'\xff\xd8\xff\xe0'}
+
+_pcap_header = struct.Struct('<IHHiIII')
+_record_header = struct.Struct('<IIII')
+_ethernet = struct.Struct('>6s6sH')
+_ipv4 = struct.Struct('>BBHHHBBH4s4s')
+_tcp = struct.Struct('>HHIIBBHHH')
+_udp = struct.Struct('>HHHH')
+_icmp = struct.Struct('>BBHHH')
+
+IP_PROTO_ICMP = 1
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+TCP_PSH_ACK = 0x18
+
+
+class CaptureWriter:
+    """
+    writes frames of each kind of traffic to a pcap file
+    all randomness comes from one seeded generator
+    """
+
+    def __init__(self, open_file, seed: int = 0, hosts: int = 1000, rate: float = 10000.0):
+        """
+        :param open_file: file opened for writing in binary mode
+        :param seed: seed of the random generator
+        :param hosts: number of IPv4 hosts, pairs are picked at random between them
+        :param rate: mean packets per second
+        """
+        self.open_file = open_file
+        self.random = random.Random(seed)
+        self.rate = rate
+        self.timestamp = START_TIME
+        self.ip_id = 0
+        # number of records written
+        self.packets = 0
+
+        # half the hosts are private, the rest are in networks the test database knows
+        networks = [network.split('/')[0] for network in TEST_LOCATIONS]
+        self.hosts = []
+        for number in range(hosts):
+            if number % 2:
+                base = int.from_bytes(socket.inet_aton(networks[number // 2 % len(networks)]), 'big')
+                self.hosts.append(struct.pack('>I', base + 1 + number // 2 // len(networks) % 250))
+            else:
+                self.hosts.append(struct.pack('>I', 0x0a000000 + 1 + number // 2))
+        self.macs = [bytes([2, 0]) + host for host in self.hosts]
+        # (src, dst, sport, dport): next sequence number, so TCP streams reassemble
+        self.sequences = {}
+
+        open_file.write(_pcap_header.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+
+    def write_frame(self, frame: bytes) -> None:
+        """
+        write one record, frames are padded to the ethernet minimum
+        :param frame: ethernet frame
+        """
+        self.timestamp += self.random.expovariate(self.rate)
+        if len(frame) < 60:
+            frame += bytes(60 - len(frame))
+        seconds = int(self.timestamp)
+        self.open_file.write(_record_header.pack(seconds, int((self.timestamp - seconds) * 1E6),
+                                                 len(frame), len(frame)))
+        self.open_file.write(frame)
+        self.packets += 1
+
+    def pick_pair(self) -> tuple[int, int]:
+        """
+        :return: (source, destination) host numbers
+        """
+        return self.random.randrange(len(self.hosts)), self.random.randrange(len(self.hosts))
+
+    def ip_frame(self, src: int, dst: int, proto: int, payload: bytes) -> bytes:
+        """
+        :param src: source host number
+        :param dst: destination host number
+        :param proto: IP protocol number
+        :param payload: IP payload
+        :return: ethernet frame of an IPv4 packet
+        """
+        self.ip_id = (self.ip_id + 1) & 0xffff
+        ip_header = _ipv4.pack(0x45, 0, 20 + len(payload), self.ip_id, 0, 64, proto, 0,
+                               self.hosts[src], self.hosts[dst])
+        return _ethernet.pack(self.macs[dst], self.macs[src], 0x0800) + ip_header + payload
+
+    def tcp_segment(self, src: int, dst: int, sport: int, dport: int, payload: bytes) -> None:
+        """
+        write a TCP segment following on from the last segment of its stream
+        :param src: source host number
+        :param dst: destination host number
+        :param sport: source port
+        :param dport: destination port
+        :param payload: TCP data
+        """
+        key = (src, dst, sport, dport)
+        seq = self.sequences.pop(key, None)
+        if seq is None:
+            seq = self.random.randrange(1 << 32)
+        # keep the most recent streams only, so memory stays bounded for large captures
+        self.sequences[key] = (seq + len(payload)) & 0xffffffff
+        if len(self.sequences) > 4096:
+            del self.sequences[next(iter(self.sequences))]
+
+        header = _tcp.pack(sport, dport, seq, 0, 5 << 4, TCP_PSH_ACK, 65535, 0, 0)
+        self.write_frame(self.ip_frame(src, dst, IP_PROTO_TCP, header + payload))
+
+    def arp(self) -> None:
+        """
+        write an ARP request
+        """
+        src, dst = self.pick_pair()
+        arp = struct.pack('>HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, self.macs[src], self.hosts[src],
+                          bytes(6), self.hosts[dst])
+        self.write_frame(_ethernet.pack(b'\xff' * 6, self.macs[src], 0x0806) + arp)
+
+    def lldp(self) -> None:
+        """
+        write an LLDP frame
+        """
+        src = self.random.randrange(len(self.hosts))
+        # chassis id, port id, time to live and end TLVs
+        tlvs = b'\x02\x07\x04' + self.macs[src] + b'\x04\x03\x07p1\x06\x02\x00\x78\x00\x00'
+        self.write_frame(_ethernet.pack(b'\x01\x80\xc2\x00\x00\x0e', self.macs[src], 0x88cc) + tlvs)
+
+    def icmp(self) -> None:
+        """
+        write an ICMP echo request
+        """
+        src, dst = self.pick_pair()
+        echo = _icmp.pack(8, 0, 0, 1, self.ip_id) + b'p' * 32
+        self.write_frame(self.ip_frame(src, dst, IP_PROTO_ICMP, echo))
+
+    def udp(self) -> None:
+        """
+        write a DNS sized UDP datagram
+        """
+        src, dst = self.pick_pair()
+        query = b'q' * self.random.randrange(12, 200)
+        datagram = _udp.pack(self.random.randrange(1024, 65535), 53, 8 + len(query), 0) + query
+        self.write_frame(self.ip_frame(src, dst, IP_PROTO_UDP, datagram))
+
+    def smtp(self) -> None:
+        """
+        write the headers of an email, sometimes split over two segments
+        """
+        src, dst = self.pick_pair()
+        user = self.random.randrange(1000)
+        message = (f'MAIL FROM:<u{user}@example.com>\r\n'
+                   f'From: User {user} <user{user}@example.com>\r\n'
+                   f'To: Bob <bob{user % 37}@mail.example.org>\r\n'
+                   f'Subject: report\r\n\r\nbody\r\n').encode()
+        sport = 1024 + user
+        # some headers are split between two segments of the same stream
+        if self.random.random() < 0.3:
+            cut = self.random.randrange(1, len(message))
+            self.tcp_segment(src, dst, sport, 25, message[:cut])
+            self.tcp_segment(src, dst, sport, 25, message[cut:])
+        else:
+            self.tcp_segment(src, dst, sport, 25, message)
+
+    def http(self) -> None:
+        """
+        write a HTTP request, followed by a response to half the requests
+        """
+        src, dst = self.pick_pair()
+        image = self.random.choice(IMAGES)
+        sport = self.random.randrange(1024, 65535)
+        request = (f'GET /static/{image}?v={self.random.randrange(5)} HTTP/1.1\r\n'
+                   f'Host: www.site{dst % 50}.com\r\nUser-Agent: bench\r\n\r\n').encode()
+        self.tcp_segment(src, dst, sport, 80, request)
+
+        # half the requests get a response, images start with their magic bytes
+        if self.random.random() < 0.5:
+            extension = image.rsplit('.', 1)[1].lower()
+            body = IMAGE_MAGIC.get(extension, b'<html></html>') + bytes(self.random.randrange(0, 400))
+            content_type = f'image/{extension}' if extension in IMAGE_MAGIC else 'text/html'
+            response = (f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n'
+                        f'Content-Length: {len(body)}\r\n\r\n').encode() + body
+            self.tcp_segment(dst, src, 80, sport, response)
+
+    def tcp(self) -> None:
+        """
+        write a TCP segment with random data
+        """
+        src, dst = self.pick_pair()
+        payload = self.random.randbytes(self.random.randrange(0, 300))
+        self.tcp_segment(src, dst, self.random.randrange(1024, 65535),
+                         self.random.choice((443, 22, 8080)), payload)
+
+
+def write_capture(file_name: str, packets: int, seed: int = 0, mix: dict[str, float] = None,
+                  hosts: int = 1000, rate: float = 10000.0) -> int:
+    """
+    write a synthetic pcap file
+    :param file_name: path of the pcap file
+    :param packets: number of packets to write, at least
+    :param seed: seed of the random generator
+    :param mix: fraction of packets of each kind, keys from DEFAULT_MIX
+    :param hosts: number of IPv4 hosts
+    :param rate: mean packets per second
+    :return: number of packets written, SMTP and HTTP can write more than one packet at a time
+    """
+    if mix is None:
+        mix = DEFAULT_MIX
+    with open(file_name, 'wb', buffering=1 << 20) as open_file:
+        writer = CaptureWriter(open_file, seed, hosts, rate)
+        kinds = [getattr(writer, kind) for kind in mix]
+        weights = list(mix.values())
+        while writer.packets < packets:
+            # pick kinds in blocks rather than calling choices for every packet
+            for write in writer.random.choices(kinds, weights, k=min(4096, packets - writer.packets)):
+                write()
+    return writer.packets
+
+
+def main() -> None:
+    """
+    process command line arguments and write a synthetic capture
+    """
+    parser = argparse.ArgumentParser(description='Write a deterministic synthetic pcap file')
+    parser.add_argument('-o', '--output',
+                        metavar='',
+                        default='synthetic.pcap',
+                        help='path of the pcap file (default synthetic.pcap)')
+    parser.add_argument('-n', '--packets',
+                        metavar='',
+                        type=int,
+                        default=100000,
+                        help='number of packets to write (default 100000)')
+    parser.add_argument('-s', '--seed',
+                        metavar='',
+                        type=int,
+                        default=0,
+                        help='seed of the random generator (default 0)')
+    parser.add_argument('--hosts',
+                        metavar='',
+                        type=int,
+                        default=1000,
+                        help='number of IPv4 hosts packets are sent between (default 1000)')
+    args = parser.parse_args()
+
+    packets = write_capture(args.output, args.packets, args.seed, hosts=args.hosts)
+    print(f'{packets} packets Saved as {args.output}')
+
+
+if __name__ == '__main__':
+    main()
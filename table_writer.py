@@ -0,0 +1,121 @@
+"""table_writer.py
+   script to write the tables of a report as pretty tables, CSV, JSON or JSON lines
+
+   CSV, JSON and JSON lines rows are written as they are produced, the table is never held in memory
+   and each row is one object keyed by the column names (e.g. 'Mean Packet size' is mean_packet_size)
+   JSON writes one {"report": name, table name: [rows], ...} document for each report,
+   opened by begin_report and closed by end_report, JSON lines one object per row with the name of its table,
+   CSV a header row and rows for each table, each row starting with the name of its table
+
+   the pretty table is built with tabulate, which has to see every row to find the width of each column,
+   it stays the default for reading small reports
+
+   when tables are written in a structured format, messages about the run go to stderr
+   so stdout only holds tables
+"""
+import csv
+import json
+import re
+import sys
+from collections.abc import Iterable
+from typing import Optional, TextIO
+
+# formats tables can be written in
+FORMATS = ('pretty', 'json', 'jsonl', 'csv')
+
+
+def field_name(header: str) -> str:
+    """
+    :param header: column header of a pretty table, e.g. 'Source -> Destination IP'
+    :return: name of the column in structured formats, e.g. source_destination_ip
+    """
+    return re.sub(r'[^a-z0-9]+', '_', header.lower()).strip('_')
+
+
+def status_stream(output_format: str) -> TextIO:
+    """
+    :param output_format: format tables are written in
+    :return: stream for messages about the run, stderr when tables are written in a structured format
+    """
+    return sys.stdout if output_format == 'pretty' else sys.stderr
+
+
+def pretty_table(headers: list[str], rows: Iterable, empty: Optional[str] = None, **options) -> str:
+    """
+    :param headers: column headers
+    :param rows: rows of the table
+    :param empty: message returned instead of a table with no rows, None for a table with only headers
+    :param options: other tabulate options, e.g. stralign
+    :return: table as a string
+    """
+    from tabulate import tabulate
+
+    rows = list(rows)
+    if not rows and empty is not None:
+        return empty
+    return tabulate(rows, headers, tablefmt='pretty', **options)
+
+
+def begin_report(name: str, output_format: str, stream: Optional[TextIO] = None) -> None:
+    """
+    start a report, the tables written until end_report are one JSON document
+    :param name: name of the report, e.g. the pcap file name
+    :param output_format: one of FORMATS
+    :param stream: stream to write to, None for stdout
+    """
+    if output_format == 'json':
+        # every table is written after a separator, so the name of the report is the first key
+        (stream or sys.stdout).write(f'{{"report": {json.dumps(name)}')
+
+
+def end_report(output_format: str, stream: Optional[TextIO] = None) -> None:
+    """
+    finish a report started with begin_report
+    :param output_format: one of FORMATS
+    :param stream: stream to write to, None for stdout
+    """
+    if output_format == 'json':
+        (stream or sys.stdout).write('\n}\n')
+
+
+def write_table(name: str, headers: list[str], rows: Iterable, output_format: str = 'pretty',
+                empty: Optional[str] = None, stream: Optional[TextIO] = None, **options) -> None:
+    """
+    write a table to a stream, rows are written as they are read from rows except as a pretty table,
+    a JSON table is written between begin_report and end_report
+    :param name: name of the table in structured formats, e.g. ip_pairs
+    :param headers: column headers
+    :param rows: rows of the table, e.g. a generator
+    :param output_format: one of FORMATS
+    :param empty: message printed instead of a pretty table with no rows
+    :param stream: stream to write to, None for stdout
+    :param options: other tabulate options for a pretty table
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    if output_format == 'pretty':
+        print(pretty_table(headers, rows, empty, **options), file=stream)
+    elif output_format == 'csv':
+        # the tables of a report are written one after another, so each row starts with its table name
+        writer = csv.writer(stream, lineterminator='\n')
+        writer.writerow(['table'] + [field_name(header) for header in headers])
+        writer.writerows([name] + list(row) for row in rows)
+    elif output_format == 'jsonl':
+        fields = [field_name(header) for header in headers]
+        for row in rows:
+            # values json cannot write, e.g. datetimes, are written as strings
+            stream.write(json.dumps({'table': name, **dict(zip(fields, row))}, default=str))
+            stream.write('\n')
+    elif output_format == 'json':
+        fields = [field_name(header) for header in headers]
+        # the table is one key of the report document started by begin_report
+        stream.write(f',\n{json.dumps(name)}: [')
+        separator = '\n'
+        for row in rows:
+            stream.write(separator)
+            stream.write(json.dumps(dict(zip(fields, row)), default=str))
+            separator = ',\n'
+        stream.write('\n]')
+    else:
+        raise ValueError(f'unknown table format {output_format!r}')
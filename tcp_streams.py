@@ -0,0 +1,185 @@
+"""tcp_streams.py
+   script to reassemble the data of TCP streams from individual segments
+   each direction of a connection is a separate stream keyed by
+   (source IP, destination IP, source port, destination port)
+
+   segments are put back in sequence order, retransmitted bytes are dropped
+   out of order segments and unread data are held in bounded buffers
+   streams that have been idle for too long are evicted
+"""
+from collections import OrderedDict
+from typing import Optional
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+# sequence numbers wrap around at 2^32
+SEQ_MASK = 0xffffffff
+# segments further than this from the expected sequence number restart the stream
+MAX_SEQ_JUMP = 1 << 24
+
+
+class TcpStream:
+    """
+    reassembly state for one direction of a TCP connection
+    buffer and state are left for the code reading the stream to use
+    """
+    __slots__ = ('next_seq', 'pending', 'pending_size', 'delivered', 'last_seen', 'buffer', 'state')
+
+    def __init__(self, next_seq: int, timestamp: float):
+        """
+        :param next_seq: sequence number of the next byte in the stream
+        :param timestamp: timestamp of the first segment seen
+        """
+        self.next_seq = next_seq
+        # out of order segments waiting for the gap before them: sequence number: data
+        self.pending: dict[int, bytes] = {}
+        self.pending_size = 0
+        # number of bytes delivered in order so far
+        self.delivered = 0
+        self.last_seen = timestamp
+        # data delivered but not yet used by the reader of the stream
+        self.buffer = bytearray()
+        self.state = None
+
+    def remaining(self) -> bytes:
+        """
+        data not yet read from the stream, including out of order segments after a gap
+        :return: unread bytes in sequence order
+        """
+        return bytes(self.buffer) + b''.join(self.pending[seq] for seq in sorted(self.pending))
+
+
+class StreamTable:
+    """
+    table of TCP streams being reassembled
+    streams are kept in order of last activity so idle streams can be evicted cheaply
+    """
+
+    def __init__(self, idle_timeout: float = 120.0, max_streams: int = 65536,
+                 max_pending: int = 65536):
+        """
+        :param idle_timeout: seconds without a segment before a stream is evicted
+        :param max_streams: most streams kept, the least recently active are evicted first
+        :param max_pending: most bytes of out of order segments held for each stream
+        """
+        self.idle_timeout = idle_timeout
+        self.max_streams = max_streams
+        self.max_pending = max_pending
+        self.streams: OrderedDict = OrderedDict()
+
+    def add(self, key: tuple, timestamp: float, seq: int, flags: int,
+            payload: bytes) -> tuple[TcpStream, bytes]:
+        """
+        add a segment to its stream
+        :param key: (source IP, destination IP, source port, destination port) of segment
+        :param timestamp: timestamp of packet
+        :param seq: sequence number of segment
+        :param flags: TCP flags of segment
+        :param payload: TCP data of segment
+        :return: (stream, data newly available in sequence order) tuple
+        """
+        stream = self.streams.get(key)
+        # data starts after the SYN
+        start = (seq + 1) & SEQ_MASK if flags & TCP_SYN else seq
+
+        if stream is None:
+            stream = self.streams[key] = TcpStream(start, timestamp)
+        else:
+            self.streams.move_to_end(key)
+            stream.last_seen = timestamp
+
+        if not payload:
+            return stream, b''
+
+        ahead = (start - stream.next_seq) & SEQ_MASK
+        behind = (stream.next_seq - start) & SEQ_MASK
+
+        # segment is unrelated to the data seen so far, e.g. a reused port
+        if min(ahead, behind) > MAX_SEQ_JUMP:
+            stream.next_seq = start
+            stream.pending.clear()
+            stream.pending_size = 0
+            ahead = 0
+
+        if ahead == 0:
+            data = payload
+        elif ahead < behind:
+            # segment after a gap, hold it until the gap is filled
+            if start not in stream.pending:
+                stream.pending[start] = payload
+                stream.pending_size += len(payload)
+            # give up waiting for the gap once too much is held
+            if stream.pending_size > self.max_pending:
+                stream.next_seq = min(stream.pending,
+                                      key=lambda pending_seq: (pending_seq - stream.next_seq) & SEQ_MASK)
+                return stream, self._drain(stream, b'')
+            return stream, b''
+        elif behind < len(payload):
+            # retransmission overlapping new data, keep only the new bytes
+            data = payload[behind:]
+        else:
+            # retransmission of data already delivered
+            return stream, b''
+
+        stream.next_seq = (stream.next_seq + len(data)) & SEQ_MASK
+        return stream, self._drain(stream, data)
+
+    def _drain(self, stream: TcpStream, data: bytes) -> bytes:
+        """
+        append any held segments that now follow on from the delivered data
+        :param stream: stream to drain
+        :param data: data just delivered
+        :return: data with the following held segments appended
+        """
+        while stream.pending:
+            for pending_seq in list(stream.pending):
+                behind = (stream.next_seq - pending_seq) & SEQ_MASK
+                # segment is still after a gap
+                if behind > MAX_SEQ_JUMP:
+                    continue
+                segment = stream.pending.pop(pending_seq)
+                stream.pending_size -= len(segment)
+                # keep only bytes not already delivered
+                if behind < len(segment):
+                    data += segment[behind:]
+                    stream.next_seq = (stream.next_seq + len(segment) - behind) & SEQ_MASK
+                break
+            else:
+                break
+
+        stream.delivered += len(data)
+        return data
+
+    def reverse(self, key: tuple) -> Optional[TcpStream]:
+        """
+        find the other direction of a connection
+        :param key: (source IP, destination IP, source port, destination port) of a stream
+        :return: stream from the destination back to the source, None if there is none
+        """
+        return self.streams.get((key[1], key[0], key[3], key[2]))
+
+    def remove(self, key: tuple) -> Optional[TcpStream]:
+        """
+        remove a stream, e.g. when it is closed with FIN or RST
+        :param key: key of stream
+        :return: stream removed, None if there was no stream
+        """
+        return self.streams.pop(key, None)
+
+    def expire(self, timestamp: float) -> list[tuple[tuple, TcpStream]]:
+        """
+        evict streams idle for longer than the idle timeout
+        and the least recently active streams when there are too many
+        :param timestamp: timestamp of the latest packet
+        :return: list of (key, stream) tuples evicted
+        """
+        evicted = []
+        streams = self.streams
+        while streams:
+            stream = next(iter(streams.values()))
+            if stream.last_seen >= timestamp - self.idle_timeout and len(streams) <= self.max_streams:
+                break
+            evicted.append(streams.popitem(last=False))
+        return evicted
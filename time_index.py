@@ -0,0 +1,243 @@
+"""time_index.py
+   script to keep a sparse index of the timestamps in a pcap file in a sidecar file
+   so a time window of a large capture can be read without parsing it from the start
+
+   the capture is split into blocks of a fixed number of packets,
+   the offset, first packet number and earliest and latest timestamp of each block are stored
+   a window is found with two binary searches, only blocks that can hold packets
+   in the window are read, so packets slightly out of order are still found
+
+   the index is built the first time a window is asked for and saved next to the capture,
+   later runs reuse it and a capture that has grown only has its new blocks added
+"""
+import mmap
+import os
+import pickle
+import struct
+from datetime import datetime, timezone
+from typing import Optional
+import numpy as np
+from analysis_cache import fingerprint, same_capture
+from parse_pcap import FILE_HEADER_SIZE, pcap_header
+from pcap_filter import parse_time
+
+# changed whenever the layout of the index file changes
+TIME_INDEX_VERSION = 1
+
+# number of packets in each block of the index
+BLOCK_PACKETS = 1024
+
+# formats of a time of day on the date the capture starts
+TIME_OF_DAY_FORMATS = ('%H:%M', '%H:%M:%S', '%H:%M:%S.%f')
+
+# one row per block of packets
+TIME_INDEX_DTYPE = np.dtype([('offset', 'u8'),
+                             ('packet', 'u8'),
+                             ('min_time', 'f8'),
+                             ('max_time', 'f8')])
+
+
+class TimeIndex:
+    """
+    sparse index of the timestamps in a pcap file, one TIME_INDEX_DTYPE row per block of packets
+    end is the offset after the last record indexed
+    """
+
+    def __init__(self, blocks: np.ndarray, end: int, packets: int, block_packets: int = BLOCK_PACKETS):
+        """
+        :param blocks: numpy structured array with one TIME_INDEX_DTYPE row per block
+        :param end: offset after the last record indexed
+        :param packets: number of packets indexed
+        :param block_packets: number of packets in each block
+        """
+        self.blocks = blocks
+        self.end = end
+        self.packets = packets
+        self.block_packets = block_packets
+
+    def window(self, start_time: Optional[float], end_time: Optional[float]) -> tuple[int, int]:
+        """
+        find the byte range holding every packet with start_time <= timestamp < end_time,
+        it can also hold packets outside the window from the first and last blocks read
+        :param start_time: start of the window, None for the start of the capture
+        :param end_time: end of the window, None for the end of the capture
+        :return: (start offset, end offset) of the records to read
+        """
+        blocks = self.blocks
+        if not len(blocks):
+            return FILE_HEADER_SIZE, self.end
+
+        first = 0
+        if start_time is not None:
+            # blocks before the first one with a packet at or after the start are all too early
+            latest = np.maximum.accumulate(blocks['max_time'])
+            first = int(np.searchsorted(latest, start_time, 'left'))
+        last = len(blocks)
+        if end_time is not None:
+            # blocks from the first one where every later packet is at or after the end are all too late
+            earliest = np.minimum.accumulate(blocks['min_time'][::-1])[::-1]
+            last = int(np.searchsorted(earliest, end_time, 'left'))
+
+        if first >= last:
+            return self.end, self.end
+        end = int(blocks['offset'][last]) if last < len(blocks) else self.end
+        return int(blocks['offset'][first]), end
+
+
+def index_path(pcap_file: str) -> str:
+    """
+    :param pcap_file: relative path to pcap file
+    :return: path of the sidecar index file
+    """
+    return f'{pcap_file}.tidx'
+
+
+def build_blocks(pcap_file: str, start: Optional[int] = None, packet: int = 0,
+                 block_packets: int = BLOCK_PACKETS) -> tuple[np.ndarray, int, int]:
+    """
+    walk the record headers of a pcap file and summarise each block of packets
+    packet data is never read, only the record headers
+    :param pcap_file: relative path to pcap file
+    :param start: offset of the record to start from, the first record of a block
+    :param packet: number of the packet at start
+    :param block_packets: number of packets in each block
+    :return: (blocks, offset after the last complete record, number of packets) tuple
+    """
+    if start is None:
+        start = FILE_HEADER_SIZE
+    rows = []
+    with open(pcap_file, 'rb') as open_file:
+        record_header, divisor = pcap_header(open_file.read(FILE_HEADER_SIZE))
+        size = os.fstat(open_file.fileno()).st_size
+        offset = start
+        if size > start:
+            with mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                header_size = record_header.size
+                # timestamp and caplen are the first three fields of the record header
+                unpack_times = struct.Struct(record_header.format[0] + 'III').unpack_from
+
+                block_offset = offset
+                block_start = packet
+                min_time = max_time = None
+                # stop at an incomplete record at the end of the file
+                while offset + header_size <= size:
+                    ts_sec, ts_frac, caplen = unpack_times(buf, offset)
+                    if offset + header_size + caplen > size:
+                        break
+                    timestamp = ts_sec + ts_frac / divisor
+                    if min_time is None:
+                        block_offset, block_start = offset, packet
+                        min_time = max_time = timestamp
+                    elif timestamp < min_time:
+                        min_time = timestamp
+                    elif timestamp > max_time:
+                        max_time = timestamp
+                    offset += header_size + caplen
+                    packet += 1
+
+                    if packet - block_start == block_packets:
+                        rows.append((block_offset, block_start, min_time, max_time))
+                        min_time = None
+                if min_time is not None:
+                    rows.append((block_offset, block_start, min_time, max_time))
+
+    return np.array(rows, dtype=TIME_INDEX_DTYPE), offset, packet
+
+
+def load_time_index(pcap_file: str, index_file: Optional[str] = None,
+                    block_packets: int = BLOCK_PACKETS) -> TimeIndex:
+    """
+    read the sidecar index of a pcap file, building it the first time
+    and adding blocks for records written since it was saved
+    :param pcap_file: relative path to pcap file
+    :param index_file: path of the index file, None for the sidecar path of the capture
+    :param block_packets: number of packets in each block of a new index
+    :return: time index of every complete record in the file
+    """
+    if index_file is None:
+        index_file = index_path(pcap_file)
+
+    saved = None
+    try:
+        with open(index_file, 'rb') as open_file:
+            saved = pickle.load(open_file)
+    # no index yet, or an index that cannot be read is built again
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        pass
+    if not isinstance(saved, dict) or saved.get('version') != TIME_INDEX_VERSION \
+            or not same_capture(saved['fingerprint'], pcap_file):
+        saved = None
+
+    if saved is not None and os.path.getsize(pcap_file) == saved['fingerprint']['size']:
+        return TimeIndex(saved['blocks'], saved['end'], saved['packets'], saved['block_packets'])
+
+    if saved is None:
+        blocks, end, packets = build_blocks(pcap_file, block_packets=block_packets)
+    else:
+        # the last block may not be full, it is built again with the records after it
+        old_blocks = saved['blocks']
+        block_packets = saved['block_packets']
+        if len(old_blocks):
+            last = old_blocks[-1]
+            new_blocks, end, packets = build_blocks(pcap_file, int(last['offset']), int(last['packet']),
+                                                    block_packets)
+            blocks = np.concatenate([old_blocks[:-1], new_blocks])
+        else:
+            blocks, end, packets = build_blocks(pcap_file, block_packets=block_packets)
+
+    index = TimeIndex(blocks, end, packets, block_packets)
+    save_time_index(index_file, pcap_file, index)
+    return index
+
+
+def save_time_index(index_file: str, pcap_file: str, index: TimeIndex) -> None:
+    """
+    save a time index next to its capture
+    a capture in a directory that cannot be written to is indexed again on each run
+    :param index_file: path of the index file
+    :param pcap_file: relative path to pcap file
+    :param index: time index of the capture
+    """
+    saved = {'version': TIME_INDEX_VERSION,
+             'fingerprint': fingerprint(pcap_file),
+             'block_packets': index.block_packets,
+             'blocks': index.blocks,
+             'end': index.end,
+             'packets': index.packets}
+
+    # replace the old index in one step so an interrupted save never leaves half an index
+    temporary_file = f'{index_file}.tmp'
+    try:
+        with open(temporary_file, 'wb') as open_file:
+            pickle.dump(saved, open_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file, index_file)
+    except OSError:
+        pass
+
+
+def parse_window_time(value: str, pcap_file: str) -> float:
+    """
+    read the start or end of a time window
+    :param value: seconds since the epoch, an ISO date and time in UTC e.g. 2019-02-12T14:02,
+                  or a time of day in UTC e.g. 14:02 on the day of the first packet in the capture
+    :param pcap_file: relative path to pcap file
+    :return: seconds since the epoch
+    """
+    for time_format in TIME_OF_DAY_FORMATS:
+        try:
+            time_of_day = datetime.strptime(value, time_format).time()
+            break
+        except ValueError:
+            pass
+    else:
+        return parse_time(value)
+
+    # a time of day is on the date the capture starts
+    with open(pcap_file, 'rb') as open_file:
+        record_header, divisor = pcap_header(open_file.read(FILE_HEADER_SIZE))
+        header = open_file.read(record_header.size)
+    if len(header) < record_header.size:
+        raise ValueError(f'no packets to give a date to {value!r}')
+    ts_sec, ts_frac = record_header.unpack(header)[:2]
+    date = datetime.fromtimestamp(ts_sec + ts_frac / divisor, timezone.utc).date()
+    return datetime.combine(date, time_of_day, timezone.utc).timestamp()